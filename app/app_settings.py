@@ -1,36 +1,156 @@
 import os
 import json
+import asyncio
+import atexit
+import logging
+import threading
 from aiohttp import web
+from .atomic_write import atomic_write
+from .route_executor import get_route_executor
+
+SETTINGS_FILE = "comfy.settings.json"
+
+# seconds without changes before settings are written back to disk
+FLUSH_DELAY = 1.0
+# seconds a change waits at most, when posts keep coming
+FLUSH_MAX_DELAY = 10.0
+# seconds before a failed write is tried again
+FLUSH_RETRY_DELAY = 10.0
+
+
+class UserSettings():
+    def __init__(self, file, settings):
+        self.file = file
+        self.settings = settings
+        self.version = 0
+        self.written_version = 0
+        self.flush_handle = None
+        self.changed_at = None  # loop time of the oldest unwritten change
+        self.write_lock = threading.Lock()
 
 
 class AppSettings():
+    """Serves user settings from memory.
+
+    Each user's settings file is read once, changes are applied in memory
+    and written back atomically once posts have settled for FLUSH_DELAY
+    seconds, or FLUSH_MAX_DELAY seconds after the first change. A failed
+    write is tried again after FLUSH_RETRY_DELAY seconds. Changes made to
+    the file on disk while the server is running are not picked up.
+    """
+
     def __init__(self, user_manager):
         self.user_manager = user_manager
+        self.executor = get_route_executor()
+        self.users = {}
+        self.locks = {}
+        self.flush_tasks = set()
+        atexit.register(self.flush_all)
 
-    def get_settings(self, request):
-        file = self.user_manager.get_request_user_filepath(
-            request, "comfy.settings.json")
+    def get_lock(self, user):
+        lock = self.locks.get(user)
+        if lock is None:
+            lock = self.locks[user] = asyncio.Lock()
+        return lock
+
+    def load_settings(self, request):
+        file = self.user_manager.get_request_user_filepath(request, SETTINGS_FILE)
         if os.path.isfile(file):
             with open(file) as f:
-                return json.load(f)
+                return UserSettings(file, json.load(f))
         else:
-            return {}
+            return UserSettings(file, {})
+
+    async def get_user_settings(self, request, user):
+        # callers hold the user's lock
+        user_settings = self.users.get(user)
+        if user_settings is None:
+            user_settings = await self.executor.run_io("settings", self.load_settings, request)
+            self.users[user] = user_settings
+        return user_settings
 
-    def save_settings(self, request, settings):
-        file = self.user_manager.get_request_user_filepath(
-            request, "comfy.settings.json")
-        with open(file, "w") as f:
-            f.write(json.dumps(settings, indent=4))
+    async def get_settings(self, request):
+        user = self.user_manager.get_request_user_id(request)
+        user_settings = self.users.get(user)
+        if user_settings is None:
+            async with self.get_lock(user):
+                user_settings = await self.get_user_settings(request, user)
+        return user_settings.settings
+
+    async def update_settings(self, request, new_settings):
+        user = self.user_manager.get_request_user_id(request)
+        async with self.get_lock(user):
+            user_settings = await self.get_user_settings(request, user)
+            user_settings.settings.update(new_settings)
+            user_settings.version += 1
+            self.schedule_flush(user_settings)
+
+    def schedule_flush(self, user_settings):
+        if user_settings.flush_handle is not None:
+            user_settings.flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if user_settings.changed_at is None:
+            user_settings.changed_at = now
+        delay = min(FLUSH_DELAY, user_settings.changed_at + FLUSH_MAX_DELAY - now)
+        user_settings.flush_handle = loop.call_later(max(delay, 0), self.start_flush, user_settings)
+
+    def start_flush(self, user_settings):
+        if user_settings.flush_handle is not None:
+            user_settings.flush_handle.cancel()
+        user_settings.flush_handle = None
+        user_settings.changed_at = None
+        # keep a reference, the loop only holds tasks weakly
+        task = asyncio.create_task(self.flush(user_settings))
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self, user_settings):
+        data = json.dumps(user_settings.settings, indent=4)
+        written = await self.executor.run_io("settings", self.write_settings, user_settings, data, user_settings.version)
+        if not written and user_settings.flush_handle is None:
+            # unless a newer change has scheduled a flush already
+            loop = asyncio.get_running_loop()
+            user_settings.flush_handle = loop.call_later(FLUSH_RETRY_DELAY, self.start_flush, user_settings)
+
+    def write_settings(self, user_settings, data, version):
+        """Returns False if the write failed."""
+        with user_settings.write_lock:
+            # an overtaken flush must not replace newer settings
+            if version <= user_settings.written_version:
+                return True
+            try:
+                atomic_write(user_settings.file, data)
+                user_settings.written_version = version
+                return True
+            except OSError as e:
+                logging.warning(f"Unable to save settings {user_settings.file}: {e}")
+                return False
+
+    async def close(self, app=None):
+        """Writes pending changes now and waits for all writes to finish."""
+        for user_settings in list(self.users.values()):
+            if user_settings.flush_handle is not None:
+                self.start_flush(user_settings)
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks)
+
+    def flush_all(self):
+        for user_settings in list(self.users.values()):
+            if user_settings.version > user_settings.written_version:
+                data = json.dumps(user_settings.settings, indent=4)
+                self.write_settings(user_settings, data, user_settings.version)
 
     def add_routes(self, routes):
         @routes.get("/settings")
         async def get_settings(request):
-            return web.json_response(self.get_settings(request))
+            settings = await self.get_settings(request)
+            return web.json_response(settings)
 
         @routes.get("/settings/{id}")
         async def get_setting(request):
             value = None
-            settings = self.get_settings(request)
+            settings = await self.get_settings(request)
             setting_id = request.match_info.get("id", None)
             if setting_id and setting_id in settings:
                 value = settings[setting_id]
@@ -38,9 +158,8 @@ class AppSettings():
 
         @routes.post("/settings")
         async def post_settings(request):
-            settings = self.get_settings(request)
             new_settings = await request.json()
-            self.save_settings(request, {**settings, **new_settings})
+            await self.update_settings(request, new_settings)
             return web.Response(status=200)
 
         @routes.post("/settings/{id}")
@@ -48,7 +167,6 @@ class AppSettings():
             setting_id = request.match_info.get("id", None)
             if not setting_id:
                 return web.Response(status=400)
-            settings = self.get_settings(request)
-            settings[setting_id] = await request.json()
-            self.save_settings(request, settings)
-            return web.Response(status=200)
\ No newline at end of file
+            new_settings = {setting_id: await request.json()}
+            await self.update_settings(request, new_settings)
+            return web.Response(status=200)
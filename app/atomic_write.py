@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+
+def file_mode(path):
+    """The permissions to give the new file at path: those of the file it
+    replaces, or what open() would have given a new one."""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def atomic_write(path, data):
+    """Replaces the file at path with data, a str or bytes.
+
+    The data goes to a temporary file in the same directory, which is
+    synced to disk and renamed over path, so readers and a restart after a
+    crash see either the old or the new contents. It gets the permissions
+    of the file it replaces, mkstemp only makes it readable by its owner.
+    The temporary file is removed when anything fails and the error is
+    raised.
+    """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, file_mode(path))
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    if hasattr(os, "O_DIRECTORY"):
+        # the rename itself is only durable once the directory is synced
+        dir_fd = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
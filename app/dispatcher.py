@@ -0,0 +1,437 @@
+import abc
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+
+import aiohttp
+
+import folder_paths
+from app.prompt_queue import ExecutionStatus
+
+# seconds between health checks of a backend, and before reconnecting to one
+HEALTH_INTERVAL = 5.0
+HEALTH_TIMEOUT = 5.0
+# weight of the newest sample in the smoothed latencies
+SMOOTHING = 0.2
+
+
+def smooth(average, sample):
+    if average is None:
+        return sample
+    return average + SMOOTHING * (sample - average)
+
+
+def prompt_models(prompt):
+    """The model files a prompt loads, sorted."""
+    models = set()
+    for node in prompt.values():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            continue
+        for value in inputs.values():
+            if not isinstance(value, str):
+                continue
+            extension = os.path.splitext(value)[1].lower()
+            if extension in folder_paths.supported_pt_extensions:
+                models.add(value)
+    return tuple(sorted(models))
+
+
+def affinity(worker, models):
+    # rendezvous hashing: each set of models ranks the workers in its own
+    # stable order, adding or losing a worker only moves its own share
+    key = "\0".join((worker.name,) + models).encode()
+    return hashlib.sha1(key).digest()
+
+
+class Job:
+    def __init__(self, item, item_id):
+        self.item = item
+        self.item_id = item_id
+        self.prompt_id = item[1]
+        self.client_id = item[3].get("client_id")
+        self.models = prompt_models(item[2])
+        # nodes to run, the unit outstanding work is counted in
+        self.cost = max(len(item[2]), 1)
+        self.started = time.monotonic()
+        self.done = None
+
+
+class Worker(abc.ABC):
+    """A backend prompts are dispatched to.
+
+    `jobs` holds the prompts assigned to it and is only changed under the
+    dispatcher's mutex. node_time, the smoothed seconds per node of the
+    prompts it finished, turns the outstanding nodes into the time it
+    needs to get through them.
+    """
+
+    def __init__(self, name, capacity=1):
+        self.name = name
+        self.capacity = capacity
+        self.jobs = {}
+        self.healthy = True
+        self.last_error = None
+        self.models = ()
+        self.node_time = None
+        self.ping = None
+        self.completed = 0
+        self.failed = 0
+
+    def has_capacity(self):
+        return self.healthy and len(self.jobs) < self.capacity
+
+    def expected_time(self, cost):
+        outstanding = sum(job.cost for job in self.jobs.values())
+        return (outstanding + cost) * (self.node_time or 1.0)
+
+    def record(self, job, success):
+        if success:
+            self.completed += 1
+            elapsed = time.monotonic() - job.started
+            self.node_time = smooth(self.node_time, elapsed / job.cost)
+        else:
+            self.failed += 1
+
+    def metrics(self):
+        return {
+            "healthy": self.healthy,
+            "last_error": self.last_error,
+            "running": len(self.jobs),
+            "capacity": self.capacity,
+            "completed": self.completed,
+            "failed": self.failed,
+            "seconds_per_node": self.node_time,
+            "ping": self.ping,
+        }
+
+    def start(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    @abc.abstractmethod
+    def submit(self, job):
+        """Starts running job, the worker calls dispatcher.finish or
+        dispatcher.retry once it is done with it."""
+
+
+class EventRelay:
+    """Takes the server's place for an in-process executor.
+
+    Events go to the server, while the client_id and last_node_id the
+    executor sets stay with its worker instead of the shared server state.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.client_id = None
+        self.last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        self.server.send_sync(event, data, sid)
+
+
+class LocalWorker(Worker):
+    """Runs prompts on its own thread with an in-process executor, built by
+    make_executor(relay). See StandInExecutor for what it has to provide."""
+
+    def __init__(self, name, server, make_executor):
+        super().__init__(name)
+        self.relay = EventRelay(server)
+        self.executor = make_executor(self.relay)
+        self.pending = queue.SimpleQueue()
+
+    def start(self, dispatcher):
+        super().start(dispatcher)
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+    def submit(self, job):
+        self.pending.put(job)
+
+    def run(self):
+        while True:
+            job = self.pending.get()
+            number, prompt_id, prompt, extra_data, outputs_to_execute = job.item
+            try:
+                self.executor.execute(prompt, prompt_id, extra_data, outputs_to_execute)
+                outputs = self.executor.outputs_ui
+                status = ExecutionStatus(
+                    status_str="success" if self.executor.success else "error",
+                    completed=self.executor.success,
+                    messages=self.executor.status_messages,
+                )
+            except Exception as e:
+                logging.exception(f"{self.name} failed to execute prompt {prompt_id}")
+                outputs = {}
+                status = ExecutionStatus(
+                    status_str="error",
+                    completed=False,
+                    messages=[
+                        (
+                            "execution_error",
+                            {"prompt_id": prompt_id, "exception_message": str(e)},
+                        )
+                    ],
+                )
+            self.dispatcher.finish(self, job, outputs, status)
+
+
+class RemoteWorker(Worker):
+    """A ComfyUI backend at url.
+
+    Prompts are posted to the backend under their own prompt_id, with the
+    client_id of a websocket this worker keeps open, and the backend's
+    events for them are relayed to the client that queued them. The
+    outputs are read back from the backend's history once it is done.
+
+    The backend is healthy while the websocket is open and it answers
+    GET /prompt, which is also what its ping is measured with. When the
+    connection is lost, its prompts go back to the queue, so a prompt
+    that was almost done may run again on another backend.
+    """
+
+    def __init__(self, url, loop, capacity=2):
+        # a second prompt waits on the backend, so it starts right away
+        super().__init__(url, capacity)
+        self.url = url.rstrip("/")
+        self.loop = loop
+        self.client_id = uuid.uuid4().hex
+        self.session = None
+        self.running = None
+        self.healthy = False
+
+    def start(self, dispatcher):
+        super().start(dispatcher)
+        asyncio.run_coroutine_threadsafe(self.connect(), self.loop)
+
+    def submit(self, job):
+        asyncio.run_coroutine_threadsafe(self.execute(job), self.loop)
+
+    async def run_io(self, function, *args):
+        await self.dispatcher.server.executor.run_io("dispatch", function, *args)
+
+    async def connect(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HEALTH_TIMEOUT)
+        )
+        while True:
+            error = "connection closed"
+            try:
+                async with self.session.ws_connect(
+                    f"{self.url}/ws?clientId={self.client_id}",
+                    heartbeat=HEALTH_INTERVAL,
+                ) as ws:
+                    checks = asyncio.ensure_future(self.check_health(ws))
+                    try:
+                        async for msg in ws:
+                            self.relay(msg)
+                    finally:
+                        checks.cancel()
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                error = str(e) or type(e).__name__
+
+            self.running = None
+            self.dispatcher.set_health(self, False, error)
+            for job in list(self.jobs.values()):
+                if job.done is not None and not job.done.done():
+                    job.done.set_exception(ConnectionError(error))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def check_health(self, ws):
+        timeout = aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)
+        while True:
+            start = time.monotonic()
+            try:
+                async with self.session.get(
+                    f"{self.url}/prompt", timeout=timeout
+                ) as response:
+                    response.raise_for_status()
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.dispatcher.set_health(self, False, str(e) or type(e).__name__)
+                await ws.close()
+                return
+            self.ping = smooth(self.ping, time.monotonic() - start)
+            if not self.healthy:
+                self.dispatcher.set_health(self, True)
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    def relay(self, msg):
+        if msg.type == aiohttp.WSMsgType.BINARY:
+            # previews carry no prompt_id, they belong to the running prompt
+            job = self.jobs.get(self.running)
+            if job is not None and job.client_id is not None and len(msg.data) >= 4:
+                event = struct.unpack(">I", msg.data[:4])[0]
+                self.dispatcher.server.send_sync(event, msg.data[4:], job.client_id)
+            return
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            return
+
+        try:
+            message = msg.json()
+        except ValueError:
+            return
+        event = message.get("type")
+        if event == "status":
+            # the backend's own queue, clients see ours
+            return
+        data = message.get("data")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if event == "executing" and prompt_id is not None:
+            self.running = prompt_id if data.get("node") is not None else None
+        job = self.jobs.get(prompt_id or self.running)
+        if job is None:
+            return
+
+        if event == "execution_start":
+            # it may have waited behind another prompt on the backend
+            job.started = time.monotonic()
+        if event == "executing" and data.get("node") is None:
+            # the dispatcher sends this once the outputs are in the history
+            if job.done is not None and not job.done.done():
+                job.done.set_result(None)
+        elif job.client_id is not None:
+            self.dispatcher.server.send_sync(event, data, job.client_id)
+
+    async def execute(self, job):
+        number, prompt_id, prompt, extra_data, outputs_to_execute = job.item
+        job.done = self.loop.create_future()
+        body = {
+            "prompt": prompt,
+            "prompt_id": prompt_id,
+            "client_id": self.client_id,
+            "extra_data": {k: v for k, v in extra_data.items() if k != "client_id"},
+        }
+        try:
+            async with self.session.post(f"{self.url}/prompt", json=body) as response:
+                if response.status == 400:
+                    # the backend can't run it, trying others won't help
+                    error = await response.json()
+                    await self.run_io(
+                        self.dispatcher.finish,
+                        self,
+                        job,
+                        {},
+                        ExecutionStatus(
+                            status_str="error",
+                            completed=False,
+                            messages=[("execution_error", error)],
+                        ),
+                    )
+                    return
+                response.raise_for_status()
+            await job.done
+            async with self.session.get(f"{self.url}/history/{prompt_id}") as response:
+                response.raise_for_status()
+                history = (await response.json()).get(prompt_id, {})
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+            await self.run_io(self.dispatcher.retry, self, job, str(e))
+            return
+
+        status = history.get("status")
+        if status is not None:
+            status = ExecutionStatus(**status)
+        await self.run_io(
+            self.dispatcher.finish, self, job, history.get("outputs", {}), status
+        )
+
+
+class Dispatcher:
+    """Hands queued prompts to a pool of workers.
+
+    A prompt is only taken off the PromptQueue once a healthy worker has
+    room for it, so everything waiting stays visible in /queue and can
+    still be reordered or deleted. "least-work" sends it to the worker
+    expected to get to it first, from the nodes it has outstanding and its
+    speed. "affinity" prefers a free worker that ran the same models last
+    and otherwise picks one by hashing the models, so prompts sharing
+    checkpoints keep landing on the same backend instead of making every
+    backend reload them.
+    """
+
+    def __init__(self, server, prompt_queue, workers, policy="least-work"):
+        self.server = server
+        self.prompt_queue = prompt_queue
+        self.workers = workers
+        self.policy = policy
+        self.mutex = threading.Condition()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start(self)
+        threading.Thread(target=self.run, name="dispatcher", daemon=True).start()
+
+    def pick(self, job):
+        free = [worker for worker in self.workers if worker.has_capacity()]
+        if len(free) == 0:
+            return None
+        if self.policy == "affinity" and job.models:
+            loaded = [worker for worker in free if worker.models == job.models]
+            if len(loaded) == 0:
+                return max(free, key=lambda worker: affinity(worker, job.models))
+            free = loaded
+        return min(free, key=lambda worker: worker.expected_time(job.cost))
+
+    def run(self):
+        while True:
+            with self.mutex:
+                while not any(worker.has_capacity() for worker in self.workers):
+                    self.mutex.wait()
+
+            queue_item = self.prompt_queue.get(timeout=1000.0)
+            if queue_item is None:
+                continue
+            job = Job(*queue_item)
+            with self.mutex:
+                worker = self.pick(job)
+                if worker is not None:
+                    worker.jobs[job.prompt_id] = job
+                    worker.models = job.models
+            if worker is None:
+                # the workers went away while we waited for a prompt
+                self.prompt_queue.requeue(job.item_id)
+                continue
+            self.server.last_prompt_id = job.prompt_id
+            worker.submit(job)
+
+    def finish(self, worker, job, outputs, status):
+        self.prompt_queue.task_done(job.item_id, outputs, status)
+        if job.client_id is not None:
+            self.server.send_sync(
+                "executing", {"node": None, "prompt_id": job.prompt_id}, job.client_id
+            )
+        with self.mutex:
+            del worker.jobs[job.prompt_id]
+            worker.record(job, status is None or status.completed)
+            self.mutex.notify_all()
+
+    def retry(self, worker, job, error):
+        """Puts back a prompt the worker lost, for another worker to run."""
+        logging.warning(f"Backend {worker.name} failed prompt {job.prompt_id}: {error}")
+        self.prompt_queue.requeue(job.item_id)
+        with self.mutex:
+            del worker.jobs[job.prompt_id]
+            worker.failed += 1
+            worker.last_error = error
+            self.mutex.notify_all()
+
+    def set_health(self, worker, healthy, error=None):
+        with self.mutex:
+            if worker.healthy != healthy:
+                if healthy:
+                    logging.info(f"Backend {worker.name} is available")
+                else:
+                    logging.warning(f"Backend {worker.name} is unavailable: {error}")
+            worker.healthy = healthy
+            if error is not None:
+                worker.last_error = error
+            self.mutex.notify_all()
+
+    def metrics(self):
+        with self.mutex:
+            return {worker.name: worker.metrics() for worker in self.workers}
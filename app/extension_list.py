@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+import urllib.parse
+
+import folder_paths
+import nodes
+from app.response_cache import PrecompressedBody
+
+# seconds the listing is served before the directories' mtimes are checked
+# again, when they aren't watched
+CHECK_INTERVAL = 2.0
+
+
+class ExtensionList:
+    """Cached listing of the frontend extension scripts for GET /extensions.
+
+    The listing is built once and kept as a precompressed JSON body. Like
+    folder_paths.cached_filename_list_, it is invalidated when the mtime of
+    a scanned directory changes, checked on an io thread at most every
+    CHECK_INTERVAL seconds, so requests in between don't touch the disk.
+    It doesn't use the --watch-model-folders watcher, extension folders
+    rarely change and a listing a few seconds old is fine.
+    """
+
+    def __init__(self, web_root):
+        self.web_root = web_root
+        self.roots = None
+        self.dirs = {}
+        self.body = None
+        self.checked_at = 0.0
+
+    def get_roots(self):
+        roots = [("/extensions", os.path.join(self.web_root, "extensions"))]
+        for name, dir in nodes.EXTENSION_WEB_DIRS.items():
+            roots.append(("/extensions/" + urllib.parse.quote(name), dir))
+        return roots
+
+    def scan(self, roots):
+        extensions = []
+        dirs = {}
+        for prefix, directory in roots:
+            files, folders = folder_paths.recursive_search(directory)
+            dirs.update(folders)
+            for file_name in sorted(files):
+                file_name = file_name.replace("\\", "/")
+                if not file_name.endswith(".js"):
+                    continue
+                # glob("**/*.js") never matched hidden files or folders
+                if any(part.startswith(".") for part in file_name.split("/")):
+                    continue
+                extensions.append(prefix + "/" + file_name)
+
+        self.roots = roots
+        self.dirs = dirs
+        self.body = PrecompressedBody.from_json(extensions)
+        self.checked_at = time.monotonic()
+        return self.body
+
+    def changed(self, roots):
+        for dir, time_modified in self.dirs.items():
+            try:
+                if os.path.getmtime(dir) != time_modified:
+                    return True
+            except OSError:
+                return True
+
+        for _, directory in roots:
+            if os.path.isdir(directory) and directory not in self.dirs:
+                return True
+
+        return False
+
+    def cached(self, roots):
+        """The listing if it can be served without checking the disk."""
+        if self.body is None or roots != self.roots:
+            return None
+        if time.monotonic() - self.checked_at < CHECK_INTERVAL:
+            return self.body
+        return None
+
+    def revalidate(self, roots):
+        body = self.body
+        if body is not None and roots == self.roots:
+            if not self.changed(roots):
+                self.checked_at = time.monotonic()
+                return body
+        return self.scan(roots)
+
+    async def response(self, request):
+        roots = self.get_roots()
+        body = self.cached(roots)
+        if body is None:
+            loop = asyncio.get_running_loop()
+            body = await loop.run_in_executor(None, self.revalidate, roots)
+        return body.response(request)
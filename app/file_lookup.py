@@ -0,0 +1,118 @@
+import logging
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+# seconds a file's stat is reused before asking the filesystem again
+STAT_TTL = 1.0
+
+# answered from the file's stat, which must be current for them
+CONDITIONAL_HEADERS = (
+    "If-Match",
+    "If-None-Match",
+    "If-Modified-Since",
+    "If-Unmodified-Since",
+)
+
+
+class StatCache:
+    """Short lived cache of os.stat results for files served by path.
+
+    Clients scrubbing through a video send a burst of range requests for the
+    same file, those share one stat. Only existing files are cached so a
+    file that appears is found right away; callers that write a file
+    invalidate it.
+    """
+
+    def __init__(self, max_entries=4096, ttl=STAT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def stat(self, path):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(path)
+                return entry[1]
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+
+        with self.lock:
+            self.entries[path] = (now, st)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return st
+
+    def is_file(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+
+class StatFileResponse(web.FileResponse):
+    """FileResponse for a file that was just stat'ed.
+
+    aiohttp handles Range, If-Range and the conditional headers and sends
+    the body with sendfile. This skips its own stat and the lookups for
+    precompressed .gz/.br siblings, which outputs never have. The file is
+    still fstat'ed once it is opened, so the body and length always match.
+
+    A stat from the StatCache can be up to STAT_TTL old, so conditional
+    requests stat the file again: a 304 or 412 from an outdated ETag or
+    Last-Modified would keep a client on the old contents.
+
+    This overrides aiohttp's private FileResponse._get_file_path_stat_encoding,
+    so requirements.txt pins aiohttp to the versions it was tested with.
+    Without it this is a plain FileResponse, see check_file_response_hook.
+    """
+
+    def __init__(self, path, st, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.stat_result = st
+
+    async def prepare(self, request):
+        if any(header in request.headers for header in CONDITIONAL_HEADERS):
+            self.stat_result = None
+        return await super().prepare(request)
+
+    def _get_file_path_stat_encoding(self, accept_encoding):
+        st = self.stat_result
+        if st is None:
+            st = self._path.stat()
+        return self._path, st, None
+
+
+def check_file_response_hook():
+    if not callable(getattr(web.FileResponse, "_get_file_path_stat_encoding", None)):
+        logging.error(
+            "aiohttp's FileResponse no longer has _get_file_path_stat_encoding, "
+            "files are stat'ed again for every /view and /userdata response. "
+            "Update app/file_lookup.StatFileResponse for this aiohttp version."
+        )
+        return False
+    return True
+
+
+check_file_response_hook()
+
+
+stat_cache = StatCache()
+
+
+def get_stat_cache():
+    return stat_cache
@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import threading
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Minimal inotify binding that reports file level changes in directories.
+
+    Callbacks are called from the watcher thread as
+    ``callback(kind, path, is_dir)`` where kind is "created", "deleted" or
+    "overflow". On "overflow" events were lost and path is None, the
+    subscriber should rebuild whatever it derived from the events.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.lock = threading.Lock()
+        self.paths = {}  # path -> wd
+        self.watches = {}  # wd -> set of paths
+        self.callbacks = {}  # path -> list of callbacks
+        self.warned = False
+
+        self.thread = threading.Thread(
+            target=self.run, name="inotify watcher", daemon=True
+        )
+        self.thread.start()
+
+    def watch(self, path, callback):
+        with self.lock:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if not self.warned:
+                    self.warned = True
+                    logging.warning(
+                        f"Unable to watch {path}: {os.strerror(err)}. "
+                        "Falling back to checking folder modification times."
+                    )
+                return False
+
+            self.paths[path] = wd
+            self.watches.setdefault(wd, set()).add(path)
+            callbacks = self.callbacks.setdefault(path, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            return True
+
+    def is_watching(self, path, callback):
+        with self.lock:
+            return callback in self.callbacks.get(path, ())
+
+    def unwatch(self, path, callback=None, recursive=False):
+        with self.lock:
+            if recursive:
+                prefix = os.path.join(path, "")
+                paths = [p for p in self.paths if p == path or p.startswith(prefix)]
+            else:
+                paths = [path] if path in self.paths else []
+
+            for p in paths:
+                callbacks = self.callbacks.get(p, [])
+                if callback is not None and callback in callbacks:
+                    callbacks.remove(callback)
+                if callback is None or len(callbacks) == 0:
+                    self.remove_path(p)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            for path in [p for p, c in self.callbacks.items() if callback in c]:
+                self.callbacks[path].remove(callback)
+                if len(self.callbacks[path]) == 0:
+                    self.remove_path(path)
+
+    def remove_path(self, path):
+        self.callbacks.pop(path, None)
+        wd = self.paths.pop(path, None)
+        if wd is None:
+            return
+        paths = self.watches.get(wd)
+        if paths is not None:
+            paths.discard(path)
+            if len(paths) == 0:
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except InterruptedError:
+                continue
+            except OSError as e:
+                logging.error(f"inotify watcher stopped: {e}")
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                self.dispatch(wd, mask, name)
+
+    def dispatch(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            with self.lock:
+                callbacks = []
+                for c in self.callbacks.values():
+                    callbacks.extend(x for x in c if x not in callbacks)
+            for callback in callbacks:
+                self.call(callback, "overflow", None, False)
+            return
+
+        if mask & IN_IGNORED:
+            # the watched directory itself is gone
+            with self.lock:
+                for path in self.watches.pop(wd, set()):
+                    self.paths.pop(path, None)
+                    self.callbacks.pop(path, None)
+            return
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            kind = "created"
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            kind = "deleted"
+        else:
+            return
+
+        is_dir = bool(mask & IN_ISDIR)
+        with self.lock:
+            targets = [
+                (os.path.join(path, name), list(self.callbacks.get(path, [])))
+                for path in self.watches.get(wd, ())
+            ]
+
+        for path, callbacks in targets:
+            if kind == "deleted" and is_dir:
+                # a moved away directory keeps its watch, drop it explicitly
+                self.unwatch(path, recursive=True)
+            for callback in callbacks:
+                self.call(callback, kind, path, is_dir)
+
+    def call(self, callback, kind, path, is_dir):
+        try:
+            callback(kind, path, is_dir)
+        except Exception:
+            logging.exception("Error in filesystem watcher callback")
+
+
+watcher = None
+watcher_failed = False
+
+
+def is_supported():
+    return sys.platform.startswith("linux")
+
+
+def get_watcher():
+    global watcher, watcher_failed
+    if watcher is None and not watcher_failed and is_supported():
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            watcher_failed = True
+            logging.warning(f"Filesystem watcher not available: {e}")
+    return watcher
@@ -0,0 +1,290 @@
+import bisect
+import json
+import logging
+import os
+import threading
+
+from app.atomic_write import atomic_write
+
+MAXIMUM_HISTORY_SIZE = 10000
+
+
+class HistoryStore:
+    """Finished prompts, oldest first, bounded by count and encoded size.
+
+    Every entry gets a sequence number that only ever grows, even across
+    clears, and clients use it as a cursor: after(cursor) returns what was
+    added since, before(cursor) pages back through older entries. Entries
+    are stored json encoded, which is what their size is measured in and
+    what /history responses are built from, so a poll doesn't encode the
+    whole history again.
+
+    `seqs`/`ids` are parallel arrays in sequence order, starting at `head`.
+    Evicting moves head forward and deleting only drops the entry from
+    `entries`, the arrays are compacted once most of them is dead.
+
+    With log_file set, changes are appended to it as json lines and
+    replayed on startup.
+    """
+
+    def __init__(self, max_items=MAXIMUM_HISTORY_SIZE, max_size=0, log_file=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.log_file = log_file
+        self.log_lines = 0
+        self.lock = threading.Lock()
+        self.entries = {}  # prompt_id -> (seq, json text)
+        self.seqs = []
+        self.ids = []
+        self.head = 0
+        self.size = 0
+        self.last_seq = 0
+        self.dropped_seq = 0  # newest entry lost to eviction or a clear
+        if log_file is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        torn = False
+        try:
+            with open(self.log_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # cut off by a crash, the next append would end up
+                        # on the same line so the log is rewritten below
+                        torn = True
+                        continue
+                    self.log_lines += 1
+                    self.replay(record)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning(f"Unable to load history {self.log_file}: {e}")
+            return
+
+        if torn or self.log_lines > 2 * len(self.entries) + 100:
+            self.compact_log()
+
+    def replay(self, record):
+        if "entry" in record:
+            self.insert(record["id"], json.dumps(record["entry"]), record.get("seq"))
+        elif "delete" in record:
+            self.remove(record["delete"])
+        elif record.get("clear"):
+            self.clear()
+        self.last_seq = max(self.last_seq, record.get("seq", 0))
+
+    def compact_log(self):
+        lines = [
+            self.log_record(self.ids[i], self.seqs[i], self.entries[self.ids[i]][1])
+            for i in self.live_positions(self.head, len(self.ids))
+        ]
+        try:
+            os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+            atomic_write(self.log_file, "".join(lines))
+            self.log_lines = len(lines)
+        except OSError as e:
+            logging.warning(f"Unable to compact history {self.log_file}: {e}")
+
+    @staticmethod
+    def log_record(prompt_id, seq, text):
+        # the entry is already encoded, splice it in rather than decoding it
+        return '{"seq": %d, "id": %s, "entry": %s}\n' % (
+            seq,
+            json.dumps(prompt_id),
+            text,
+        )
+
+    def append_log(self, line):
+        if self.log_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+            with open(self.log_file, "a") as f:
+                f.write(line)
+            self.log_lines += 1
+        except OSError as e:
+            logging.warning(f"Unable to update history {self.log_file}: {e}")
+            return
+        if self.log_lines > 2 * len(self.entries) + 1000:
+            self.compact_log()
+
+    def insert(self, prompt_id, text, seq=None):
+        if prompt_id in self.entries:
+            self.remove(prompt_id)
+        if seq is None or seq <= self.last_seq:
+            seq = self.last_seq + 1
+        self.last_seq = seq
+        self.entries[prompt_id] = (seq, text)
+        self.seqs.append(seq)
+        self.ids.append(prompt_id)
+        self.size += len(text)
+        self.evict()
+        return seq
+
+    def evict(self):
+        while len(self.entries) > 1 and (
+            (self.max_items > 0 and len(self.entries) > self.max_items)
+            or (self.max_size > 0 and self.size > self.max_size)
+        ):
+            prompt_id = self.ids[self.head]
+            entry = self.entries.get(prompt_id)
+            if entry is not None and entry[0] == self.seqs[self.head]:
+                del self.entries[prompt_id]
+                self.size -= len(entry[1])
+                self.dropped_seq = entry[0]
+            self.head += 1
+        self.compact()
+
+    def remove(self, prompt_id):
+        entry = self.entries.pop(prompt_id, None)
+        if entry is None:
+            return False
+        self.size -= len(entry[1])
+        self.compact()
+        return True
+
+    def clear(self):
+        self.dropped_seq = self.last_seq
+        self.entries = {}
+        self.seqs = []
+        self.ids = []
+        self.head = 0
+        self.size = 0
+
+    def compact(self):
+        # evicted slots before head and deleted ones after it
+        if len(self.ids) <= 2 * len(self.entries) + 64:
+            return
+        live = list(self.live_positions(self.head, len(self.ids)))
+        self.seqs = [self.seqs[i] for i in live]
+        self.ids = [self.ids[i] for i in live]
+        self.head = 0
+
+    def is_live(self, i):
+        entry = self.entries.get(self.ids[i])
+        return entry is not None and entry[0] == self.seqs[i]
+
+    def live_positions(self, start, stop, step=1):
+        if step < 0:
+            start, stop = stop - 1, start - 1
+        for i in range(start, stop, step):
+            if self.is_live(i):
+                yield i
+
+    def add(self, prompt_id, entry):
+        """Stores a finished prompt and returns its sequence number."""
+        text = json.dumps(entry)
+        with self.lock:
+            seq = self.insert(prompt_id, text)
+            self.append_log(self.log_record(prompt_id, seq, text))
+            return seq
+
+    def delete(self, prompt_id):
+        with self.lock:
+            if self.remove(prompt_id):
+                self.last_seq += 1
+                self.append_log(
+                    json.dumps({"seq": self.last_seq, "delete": prompt_id}) + "\n"
+                )
+
+    def wipe(self):
+        with self.lock:
+            self.clear()
+            self.last_seq += 1
+            self.append_log(json.dumps({"seq": self.last_seq, "clear": True}) + "\n")
+
+    def get(self, prompt_id):
+        """Returns [(prompt_id, json text)] for the prompt, or []."""
+        with self.lock:
+            entry = self.entries.get(prompt_id)
+            return [] if entry is None else [(prompt_id, entry[1])]
+
+    def items(self, max_items=None, offset=-1):
+        """The entries from offset, the newest max_items when offset is
+        negative, with the same meaning as upstream's get_history."""
+        if offset < 0 and max_items is not None:
+            return self.before(None, max_items)[0][::-1]
+        with self.lock:
+            offset = max(offset, 0)
+            out = []
+            for i in self.live_positions(self.head, len(self.ids)):
+                if offset > 0:
+                    offset -= 1
+                    continue
+                out.append((self.ids[i], self.entries[self.ids[i]][1]))
+                if max_items is not None and len(out) >= max_items:
+                    break
+            return out
+
+    def after(self, cursor, max_items=None):
+        """Entries added after cursor, oldest first.
+
+        Returns (items, cursor, more, truncated): the cursor to pass next time,
+        whether max_items cut the page short and whether entries after the
+        given cursor were evicted or cleared before they could be returned.
+        A cursor from the future, handed out before a restart that lost the
+        history, starts over from the oldest entry."""
+        with self.lock:
+            if cursor > self.last_seq:
+                cursor = 0
+                truncated = True
+            else:
+                truncated = cursor < self.dropped_seq
+            start = bisect.bisect_right(self.seqs, cursor, self.head)
+            out = []
+            more = False
+            next_cursor = max(cursor, 0)
+            for i in self.live_positions(start, len(self.ids)):
+                if max_items is not None and len(out) >= max_items:
+                    more = True
+                    break
+                out.append((self.ids[i], self.entries[self.ids[i]][1]))
+                next_cursor = self.seqs[i]
+            if not more:
+                next_cursor = max(next_cursor, self.last_seq)
+            return out, next_cursor, more, truncated
+
+    def before(self, cursor=None, max_items=None):
+        """Entries added before cursor (or the newest), newest first.
+
+        Returns (items, cursor, more): the cursor of the oldest entry
+        returned, to get the next page with, and whether there are older
+        entries."""
+        with self.lock:
+            stop = len(self.ids)
+            if cursor is not None:
+                stop = bisect.bisect_left(self.seqs, cursor, self.head)
+            out = []
+            more = False
+            next_cursor = cursor
+            for i in self.live_positions(self.head, stop, -1):
+                if max_items is not None and len(out) >= max_items:
+                    more = True
+                    break
+                out.append((self.ids[i], self.entries[self.ids[i]][1]))
+                next_cursor = self.seqs[i]
+            return out, next_cursor, more
+
+    def cursor(self):
+        with self.lock:
+            return self.last_seq
+
+    @staticmethod
+    def encode(items):
+        """Builds the json object {prompt_id: entry} for items."""
+        return (
+            "{"
+            + ", ".join(
+                json.dumps(prompt_id) + ": " + text for prompt_id, text in items
+            )
+            + "}"
+        )
+
+    @staticmethod
+    def decode(items):
+        return {prompt_id: json.loads(text) for prompt_id, text in items}
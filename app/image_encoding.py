@@ -0,0 +1,121 @@
+from io import BytesIO
+
+import struct
+
+import numpy as np
+from PIL import Image, ImageOps
+from PIL.PngImagePlugin import PngInfo
+
+# image format ids sent in the header of binary image messages
+IMAGE_TYPES = {"JPEG": 1, "PNG": 2, "WEBP": 3}
+
+# These run on the route executor's image workers, possibly in another
+# process, so they only take and return picklable values.
+
+
+def encode_preview(file, image_format, quality, channel, max_size=None):
+    with Image.open(file) as img:
+        if max_size is not None:
+            # downscale before encoding, never upscale
+            img.thumbnail((max_size, max_size))
+        if image_format in ["jpeg"] or channel == "rgb":
+            img = img.convert("RGB")
+        buffer = BytesIO()
+        img.save(buffer, format=image_format, quality=quality)
+        return buffer.getvalue()
+
+
+def encode_rgb(file):
+    with Image.open(file) as img:
+        # converting RGBA drops the alpha band in one pass, without the
+        # per band images split() and merge() make
+        new_img = img.convert("RGB")
+
+        buffer = BytesIO()
+        new_img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+def encode_alpha(file):
+    with Image.open(file) as img:
+        # alpha img: black RGB with the original alpha channel
+        alpha_img = Image.new("RGBA", img.size, (0, 0, 0, 255))
+        if img.mode == "RGBA":
+            alpha_img.putalpha(img.getchannel("A"))
+
+        alpha_buffer = BytesIO()
+        alpha_img.save(alpha_buffer, format="PNG")
+        return alpha_buffer.getvalue()
+
+
+def mask_alpha(mask):
+    # only the alpha plane of the mask is used
+    if mask.mode in ["RGBA", "LA"]:
+        return mask.getchannel("A")
+    if mask.mode in ["P", "PA"] or "transparency" in mask.info:
+        return mask.convert("RGBA").getchannel("A")
+    return None  # no alpha, fully opaque
+
+
+def composite_mask(original_file, mask_file, filepath, compress_level):
+    """Saves the original image with the mask's alpha as its alpha channel,
+    keeping the original's PNG text chunks."""
+    with Image.open(original_file) as original, Image.open(mask_file) as mask:
+        metadata = PngInfo()
+        if hasattr(original, "text"):
+            for key in original.text:
+                metadata.add_text(key, original.text[key])
+
+        if mask.size != original.size:
+            raise ValueError("images do not match")
+
+        pixels = np.empty((original.height, original.width, 4), dtype=np.uint8)
+        if original.mode in ["RGB", "RGBA"]:
+            pixels[:, :, :3] = np.asarray(original)[:, :, :3]
+        else:
+            pixels[:, :, :3] = np.asarray(original.convert("RGB"))
+
+        alpha = mask_alpha(mask)
+        if alpha is None:
+            pixels[:, :, 3] = 255
+        else:
+            pixels[:, :, 3] = np.asarray(alpha)
+
+    Image.fromarray(pixels, "RGBA").save(
+        filepath, format="PNG", compress_level=compress_level, pnginfo=metadata
+    )
+
+
+def encode_preview_image(image_type, image, max_size, event=None):
+    """Encodes a sampler preview for the websocket, prefixed with its type.
+
+    With event set the binary event header is written in front as well, so
+    the returned buffer is the complete websocket message and the encoder
+    writes straight into it.
+    """
+    if max_size is not None:
+        if hasattr(Image, "Resampling"):
+            resampling = Image.Resampling.BILINEAR
+        else:
+            resampling = Image.ANTIALIAS
+
+        image = ImageOps.contain(image, (max_size, max_size), resampling)
+    type_num = IMAGE_TYPES.get(image_type, 1)
+
+    bytesIO = BytesIO()
+    if event is not None:
+        bytesIO.write(struct.pack(">II", event, type_num))
+    else:
+        bytesIO.write(struct.pack(">I", type_num))
+    image.save(bytesIO, format=image_type, quality=95, compress_level=1)
+    return bytesIO.getbuffer()
+
+
+def encode_image_frame(image_type, image, event, **save_args):
+    """Encodes a full size image as a complete binary websocket message: the
+    event and image type headers followed by the encoded image, written in
+    place like encode_preview_image. Send it with send_frame_sync."""
+    bytesIO = BytesIO()
+    bytesIO.write(struct.pack(">II", event, IMAGE_TYPES[image_type]))
+    image.save(bytesIO, format=image_type, **save_args)
+    return bytesIO.getbuffer()
@@ -0,0 +1,386 @@
+import asyncio
+import bisect
+import math
+
+from aiohttp import web
+from aiohttp.abc import AbstractAccessLogger
+
+import folder_paths
+from app import upload_stream
+
+# upper bounds in seconds, what Prometheus clients use by default
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+SIZE_BUCKETS = tuple(256 * 4**i for i in range(10))  # 256B to 64MB
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# seconds between event loop lag samples
+LAG_INTERVAL = 0.5
+
+
+class Histogram:
+    """Counts observations into buckets by upper bound and keeps their sum.
+
+    Not thread safe, observe from one thread (the event loop).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yields (upper bound, observations <= bound), ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(bound): count for bound, count in self.cumulative()},
+        }
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Exposition:
+    """Builds a page in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, metric_type, help, samples):
+        """samples is a list of (labels, value)."""
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+    def gauge(self, name, help, value, labels=None):
+        self.metric(name, "gauge", help, [(labels, value)])
+
+    def counter(self, name, help, value, labels=None):
+        self.metric(name, "counter", help, [(labels, value)])
+
+    def histogram(self, name, help, series):
+        """series is a list of (labels, Histogram)."""
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series:
+            labels = labels or {}
+            for bound, count in histogram.cumulative():
+                bucket_labels = format_labels({**labels, "le": format_value(bound)})
+                self.lines.append(f"{name}_bucket{bucket_labels} {count}")
+            self.lines.append(
+                f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}"
+            )
+            self.lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class BodyCounter:
+    """A response writer's on_body_write hook that adds up the body bytes."""
+
+    def __init__(self):
+        self.size = 0
+
+    def __call__(self, size, output_size):
+        self.size += size
+
+
+class RequestSeries:
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram()
+        self.size = Histogram(SIZE_BUCKETS)
+
+
+class ServerMetrics:
+    """Metrics of a PromptServer for GET /metrics (--enable-metrics).
+
+    Requests are recorded from aiohttp's access log hook, which runs once
+    the response is fully sent, so the latency and size include file and
+    streamed bodies that are written after the handler returned. Routes
+    are labeled by their pattern, e.g. /history/{prompt_id}. Websocket
+    messages are counted by event where they are queued, once per message
+    and not per client. Everything else is read from the server when the
+    page is built.
+
+    Response sizes are payload bytes, the Content-Length when one is set
+    and otherwise what the handler wrote (before compression), never the
+    headers.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.requests = {}
+        self.messages = {}  # event -> [count, bytes]
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.last_loop_lag = 0.0
+        self.lag_task = None
+
+    def access_log_class(self):
+        metrics = self
+
+        class MetricsAccessLogger(AbstractAccessLogger):
+            def log(self, request, response, time):
+                metrics.observe_request(request, response, time)
+
+        return MetricsAccessLogger
+
+    async def on_response_prepare(self, request, response):
+        request.writer.on_body_write = BodyCounter()
+
+    def observe_request(self, request, response, time):
+        match_info = getattr(request, "match_info", None)
+        resource = match_info.route.resource if match_info is not None else None
+        route = resource.canonical if resource is not None else "unmatched"
+        key = (request.method, route)
+        series = self.requests.get(key)
+        if series is None:
+            series = self.requests[key] = RequestSeries()
+        status = response.status
+        series.statuses[status] = series.statuses.get(status, 0) + 1
+        series.latency.observe(time)
+        series.size.observe(self.body_size(request, response))
+
+    @staticmethod
+    def body_size(request, response):
+        if request.method == "HEAD" or response.status in (204, 304):
+            return 0
+        if response.content_length is not None:
+            return response.content_length
+        # streamed without a length, body_length would count the headers
+        counter = getattr(request.writer, "on_body_write", None)
+        return counter.size if isinstance(counter, BodyCounter) else 0
+
+    def sent(self, event, size):
+        counts = self.messages.get(event)
+        if counts is None:
+            counts = self.messages[event] = [0, 0]
+        counts[0] += 1
+        counts[1] += size
+
+    async def start(self, app):
+        self.lag_task = asyncio.create_task(self.measure_loop_lag())
+
+    async def stop(self, app):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+
+    async def measure_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(loop.time() - start - LAG_INTERVAL, 0.0)
+            self.last_loop_lag = lag
+            self.loop_lag.observe(lag)
+
+    def render(self):
+        server = self.server
+        page = Exposition()
+
+        page.metric(
+            "comfyui_http_requests_total",
+            "counter",
+            "HTTP requests by route and status.",
+            [
+                ({"method": method, "route": route, "status": status}, count)
+                for (method, route), series in self.requests.items()
+                for status, count in series.statuses.items()
+            ],
+        )
+        page.histogram(
+            "comfyui_http_request_duration_seconds",
+            "Time from receiving a request to having sent the response.",
+            [
+                ({"method": method, "route": route}, series.latency)
+                for (method, route), series in self.requests.items()
+            ],
+        )
+        page.histogram(
+            "comfyui_http_response_size_bytes",
+            "Payload bytes of response bodies, without headers.",
+            [
+                ({"method": method, "route": route}, series.size)
+                for (method, route), series in self.requests.items()
+            ],
+        )
+
+        page.gauge(
+            "comfyui_websocket_clients",
+            "Connected websocket clients.",
+            len(server.sockets),
+        )
+        # not per client, every sid would be a series of its own
+        depths = server.broadcaster.queue_depths().values()
+        page.gauge(
+            "comfyui_websocket_send_queue_depth_max",
+            "Most messages waiting to be sent to one websocket client.",
+            max(depths, default=0),
+        )
+        page.gauge(
+            "comfyui_websocket_send_queue_depth_total",
+            "Messages waiting to be sent to all websocket clients.",
+            sum(depths),
+        )
+        page.metric(
+            "comfyui_websocket_messages_total",
+            "counter",
+            "Websocket messages queued for sending, by event.",
+            [({"event": event}, counts[0]) for event, counts in self.messages.items()],
+        )
+        page.metric(
+            "comfyui_websocket_message_bytes_total",
+            "counter",
+            "Bytes of websocket messages queued for sending, by event. Previews are event 1.",
+            [({"event": event}, counts[1]) for event, counts in self.messages.items()],
+        )
+        page.gauge(
+            "comfyui_message_backlog",
+            "Events sent with send_sync that the publish loop hasn't handled yet.",
+            server.messages.qsize(),
+        )
+        page.gauge(
+            "comfyui_event_loop_lag_seconds",
+            "How late the event loop last woke up from a sleep.",
+            self.last_loop_lag,
+        )
+        page.histogram(
+            "comfyui_event_loop_lag_distribution_seconds",
+            f"How late the event loop woke up, sampled every {LAG_INTERVAL}s.",
+            [(None, self.loop_lag)],
+        )
+
+        page.counter(
+            "comfyui_upload_bytes_total",
+            "Bytes of uploaded files received.",
+            upload_stream.bytes_received,
+        )
+        page.counter(
+            "comfyui_preview_cache_hits_total",
+            "/view previews served from the cache.",
+            server.preview_cache.hits,
+        )
+        page.counter(
+            "comfyui_preview_cache_misses_total",
+            "/view previews that had to be encoded.",
+            server.preview_cache.misses,
+        )
+        page.counter(
+            "comfyui_filename_list_cache_hits_total",
+            "Model file lists served without listing the folders again.",
+            folder_paths.filename_list_stats["hits"],
+        )
+        page.counter(
+            "comfyui_filename_list_cache_misses_total",
+            "Model file lists that needed folders listed.",
+            folder_paths.filename_list_stats["misses"],
+        )
+
+        page.gauge(
+            "comfyui_queue_remaining",
+            "Prompts pending or running.",
+            server.prompt_queue.get_tasks_remaining(),
+        )
+        page.gauge(
+            "comfyui_history_entries",
+            "Finished prompts kept in the history.",
+            len(server.prompt_queue.history),
+        )
+
+        route_stats = server.executor.metrics()
+        for name, field, metric_type, help in (
+            ("queued", "queued", "gauge", "Blocking jobs waiting for a slot."),
+            ("running", "running", "gauge", "Blocking jobs running."),
+            ("jobs_total", "completed", "counter", "Blocking jobs finished."),
+            ("errors_total", "errors", "counter", "Blocking jobs that raised."),
+            ("seconds_total", "total_time", "counter", "Time spent in blocking jobs."),
+        ):
+            page.metric(
+                f"comfyui_route_executor_{name}",
+                metric_type,
+                help,
+                [
+                    ({"route": route}, stats[field])
+                    for route, stats in route_stats.items()
+                ],
+            )
+
+        handlers = server.on_prompt_handlers.handlers
+        page.histogram(
+            "comfyui_prompt_handler_duration_seconds",
+            "Time taken by on_prompt handlers.",
+            [({"handler": handler.name}, handler.latency) for handler in handlers],
+        )
+
+        if server.dispatcher is not None:
+            workers = server.dispatcher.metrics()
+            for name, field, metric_type, help in (
+                ("healthy", "healthy", "gauge", "Whether the backend takes prompts."),
+                ("running", "running", "gauge", "Prompts assigned to the backend."),
+                ("completed_total", "completed", "counter", "Prompts it finished."),
+                ("failed_total", "failed", "counter", "Prompts that failed on it."),
+                ("ping_seconds", "ping", "gauge", "Smoothed health check latency."),
+            ):
+                page.metric(
+                    f"comfyui_backend_{name}",
+                    metric_type,
+                    help,
+                    [({"backend": worker}, m[field]) for worker, m in workers.items()],
+                )
+
+        return page.text()
+
+    def response(self):
+        return web.Response(
+            body=self.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class PreviewCache:
+    """Bounded LRU cache for encoded image variants served by /view.
+
+    Entries are keyed by the source file (path, mtime and size) plus the
+    parameters of the variant, so a changed file never serves a stale
+    preview. An optional disk tier keeps evicted and new entries in
+    disk_dir, bounded by max_disk_bytes. Concurrent misses for the same key
+    share one encode.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}  # key -> task, used on the event loop only
+
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_size = 0
+        self.disk_entries = OrderedDict()
+        if disk_dir is not None:
+            self.load_disk_entries()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(file, stat, *variant):
+        return (file, stat.st_mtime_ns, stat.st_size) + variant
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def etag(self, key):
+        return f'"{self.digest(key)}"'
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def load_disk_entries(self):
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            files = []
+            with os.scandir(self.disk_dir) as it:
+                for e in it:
+                    if not e.is_file():
+                        continue
+                    if e.name.endswith(".bin"):
+                        stat = e.stat()
+                        files.append((stat.st_mtime, e.name[:-4], stat.st_size))
+                    elif e.name.endswith(".tmp"):
+                        # left behind by a crash during put_disk
+                        remove_file(e.path)
+        except OSError as e:
+            logging.warning(f"Preview disk cache disabled: {e}")
+            self.disk_dir = None
+            return
+
+        for _, digest, size in sorted(files):
+            self.disk_entries[digest] = size
+            self.disk_size += size
+
+    def disk_path(self, digest):
+        return os.path.join(self.disk_dir, digest + ".bin")
+
+    # the disk tier does blocking file I/O, call it from the io threads
+    def get_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        digest = self.digest(key)
+        with self.lock:
+            if digest not in self.disk_entries:
+                return None
+            self.disk_entries.move_to_end(digest)
+        try:
+            with open(self.disk_path(digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                size = self.disk_entries.pop(digest, None)
+                if size is not None:
+                    self.disk_size -= size
+            return None
+
+        self.put(key, data)
+        return data
+
+    def put_disk(self, key, data):
+        if self.disk_dir is None or len(data) > self.max_disk_bytes:
+            return
+        digest = self.digest(key)
+        # unlike atomic_write this isn't synced to disk, a cache doesn't need
+        # to survive a crash and an fsync per preview would be slow
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.disk_path(digest))
+            temp_path = None
+        except OSError as e:
+            logging.warning(f"Unable to write preview cache entry: {e}")
+            return
+        finally:
+            if temp_path is not None:
+                remove_file(temp_path)
+
+        evicted = []
+        with self.lock:
+            size = self.disk_entries.pop(digest, None)
+            if size is not None:
+                self.disk_size -= size
+            self.disk_entries[digest] = len(data)
+            self.disk_size += len(data)
+            while self.disk_size > self.max_disk_bytes:
+                old_digest, size = self.disk_entries.popitem(last=False)
+                self.disk_size -= size
+                evicted.append(old_digest)
+
+        for old_digest in evicted:
+            remove_file(self.disk_path(old_digest))
+
+    async def get_or_encode(self, key, encode, run_io):
+        """Returns the cached bytes for key, calling the async encode() on a miss.
+
+        run_io(function, *args) runs the disk tier off the event loop.
+        """
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load(key, encode, run_io))
+            self.loading[key] = task
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
+
+    async def load(self, key, encode, run_io):
+        try:
+            data = None
+            if self.disk_dir is not None:
+                data = await run_io(self.get_disk, key)
+            if data is not None:
+                self.hits += 1
+                return data
+
+            self.misses += 1
+            data = await encode()
+            self.put(key, data)
+            if self.disk_dir is not None:
+                await run_io(self.put_disk, key, data)
+            return data
+        finally:
+            del self.loading[key]
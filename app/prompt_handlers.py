@@ -0,0 +1,206 @@
+import asyncio
+import copy
+import hashlib
+import inspect
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from app.metrics import Histogram
+
+# results kept per pure handler
+PURE_CACHE_SIZE = 256
+
+
+def handler_name(function):
+    module = getattr(function, "__module__", None)
+    name = getattr(function, "__qualname__", None) or type(function).__qualname__
+    return f"{module}.{name}" if module else name
+
+
+def is_async(function):
+    while hasattr(function, "func"):
+        function = function.func  # functools.partial
+    if inspect.iscoroutinefunction(function):
+        return True
+    return inspect.iscoroutinefunction(getattr(function, "__call__", None))
+
+
+def prompt_hash(json_data):
+    text = json.dumps(json_data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode()).digest()
+
+
+class PromptHandler:
+    """An on_prompt handler and how it is run.
+
+    timeout: seconds after which the handler is abandoned and the prompt
+        goes on as it was before it. It is given a copy of the prompt, so
+        a sync handler still running in its thread can't change it.
+    budget: seconds the handler is expected to take, going over it is
+        counted and logged the first time.
+    pure: the result only depends on the prompt, so it is cached by the
+        prompt's hash and the handler isn't called again for the same one.
+    """
+
+    def __init__(self, function, timeout=None, budget=None, pure=False):
+        self.function = function
+        self.name = handler_name(function)
+        self.is_async = is_async(function)
+        self.timeout = timeout
+        self.budget = budget
+        self.pure = pure
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.latency = Histogram()
+        self.errors = 0
+        self.timeouts = 0
+        self.over_budget = 0
+        self.cache_hits = 0
+
+    async def __call__(self, json_data, run_io):
+        if not self.pure:
+            return (await self.call(json_data, run_io))[0]
+
+        key = prompt_hash(json_data)
+        cached = self.cache.get(key)
+        if cached is None and key in self.in_flight:
+            # the same prompt is being handled, share its result
+            cached = await asyncio.shield(self.in_flight[key])
+        if cached is not None:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return json.loads(cached)
+        if key in self.in_flight:
+            # it failed and another caller is already trying again
+            return (await self.call(json_data, run_io))[0]
+
+        waiting = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        text = None
+        try:
+            result, ok = await self.call(json_data, run_io)
+            if ok:
+                text = self.store(key, result)
+        finally:
+            del self.in_flight[key]
+            waiting.set_result(text)
+        return result
+
+    async def call(self, json_data, run_io):
+        """Returns the handler's result and whether it succeeded."""
+        data = json_data
+        if self.timeout is not None:
+            data = copy.deepcopy(json_data)
+        start = time.perf_counter()
+        try:
+            if self.is_async:
+                call = self.function(data)
+            else:
+                call = run_io("on_prompt", self.function, data)
+            result = await asyncio.wait_for(call, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.error(
+                f"on_prompt handler {self.name} timed out after {self.timeout}s, continuing without it"
+            )
+            return json_data, False
+        except Exception:
+            self.errors += 1
+            logging.exception(
+                f"An error occurred during the on_prompt handler {self.name}"
+            )
+            return json_data, False
+        finally:
+            elapsed = time.perf_counter() - start
+            self.latency.observe(elapsed)
+
+        if self.budget is not None and elapsed > self.budget:
+            self.over_budget += 1
+            if self.over_budget == 1:
+                logging.warning(
+                    f"on_prompt handler {self.name} took {elapsed:.3f}s, over its budget of {self.budget}s"
+                )
+        return result, True
+
+    def store(self, key, result):
+        try:
+            text = json.dumps(result)
+        except (TypeError, ValueError):
+            return None
+        self.cache[key] = text
+        if len(self.cache) > PURE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return text
+
+    def metrics(self):
+        return {
+            "latency": self.latency.as_dict(),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "over_budget": self.over_budget,
+            "cache_hits": self.cache_hits,
+        }
+
+
+class PromptHandlers:
+    """The on_prompt handlers, run in the order they were added.
+
+    Each handler is inspected once when it is added. Async handlers are
+    awaited on the loop and sync ones are run on the io threads, so a slow
+    handler holds up the prompt it is working on and not the server.
+
+    Custom nodes used to append to the list upstream keeps them in, so
+    append and iterating over the handler functions work as on a list.
+    """
+
+    def __init__(self, run_io, default_timeout=None):
+        self.run_io = run_io
+        self.default_timeout = default_timeout
+        self.handlers = []
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def __iter__(self):
+        return (handler.function for handler in self.handlers)
+
+    def append(self, function):
+        self.add(function)
+
+    def add(self, function, timeout=None, budget=None, pure=False):
+        if timeout is None:
+            timeout = self.default_timeout
+        handler = PromptHandler(function, timeout, budget, pure)
+        names = {h.name for h in self.handlers}
+        if handler.name in names:
+            # several lambdas or instances of one class
+            handler.name = f"{handler.name}#{len(self.handlers)}"
+        self.handlers.append(handler)
+
+    async def run(self, json_data):
+        for handler in self.handlers:
+            json_data = await handler(json_data, self.run_io)
+        return json_data
+
+    def run_inline(self, json_data):
+        """Calls the sync handlers on this thread, as upstream did, for
+        callers on the loop that can't await run. Async ones are skipped."""
+        for handler in self.handlers:
+            if handler.is_async:
+                logging.warning(
+                    f"on_prompt handler {handler.name} is async and was skipped, use trigger_on_prompt_async"
+                )
+                continue
+            try:
+                json_data = handler.function(json_data)
+            except Exception:
+                handler.errors += 1
+                logging.exception(
+                    f"An error occurred during the on_prompt handler {handler.name}"
+                )
+        return json_data
+
+    def metrics(self):
+        return {handler.name: handler.metrics() for handler in self.handlers}
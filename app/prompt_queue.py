@@ -0,0 +1,222 @@
+import heapq
+import threading
+from typing import NamedTuple
+
+import nodes
+from app.history_store import HistoryStore
+
+# Follows the PromptQueue of ComfyUI's execution.py, queue items are
+# (number, prompt_id, prompt, extra_data, outputs_to_execute).
+
+
+class ExecutionStatus(NamedTuple):
+    status_str: str
+    completed: bool
+    messages: list
+
+
+def is_output_node(class_type):
+    node_class = nodes.NODE_CLASS_MAPPINGS[class_type]
+    if isinstance(node_class, dict):
+        return bool(node_class.get("output_node", False))
+    return bool(getattr(node_class, "OUTPUT_NODE", False))
+
+
+def prompt_error(error_type, message, details=""):
+    return {
+        "type": error_type,
+        "message": message,
+        "details": details,
+        "extra_info": {},
+    }
+
+
+def validate_prompt(prompt):
+    """Checks that every node exists and returns
+    (valid, error, outputs_to_execute, node_errors)."""
+    if not isinstance(prompt, dict):
+        return (
+            False,
+            prompt_error("invalid_prompt", "Prompt must be an object"),
+            [],
+            {},
+        )
+
+    outputs = []
+    for node_id, node in prompt.items():
+        class_type = node.get("class_type") if isinstance(node, dict) else None
+        if class_type is None:
+            error = prompt_error(
+                "invalid_prompt",
+                "Cannot execute because a node is missing the class_type property.",
+                f"Node ID '#{node_id}'",
+            )
+            return (False, error, [], {})
+        if class_type not in nodes.NODE_CLASS_MAPPINGS:
+            error = prompt_error(
+                "invalid_prompt",
+                f"Cannot execute because node {class_type} does not exist.",
+                f"Node ID '#{node_id}'",
+            )
+            return (False, error, [], {})
+        if is_output_node(class_type):
+            outputs.append(node_id)
+
+    if len(outputs) == 0:
+        return (
+            False,
+            prompt_error("prompt_no_outputs", "Prompt has no outputs"),
+            [],
+            {},
+        )
+    return (True, None, outputs, {})
+
+
+class PromptQueue:
+    """Priority queue of prompts waiting for the executor.
+
+    Pending items sit in a heap ordered by number, with prompt_id -> item in
+    `pending`. Deleting only drops the item from `pending`, the heap entry is
+    skipped when it comes up and the heap is rebuilt once most of it is
+    stale, so enqueue, dequeue and delete stay O(log n) or better.
+    """
+
+    def __init__(self, server, history=None):
+        self.server = server
+        self.mutex = threading.RLock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.task_counter = 0
+        self.queue = []
+        self.pending = {}
+        self.stale = 0
+        self.snapshot = None
+        self.currently_running = {}
+        self.history = history if history is not None else HistoryStore()
+        self.flags = {}
+
+    def changed(self):
+        self.snapshot = None
+        self.server.queue_updated()
+
+    def put(self, item):
+        with self.mutex:
+            old = self.pending.get(item[1])
+            if old is not None:
+                self.stale += 1
+            heapq.heappush(self.queue, item)
+            self.pending[item[1]] = item
+            self.changed()
+            self.not_empty.notify()
+
+    def pop(self):
+        while True:
+            item = heapq.heappop(self.queue)
+            if self.pending.get(item[1]) is item:
+                del self.pending[item[1]]
+                return item
+            self.stale -= 1
+
+    def get(self, timeout=None):
+        with self.not_empty:
+            while len(self.pending) == 0:
+                self.not_empty.wait(timeout=timeout)
+                if timeout is not None and len(self.pending) == 0:
+                    return None
+            item = self.pop()
+            i = self.task_counter
+            self.currently_running[i] = item
+            self.task_counter += 1
+            self.changed()
+            return (item, i)
+
+    def requeue(self, item_id):
+        """Puts a running item back in the queue, keeping its place."""
+        with self.mutex:
+            item = self.currently_running.pop(item_id)
+            self.put(item)
+
+    def task_done(self, item_id, outputs, status):
+        with self.mutex:
+            prompt = self.currently_running[item_id]
+
+        status_dict = None
+        if status is not None:
+            status_dict = status._asdict()
+
+        # encoded outside the mutex, the history is in place before the
+        # prompt stops showing as running
+        self.history.add(
+            prompt[1],
+            {"prompt": prompt, "outputs": outputs, "status": status_dict},
+        )
+        with self.mutex:
+            del self.currently_running[item_id]
+            self.changed()
+
+    def get_current_queue(self):
+        """Returns the running items and the pending ones in execution order."""
+        with self.mutex:
+            snapshot = self.snapshot
+            if snapshot is None:
+                snapshot = self.snapshot = sorted(self.pending.values())
+            return list(self.currently_running.values()), list(snapshot)
+
+    def get_tasks_remaining(self):
+        with self.mutex:
+            return len(self.pending) + len(self.currently_running)
+
+    def wipe_queue(self):
+        with self.mutex:
+            self.queue = []
+            self.pending = {}
+            self.stale = 0
+            self.changed()
+
+    def delete_queue_items(self, prompt_ids):
+        with self.mutex:
+            deleted = 0
+            for prompt_id in prompt_ids:
+                if self.pending.pop(prompt_id, None) is not None:
+                    deleted += 1
+            if deleted == 0:
+                return False
+
+            self.stale += deleted
+            if self.stale > len(self.pending):
+                self.queue = list(self.pending.values())
+                heapq.heapify(self.queue)
+                self.stale = 0
+            self.changed()
+            return True
+
+    def delete_queue_item(self, function):
+        with self.mutex:
+            for item in list(self.pending.values()):
+                if function(item):
+                    return self.delete_queue_items([item[1]])
+            return False
+
+    def get_history(self, prompt_id=None, max_items=None, offset=-1):
+        if prompt_id is None:
+            return self.history.decode(self.history.items(max_items, offset))
+        return self.history.decode(self.history.get(prompt_id))
+
+    def wipe_history(self):
+        self.history.wipe()
+
+    def delete_history_item(self, id_to_delete):
+        self.history.delete(id_to_delete)
+
+    def set_flag(self, name, data):
+        with self.mutex:
+            self.flags[name] = data
+            self.not_empty.notify()
+
+    def get_flags(self, reset=True):
+        with self.mutex:
+            if reset:
+                ret = self.flags
+                self.flags = {}
+                return ret
+            else:
+                return self.flags.copy()
@@ -0,0 +1,188 @@
+import asyncio
+import gzip
+import hashlib
+import json
+
+from aiohttp import web
+
+# optional, clients that accept br get it when it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are not worth the compression overhead.
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, *params = part.split(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            encodings.add(coding)
+    return encodings
+
+
+def etag_matches(request, etags):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in etags:
+            return True
+    return False
+
+
+class PrecompressedBody:
+    """A response body that is encoded once and served many times.
+
+    Keeps the identity body together with gzip (and brotli, if installed)
+    variants and a content hash based ETag, so serving it only costs picking
+    the variant the client accepts.
+    """
+
+    def __init__(self, body, content_type, charset=None):
+        self.body = body
+        self.content_type = content_type
+        self.charset = charset
+        self.size = len(body)
+        self.hash = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{self.hash}"'
+
+        self.encoded = {}
+        if self.size >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                encoded = brotli.compress(body, quality=BROTLI_QUALITY)
+                if len(encoded) < self.size:
+                    self.encoded["br"] = encoded
+            encoded = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+            if len(encoded) < self.size:
+                self.encoded["gzip"] = encoded
+
+        # each encoding is a separate representation so it gets its own ETag
+        self.etags = {self.etag: None}
+        for encoding in self.encoded:
+            self.etags[f'"{self.hash}-{encoding}"'] = encoding
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(json.dumps(data).encode("utf-8"), "application/json")
+
+    def select(self, request):
+        if self.encoded:
+            accepted = accepted_encodings(request)
+            for encoding, body in self.encoded.items():
+                if encoding in accepted:
+                    return encoding, body
+        return None, self.body
+
+    def response(self, request, headers=None, cache_control="no-cache"):
+        encoding, body = self.select(request)
+        etag = self.etag if encoding is None else f'"{self.hash}-{encoding}"'
+
+        response_headers = {"ETag": etag}
+        if cache_control is not None:
+            response_headers["Cache-Control"] = cache_control
+        if self.encoded:
+            response_headers["Vary"] = "Accept-Encoding"
+        if headers is not None:
+            response_headers.update(headers)
+
+        if etag_matches(request, self.etags):
+            return web.Response(status=304, headers=response_headers)
+
+        if encoding is not None:
+            response_headers["Content-Encoding"] = encoding
+        return web.Response(
+            body=body,
+            content_type=self.content_type,
+            charset=self.charset,
+            headers=response_headers,
+        )
+
+
+class JSONResponseCache:
+    """Serializes JSON values once per data version and reuses the result.
+
+    ``get_data`` is called with the key passed to ``get`` and ``version`` is a
+    callable returning any value that changes when the source data changes.
+
+    Serializing and compressing a large value takes long enough to stall
+    the event loop, so with ``run_io(function, *args)`` given, ``response``
+    builds missing entries with it and concurrent requests for the same
+    entry wait for the one build. ``get`` builds in the calling thread, to
+    warm the cache at startup.
+    """
+
+    def __init__(self, get_data, version, run_io=None):
+        self.get_data = get_data
+        self.version = version
+        self.run_io = run_io
+        self.current_version = None
+        self.entries = {}
+        self.building = {}  # (version, key) -> task
+
+    def invalidate(self):
+        self.current_version = None
+        self.entries = {}
+
+    def check_version(self):
+        version = self.version()
+        if version != self.current_version:
+            self.entries = {}
+            self.current_version = version
+        return version
+
+    def build(self, key):
+        return PrecompressedBody.from_json(self.get_data(*key))
+
+    def get(self, *key):
+        self.check_version()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.build(key)
+            self.entries[key] = entry
+        return entry
+
+    async def get_async(self, *key):
+        version = self.check_version()
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+        if self.run_io is None:
+            return self.get(*key)
+
+        task = self.building.get((version, key))
+        if task is None:
+            task = asyncio.ensure_future(self.build_async(version, key))
+            self.building[(version, key)] = task
+        return await asyncio.shield(task)
+
+    async def build_async(self, version, key):
+        try:
+            entry = await self.run_io(self.build, key)
+        finally:
+            del self.building[(version, key)]
+        if version == self.current_version:
+            self.entries[key] = entry
+        return entry
+
+    async def response(self, request, *key):
+        return (await self.get_async(*key)).response(request)
@@ -0,0 +1,121 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from comfy.cli_args import args
+
+
+class RouteStats:
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def as_dict(self):
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "errors": self.errors,
+            "total_time": self.total_time,
+        }
+
+
+class RouteExecutor:
+    """Runs the blocking parts of route handlers away from the event loop.
+
+    File I/O goes to a thread pool. Image decode/encode goes to a process
+    pool when one is configured (--image-processes) and to the thread pool
+    otherwise. Each route name can have at most max_concurrency jobs running
+    at once; the rest wait in line and are counted as queued.
+    """
+
+    def __init__(self, io_threads=None, image_processes=0, max_concurrency=16):
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=io_threads, thread_name_prefix="route io"
+        )
+        self.image_executor = None
+        if image_processes > 0:
+            self.image_executor = ProcessPoolExecutor(
+                max_workers=image_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        self.max_concurrency = max_concurrency
+        self.limits = {}
+        self.stats = {}
+
+    def get_stats(self, route):
+        stats = self.stats.get(route)
+        if stats is None:
+            stats = self.stats[route] = RouteStats()
+        return stats
+
+    def get_limit(self, route):
+        limit = self.limits.get(route)
+        if limit is None:
+            limit = self.limits[route] = asyncio.Semaphore(self.max_concurrency)
+        return limit
+
+    async def run(self, route, executor, function, *args, **kwargs):
+        stats = self.get_stats(route)
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        started = False
+        try:
+            async with self.get_limit(route):
+                stats.queued -= 1
+                started = True
+                stats.running += 1
+                start = time.perf_counter()
+                try:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(
+                        executor, functools.partial(function, *args, **kwargs)
+                    )
+                except Exception:
+                    stats.errors += 1
+                    raise
+                finally:
+                    stats.running -= 1
+                    stats.completed += 1
+                    stats.total_time += time.perf_counter() - start
+        finally:
+            if not started:
+                stats.queued -= 1
+
+    async def run_io(self, route, function, *args, **kwargs):
+        return await self.run(route, self.io_executor, function, *args, **kwargs)
+
+    async def run_image(self, route, function, *args, **kwargs):
+        """function and its arguments must be picklable when a process pool is used."""
+        executor = self.image_executor or self.io_executor
+        return await self.run(route, executor, function, *args, **kwargs)
+
+    def call_image(self, function, *args, **kwargs):
+        """Runs image work from code that is already on an io thread."""
+        if self.image_executor is None:
+            return function(*args, **kwargs)
+        return self.image_executor.submit(function, *args, **kwargs).result()
+
+    def metrics(self):
+        return {route: stats.as_dict() for route, stats in self.stats.items()}
+
+
+route_executor = None
+
+
+def get_route_executor():
+    global route_executor
+    if route_executor is None:
+        route_executor = RouteExecutor(
+            io_threads=args.io_threads,
+            image_processes=args.image_processes,
+            max_concurrency=args.max_route_concurrency,
+        )
+    return route_executor
@@ -0,0 +1,53 @@
+import time
+
+# A local stand-in for ComfyUI's PromptExecutor. It sends the same websocket
+# events for a prompt without running any node, so the queue, history and
+# websocket paths can be exercised and load tested without a GPU backend.
+# Anything with the same execute() method and outputs_ui, success and
+# status_messages attributes can be run by a dispatcher LocalWorker.
+
+
+class StandInExecutor:
+    def __init__(self, server, node_time=0.0):
+        self.server = server
+        self.node_time = node_time
+        self.reset()
+
+    def reset(self):
+        self.outputs_ui = {}
+        self.status_messages = []
+        self.success = True
+
+    def add_message(self, event, data, broadcast: bool):
+        data = {**data, "timestamp": int(time.time() * 1000)}
+        self.status_messages.append((event, data))
+        if self.server.client_id is not None or broadcast:
+            self.server.send_sync(event, data, self.server.client_id)
+
+    def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
+        self.reset()
+        self.server.client_id = extra_data.get("client_id")
+
+        self.add_message("execution_start", {"prompt_id": prompt_id}, broadcast=False)
+        self.add_message(
+            "execution_cached", {"nodes": [], "prompt_id": prompt_id}, broadcast=False
+        )
+        for node_id in prompt:
+            self.server.last_node_id = node_id
+            if self.server.client_id is not None:
+                self.server.send_sync(
+                    "executing",
+                    {"node": node_id, "prompt_id": prompt_id},
+                    self.server.client_id,
+                )
+            if self.node_time > 0:
+                time.sleep(self.node_time)
+            if node_id in execute_outputs:
+                self.outputs_ui[node_id] = {}
+                if self.server.client_id is not None:
+                    self.server.send_sync(
+                        "executed",
+                        {"node": node_id, "output": {}, "prompt_id": prompt_id},
+                        self.server.client_id,
+                    )
+        self.server.last_node_id = None
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import stat as stat_module
+import time
+
+from aiohttp import web
+
+from app.response_cache import PrecompressedBody
+
+# Files larger than this are streamed from disk instead of kept in memory.
+MAX_CACHED_FILE_SIZE = 4 * 1024 * 1024
+# How often (in seconds) a cached file is compared against the one on disk.
+CHECK_INTERVAL = 1.0
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+HTML_TAG = re.compile(rb"<(?:link|script)\b[^>]*>", re.IGNORECASE)
+HTML_URL_ATTRIBUTE = re.compile(rb'\b(href|src)="([^"?#]*)"', re.IGNORECASE)
+HTML_MODULE_TYPE = re.compile(rb'\btype\s*=\s*"module"', re.IGNORECASE)
+
+
+def guess_content_type(path):
+    content_type, _ = mimetypes.guess_type(path)
+    if content_type is None:
+        return "application/octet-stream", None
+
+    # mimetypes.types_map entries can carry a charset, e.g. the one for .js
+    content_type, _, params = content_type.partition(";")
+    charset = None
+    for param in params.split(";"):
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset":
+            charset = value
+    return content_type.strip(), charset
+
+
+def rewrite_html_urls(html, base, version):
+    """Calls version(url_path) for the stylesheet and classic script urls in
+    html, resolved against the url path base, and adds ?v=<its result> to
+    the ones it returns a version for.
+
+    Module scripts are left alone, the browser would load a module that is
+    also imported under its plain url twice.
+    """
+
+    def rewrite_attribute(match):
+        url = match.group(2)
+        if not url or b":" in url or url.startswith(b"//"):
+            return match.group(0)
+        url_path = posixpath.normpath(posixpath.join(base, url.decode()))
+        v = version(url_path)
+        if v is None:
+            return match.group(0)
+        return match.group(1) + b'="' + url + b"?v=" + v.encode() + b'"'
+
+    def rewrite_tag(match):
+        tag = match.group(0)
+        if HTML_MODULE_TYPE.search(tag):
+            return tag
+        return HTML_URL_ATTRIBUTE.sub(rewrite_attribute, tag)
+
+    return HTML_TAG.sub(rewrite_tag, html)
+
+
+class StaticAsset:
+    def __init__(self, path, stat, body, url_path=None):
+        self.path = path
+        self.url_path = url_path
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.body = body
+        self.checked = time.monotonic()
+        # pages link their stylesheets and scripts by versioned url
+        self.urls = []
+        self.versioned = None  # (versions of urls, body)
+        if url_path is not None and body.content_type == "text/html":
+            base = posixpath.dirname(url_path)
+            rewrite_html_urls(body.body, base, self.urls.append)
+
+    @property
+    def hash(self):
+        return self.body.hash
+
+    def matches(self, stat):
+        return self.mtime == stat.st_mtime_ns and self.size == stat.st_size
+
+
+class StaticManifest:
+    """In-memory index of the static files served by the web server.
+
+    Every file under a registered directory is read once at startup and
+    kept with its content hash, size, mtime and precompressed bodies.
+    Requests are answered from memory; the file on disk is only looked at
+    again when it has changed since it was loaded. A ``?v=<hash>`` query
+    matching the current content marks the URL as immutable. HTML pages
+    are served with such URLs for their stylesheets and classic scripts.
+    Range requests are served from disk by web.FileResponse.
+    """
+
+    def __init__(self):
+        self.assets = {}
+
+    def load_asset(self, url_path, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        if stat.st_size > MAX_CACHED_FILE_SIZE:
+            self.assets.pop(url_path, None)
+            return None
+
+        with open(path, "rb") as f:
+            data = f.read()
+        content_type, charset = guess_content_type(path)
+        body = PrecompressedBody(data, content_type, charset)
+        asset = StaticAsset(path, stat, body, url_path)
+        self.assets[url_path] = asset
+        return asset
+
+    def refresh(self, url_path):
+        """Reloads the asset if it changed on disk, returns it or None."""
+        asset = self.assets.get(url_path)
+        if asset is None or time.monotonic() - asset.checked < CHECK_INTERVAL:
+            return asset
+        try:
+            stat = os.stat(asset.path)
+        except OSError:
+            self.assets.pop(url_path, None)
+            return None
+        if asset.matches(stat):
+            asset.checked = time.monotonic()
+            return asset
+        return self.load_asset(url_path, asset.path, stat)
+
+    def add_directory(self, prefix, directory):
+        prefix = prefix.rstrip("/")
+        directory = os.path.realpath(directory)
+
+        count = 0
+        for dirpath, subdirs, filenames in os.walk(directory):
+            for file_name in filenames:
+                path = os.path.join(dirpath, file_name)
+                if os.path.commonpath((directory, os.path.realpath(path))) != directory:
+                    continue
+                url_path = (
+                    prefix + "/" + os.path.relpath(path, directory).replace("\\", "/")
+                )
+                try:
+                    if self.load_asset(url_path, path) is not None:
+                        count += 1
+                except OSError as e:
+                    logging.warning(f"Unable to load static file {path}: {e}")
+        logging.debug("static manifest: {} files from {}".format(count, directory))
+
+        async def handler(request):
+            filename = request.match_info["filename"]
+            return await self.serve(
+                request, prefix + "/" + filename, directory, filename
+            )
+
+        return [web.get(prefix + "/{filename:.*}", handler)]
+
+    def version(self, url_path):
+        asset = self.assets.get(url_path)
+        return None if asset is None else asset.hash
+
+    async def serve(self, request, url_path, directory, filename):
+        asset = self.assets.get(url_path)
+        if asset is not None and time.monotonic() - asset.checked < CHECK_INTERVAL:
+            return await self.response(request, asset)
+
+        # prevent leaving the directory, the same way web.static does
+        path = os.path.realpath(os.path.join(directory, filename))
+        if os.path.commonpath((directory, path)) != directory:
+            raise web.HTTPForbidden()
+
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            self.assets.pop(url_path, None)
+            raise web.HTTPNotFound()
+        if not stat_module.S_ISREG(stat.st_mode):
+            raise web.HTTPNotFound()
+
+        if asset is not None and asset.matches(stat):
+            asset.checked = time.monotonic()
+            return await self.response(request, asset)
+
+        # new or changed on disk, reload it off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            asset = await loop.run_in_executor(
+                None, self.load_asset, url_path, path, stat
+            )
+        except OSError:
+            raise web.HTTPNotFound()
+        if asset is None:
+            return web.FileResponse(path)
+        return await self.response(request, asset)
+
+    async def response(self, request, asset):
+        if "Range" in request.headers:
+            return web.FileResponse(asset.path)
+        if asset.urls:
+            return await self.page_response(request, asset)
+        if request.rel_url.query.get("v") == asset.hash:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            cache_control = "no-cache"
+        return asset.body.response(request, cache_control=cache_control)
+
+    async def page_response(self, request, asset):
+        # a page must not link an old version the browser then never asks for
+        now = time.monotonic()
+        if any(
+            url in self.assets and now - self.assets[url].checked >= CHECK_INTERVAL
+            for url in asset.urls
+        ):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, lambda: [self.refresh(url) for url in asset.urls]
+            )
+
+        versions = tuple(self.version(url) for url in asset.urls)
+        if asset.versioned is None or asset.versioned[0] != versions:
+            html = rewrite_html_urls(
+                asset.body.body,
+                posixpath.dirname(asset.url_path),
+                self.version,
+            )
+            body = PrecompressedBody(html, asset.body.content_type, asset.body.charset)
+            asset.versioned = (versions, body)
+        return asset.versioned[1].response(request)
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import uuid
+
+from app.atomic_write import atomic_write
+
+
+class UploadIndex:
+    """Content hash -> uploaded files, for --dedup-uploads.
+
+    The index is kept in memory and persisted as an append-only log of json
+    lines, so recording an upload is a single small write. Entries are
+    checked against the file's size and mtime before they are used, files
+    changed or removed behind the index's back are dropped. All methods do
+    blocking file I/O, call them from the io threads.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.entries = {}  # sha256 -> {path: (size, mtime_ns)}
+        self.log_lines = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.loaded = True
+        torn = False
+        try:
+            with open(self.index_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # cut off by a crash, the next append would end up
+                        # on the same line so the index is rewritten below
+                        torn = True
+                        continue
+                    self.log_lines += 1
+                    paths = self.entries.setdefault(entry["hash"], {})
+                    if "size" in entry:
+                        paths[entry["path"]] = (entry["size"], entry["mtime"])
+                    else:
+                        paths.pop(entry["path"], None)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning(f"Unable to load upload index {self.index_file}: {e}")
+            return
+
+        live = sum(len(paths) for paths in self.entries.values())
+        if torn or self.log_lines > 2 * live + 100:
+            self.compact()
+
+    def compact(self):
+        lines = []
+        for sha256, paths in self.entries.items():
+            for path, (size, mtime) in paths.items():
+                lines.append(self.format(sha256, path, size, mtime))
+        try:
+            atomic_write(self.index_file, "".join(lines))
+            self.log_lines = len(lines)
+        except OSError as e:
+            logging.warning(f"Unable to compact upload index {self.index_file}: {e}")
+
+    @staticmethod
+    def format(sha256, path, size=None, mtime=None):
+        entry = {"hash": sha256, "path": path}
+        if size is not None:
+            entry["size"] = size
+            entry["mtime"] = mtime
+        return json.dumps(entry) + "\n"
+
+    def append(self, line):
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            with open(self.index_file, "a") as f:
+                f.write(line)
+            self.log_lines += 1
+        except OSError as e:
+            logging.warning(f"Unable to update upload index {self.index_file}: {e}")
+
+    def find(self, sha256, directory):
+        """Returns the path of an unchanged file in directory with this hash."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            paths = self.entries.get(sha256)
+            if not paths:
+                return None
+            for path, (size, mtime) in list(paths.items()):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    stat = None
+                if stat is None or stat.st_size != size or stat.st_mtime_ns != mtime:
+                    del paths[path]
+                    self.append(self.format(sha256, path))
+                    continue
+                if os.path.commonpath((directory, path)) == directory:
+                    return path
+        return None
+
+    def add(self, sha256, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            entry = (stat.st_size, stat.st_mtime_ns)
+            paths = self.entries.setdefault(sha256, {})
+            if paths.get(path) != entry:
+                paths[path] = entry
+                self.append(self.format(sha256, path, *entry))
+
+
+def link_file(source, path):
+    """Replaces path with a hardlink to source, returns False when the
+    filesystem can't link them."""
+    temp_path = os.path.join(os.path.dirname(path), f".upload-{uuid.uuid4().hex}.tmp")
+    try:
+        os.link(source, temp_path)
+        os.replace(temp_path, path)
+        return True
+    except OSError:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        return False
@@ -0,0 +1,153 @@
+import asyncio
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+from aiohttp import BodyPartReader, web
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# bytes of uploaded files received, for the metrics
+bytes_received = 0
+
+
+class UploadFile:
+    """An uploaded file that is written to a temp file while it arrives.
+
+    The temp file is created in the target directory (or close to it) so
+    that commit() can move it into place with a rename. The sha256 of the
+    content is computed while it is written. write, commit and discard do
+    blocking file I/O and are called from the io threads.
+    """
+
+    def __init__(self, filename, directory):
+        self.filename = filename
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=directory, prefix=".upload-", suffix=".tmp"
+        )
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    @property
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def commit(self, path):
+        self.close()
+        try:
+            os.replace(self.temp_path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # staged on another filesystem
+            shutil.move(self.temp_path, path)
+        self.temp_path = None
+
+    def discard(self):
+        self.close()
+        if self.temp_path is not None:
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+
+async def stream_to_file(request, read, upload, run_io, max_size):
+    """Writes the chunks returned by read(size) to upload until it returns
+    nothing. The next chunk is received while the previous one is written, so
+    at most two chunks are held in memory."""
+    global bytes_received
+    pending = None
+    try:
+        while True:
+            chunk = await read(UPLOAD_CHUNK_SIZE)
+            if pending is not None:
+                await pending
+                pending = None
+            if not chunk:
+                break
+            if 0 < max_size < request.content.total_bytes:
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=max_size, actual_size=request.content.total_bytes
+                )
+            upload.size += len(chunk)
+            bytes_received += len(chunk)
+            pending = asyncio.ensure_future(run_io(upload.write, chunk))
+    finally:
+        if pending is not None:
+            # don't let the file be closed under a running write
+            await asyncio.wait([pending])
+    await run_io(upload.close)
+
+
+async def read_body(request, filename, directory, run_io, max_size):
+    """Streams the raw request body into an UploadFile in directory."""
+    upload = await run_io(UploadFile, filename, directory)
+    try:
+        await stream_to_file(request, request.content.read, upload, run_io, max_size)
+    except BaseException:
+        await run_io(upload.discard)
+        raise
+    return upload
+
+
+async def read_multipart(request, file_field, get_directory, run_io, max_size):
+    """Reads a multipart form, streaming the file in file_field to disk.
+
+    Returns the other fields as a dict of strings and the UploadFile or None.
+    get_directory(fields) picks the directory to stage the file in from the
+    fields that came before it.
+    """
+    if request.content_type != "multipart/form-data":
+        # a urlencoded form can't carry a file
+        post = await request.post()
+        return {k: v for k, v in post.items() if isinstance(v, str)}, None
+
+    fields = {}
+    upload = None
+    reader = await request.multipart()
+    try:
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if not isinstance(part, BodyPartReader):
+                continue
+
+            if part.name == file_field and part.filename is not None:
+                if upload is not None:
+                    continue
+                upload = await run_io(UploadFile, part.filename, get_directory(fields))
+
+                async def read(size):
+                    return part.decode(await part.read_chunk(size))
+
+                await stream_to_file(request, read, upload, run_io, max_size)
+            else:
+                value = bytearray()
+                while chunk := await part.read_chunk(UPLOAD_CHUNK_SIZE):
+                    if 0 < max_size < request.content.total_bytes:
+                        raise web.HTTPRequestEntityTooLarge(
+                            max_size=max_size,
+                            actual_size=request.content.total_bytes,
+                        )
+                    value.extend(chunk)
+                value = part.decode(bytes(value))
+                fields[part.name] = value.decode(part.get_charset(default="utf-8"))
+    except BaseException:
+        if upload is not None:
+            await run_io(upload.discard)
+        raise
+    return fields, upload
@@ -1,11 +1,19 @@
+import atexit
+import functools
 import json
 import os
 import re
+import stat
+import threading
 import uuid
 from aiohttp import web
 from comfy.cli_args import args
 from folder_paths import user_directory
 from .app_settings import AppSettings
+from .atomic_write import atomic_write
+from .file_lookup import StatFileResponse, get_stat_cache
+from .route_executor import get_route_executor
+from .upload_stream import read_body
 
 default_user = "default"
 users_file = os.path.join(user_directory, "users.json")
@@ -16,6 +24,16 @@ class UserManager():
         global user_directory
 
         self.settings = AppSettings(self)
+        self.executor = get_route_executor()
+        self.stat_cache = get_stat_cache()
+        # users are registered in memory on the event loop and written out by
+        # save_users, name -> id is indexed for the duplicate check
+        self.user_names = {}
+        self.users_version = 0
+        self.users_written_version = 0
+        self.users_lock = threading.Lock()
+        # user id -> resolved directory, only added once the directory exists
+        self.user_roots = {}
         if not os.path.exists(user_directory):
             os.mkdir(user_directory)
             if not args.multi_user:
@@ -31,6 +49,12 @@ class UserManager():
         else:
             self.users = {"default": "default"}
 
+        for user_id, name in self.users.items():
+            self.user_names.setdefault(name, user_id)
+
+        # a registration whose write failed is written on the way out
+        atexit.register(self.save_users)
+
     def get_request_user_id(self, request):
         user = "default"
         if args.multi_user and "comfy-user" in request.headers:
@@ -41,22 +65,35 @@ class UserManager():
 
         return user
 
-    def get_request_user_filepath(self, request, file, type="userdata", create_dir=True):
+    def get_user_root(self, user, create_dir=True):
         global user_directory
 
-        if type == "userdata":
-            root_dir = user_directory
-        else:
-            raise KeyError("Unknown filepath type:" + type)
+        user_root = self.user_roots.get(user)
+        if user_root is not None:
+            return user_root
 
-        user = self.get_request_user_id(request)
-        path = user_root = os.path.abspath(os.path.join(root_dir, user))
+        root_dir = user_directory
+        user_root = os.path.abspath(os.path.join(root_dir, user))
 
         # prevent leaving /{type}
         if os.path.commonpath((root_dir, user_root)) != root_dir:
             return None
 
-        parent = user_root
+        if create_dir and not os.path.exists(user_root):
+            os.mkdir(user_root)
+
+        if create_dir or os.path.isdir(user_root):
+            self.user_roots[user] = user_root
+        return user_root
+
+    def get_request_user_filepath(self, request, file, type="userdata", create_dir=True):
+        if type != "userdata":
+            raise KeyError("Unknown filepath type:" + type)
+
+        user = self.get_request_user_id(request)
+        path = user_root = self.get_user_root(user, create_dir)
+        if user_root is None:
+            return None
 
         if file is not None:
             # prevent leaving /{type}/{user}
@@ -64,9 +101,6 @@ class UserManager():
             if os.path.commonpath((user_root, path)) != user_root:
                 return None
 
-        if create_dir and not os.path.exists(parent):
-            os.mkdir(parent)
-
         return path
 
     def add_user(self, name):
@@ -77,12 +111,25 @@ class UserManager():
         user_id = user_id + "_" + str(uuid.uuid4())
 
         self.users[user_id] = name
+        self.user_names.setdefault(name, user_id)
+        self.users_version += 1
+        # a directory memoized for this id before it existed is looked up again
+        self.user_roots.pop(user_id, None)
 
+        return user_id
+
+    def save_users(self):
         global users_file
-        with open(users_file, "w") as f:
-            json.dump(self.users, f)
 
-        return user_id
+        with self.users_lock:
+            # registrations that came in while waiting are written together
+            version = self.users_version
+            if version <= self.users_written_version:
+                return
+            data = json.dumps(dict(self.users))
+
+            atomic_write(users_file, data)
+            self.users_written_version = version
 
     def add_routes(self, routes):
         self.settings.add_routes(routes)
@@ -102,10 +149,11 @@ class UserManager():
         async def post_users(request):
             body = await request.json()
             username = body["username"]
-            if username in self.users.values():
+            if username.strip() in self.user_names:
                 return web.json_response({"error": "Duplicate username."}, status=400)
 
             user_id = self.add_user(username)
+            await self.executor.run_io("users", self.save_users)
             return web.json_response(user_id)
 
         @routes.get("/userdata/{file}")
@@ -118,10 +166,13 @@ class UserManager():
             if not path:
                 return web.Response(status=403)
             
-            if not os.path.exists(path):
+            st = self.stat_cache.stat(path)
+            if st is None:
                 return web.Response(status=404)
+            if not stat.S_ISREG(st.st_mode):
+                return web.Response(status=403)
             
-            return web.FileResponse(path)
+            return StatFileResponse(path, st)
 
         @routes.post("/userdata/{file}")
         async def post_userdata(request):
@@ -133,8 +184,17 @@ class UserManager():
             if not path:
                 return web.Response(status=403)
 
-            body = await request.read()
-            with open(path, "wb") as f:
-                f.write(body)
+            upload = await read_body(
+                request,
+                file,
+                os.path.dirname(path),
+                functools.partial(self.executor.run_io, "userdata"),
+                request.client_max_size,
+            )
+            try:
+                await self.executor.run_io("userdata", upload.commit, path)
+            finally:
+                await self.executor.run_io("userdata", upload.discard)
+                self.stat_cache.invalidate(path)
                 
             return web.Response(status=200)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from collections import deque
+
+import aiohttp
+from aiohttp import WSCloseCode
+
+
+class QueuedMessage:
+    __slots__ = ("binary", "data", "key")
+
+    def __init__(self, binary, data, key):
+        self.binary = binary
+        self.data = data
+        self.key = key
+
+
+class ClientQueue:
+    """Bounded send queue for one websocket with its own writer task.
+
+    Messages pushed with a coalesce key replace a queued message with the
+    same key instead of being added, so a slow client only ever gets the
+    latest status or preview. When the queue is full anyway the client is
+    disconnected, it can reconnect and will get a fresh status. After a
+    failed send nothing more is sent, the server removes the client once
+    its connection is closed.
+    """
+
+    def __init__(self, sid, ws, max_size):
+        self.sid = sid
+        self.ws = ws
+        self.max_size = max_size
+        self.queue = deque()
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.coalesced = 0
+        self.closing = False
+        self.task = asyncio.create_task(self.run())
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, binary, data, key=None):
+        if self.closing:
+            return
+
+        if key is not None:
+            queued = self.pending.pop(key, None)
+            if queued is not None:
+                # the newer message goes to the back to keep the event order
+                self.queue.remove(queued)
+                self.coalesced += 1
+
+        if len(self.queue) >= self.max_size:
+            logging.warning(f"websocket client {self.sid} is too slow, disconnecting")
+            self.close()
+            return
+
+        message = QueuedMessage(binary, data, key)
+        if key is not None:
+            self.pending[key] = message
+        self.queue.append(message)
+        self.ready.set()
+
+    def close(self):
+        self.closing = True
+        self.queue.clear()
+        self.pending.clear()
+        asyncio.create_task(
+            self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow")
+        )
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            while len(self.queue) > 0:
+                message = self.queue.popleft()
+                if message.key is not None and self.pending.get(message.key) is message:
+                    del self.pending[message.key]
+                try:
+                    if message.binary:
+                        await self.ws.send_bytes(message.data)
+                    else:
+                        await self.ws.send_str(message.data)
+                    self.sent += 1
+                except (
+                    aiohttp.ClientError,
+                    aiohttp.ClientPayloadError,
+                    ConnectionResetError,
+                ) as err:
+                    # the connection is gone, the rest would fail the same way
+                    logging.debug(f"websocket client {self.sid} send error: {err}")
+                    self.closing = True
+                    self.queue.clear()
+                    self.pending.clear()
+                    return
+            self.ready.clear()
+
+    def stop(self):
+        self.task.cancel()
+
+
+class Broadcaster:
+    """Fans messages out to every connected websocket.
+
+    A message is serialized once by the caller and the same object is
+    queued for each recipient, so delivery to one client never waits on
+    another.
+    """
+
+    def __init__(self, max_queue_size=64):
+        self.max_queue_size = max_queue_size
+        self.clients = {}
+
+    def add(self, sid, ws):
+        old = self.clients.pop(sid, None)
+        if old is not None:
+            old.stop()
+        self.clients[sid] = ClientQueue(sid, ws, self.max_queue_size)
+
+    def remove(self, sid, ws):
+        client = self.clients.get(sid)
+        if client is not None and client.ws is ws:
+            del self.clients[sid]
+            client.stop()
+
+    def push(self, binary, data, sid=None, key=None):
+        if sid is None:
+            for client in list(self.clients.values()):
+                client.push(binary, data, key)
+        else:
+            client = self.clients.get(sid)
+            if client is not None:
+                client.push(binary, data, key)
+
+    def queue_depths(self):
+        return {sid: len(client) for sid, client in self.clients.items()}
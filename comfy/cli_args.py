@@ -116,6 +116,33 @@ parser.add_argument("--disable-metadata", action="store_true", help="Disable sav
 
 parser.add_argument("--multi-user", action="store_true", help="Enables per-user storage.")
 
+parser.add_argument("--io-threads", type=int, default=None, help="Number of threads used for blocking file work in http routes (default: picked by Python from the cpu count).")
+parser.add_argument("--image-processes", type=int, default=0, help="Number of worker processes used to decode and encode images in http routes. 0 runs that work on the io threads instead.")
+parser.add_argument("--max-route-concurrency", type=int, default=16, help="Maximum number of blocking jobs a single http route can run at the same time, further requests wait in line.")
+
+parser.add_argument("--preview-cache-size", type=float, default=64, help="Set the size in MB of the in-memory cache for /view previews.")
+parser.add_argument("--preview-disk-cache", action="store_true", help="Also keep encoded /view previews on disk, in the temp directory.")
+parser.add_argument("--preview-disk-cache-size", type=float, default=1024, help="Set the maximum size in MB of the on-disk preview cache.")
+
+parser.add_argument("--websocket-queue-size", type=int, default=256, help="Maximum number of messages queued for a single websocket client, clients that fall further behind are disconnected.")
+
+parser.add_argument("--preview-max-rate", type=float, default=0, help="Maximum number of sampler previews per second sent to a single websocket client, newer previews replace the ones waiting. 0 means no limit.")
+
+parser.add_argument("--mask-compress-level", type=int, default=4, choices=range(10), metavar="[0-9]", help="PNG compression level for images saved by /upload/mask, lower is faster and bigger.")
+parser.add_argument("--dedup-uploads", type=str, default=None, choices=["name", "hardlink"], help="Store identical image uploads to the input folder only once. \"name\" returns the name of the earlier identical upload instead of writing a copy, \"hardlink\" saves the upload under its own name as a hardlink to the earlier file.")
+
+parser.add_argument("--stand-in-executor", type=float, nargs="?", const=0.0, default=None, metavar="SECONDS_PER_NODE", help="Run queued prompts with a local stand-in executor that only sends the execution events, optionally taking this many seconds per node. For testing the queue without a backend.")
+parser.add_argument("--stand-in-workers", type=int, default=1, help="Number of stand-in executors run side by side with --stand-in-executor.")
+parser.add_argument("--backend", type=str, action="append", default=[], metavar="URL", help="URL of a ComfyUI backend to run queued prompts on, can be given multiple times. A server started with --stand-in-executor can stand in for one.")
+parser.add_argument("--dispatch", type=str, default="least-work", choices=["least-work", "affinity"], help="How queued prompts are spread over the backends: to the one expected to get to them first, or to the one that ran the same models last so they don't have to be loaded again.")
+parser.add_argument("--prompt-handler-timeout", type=float, default=0, help="Seconds an on_prompt handler of a custom node may take before the prompt is queued without it. 0 means no limit.")
+parser.add_argument("--enable-metrics", action="store_true", help="Serve request latencies, websocket queues, event loop lag, cache hit rates and transfer totals on /metrics in the Prometheus text format.")
+parser.add_argument("--max-history-items", type=int, default=10000, help="Maximum number of finished prompts kept in the history, the oldest are dropped first. 0 means no limit.")
+parser.add_argument("--max-history-size", type=float, default=512, help="Maximum size in MB of the history once json encoded, the oldest prompts are dropped first. 0 means no limit.")
+parser.add_argument("--persist-history", action="store_true", help="Keep the history across restarts in the user directory.")
+
+parser.add_argument("--watch-model-folders", action="store_true", help="Keep model file lists up to date with filesystem events (inotify on Linux) instead of checking every folder's modification time on each lookup.")
+
 parser.add_argument("--verbose", action="store_true", help="Enables more debug prints.")
 
 parser.add_argument("--dump-nodes-info", action="store_true", help="Dump nodes info.")
@@ -1,22 +1,60 @@
-from PIL import Image, ImageOps
-from io import BytesIO
-import numpy as np
-import struct
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
 import comfy.utils
 import time
 
+from server import BinaryEventTypes, PromptServer
+
+try:
+    from app.image_encoding import encode_image_frame
+except ImportError:
+    #a server without encode_image_frame, images go through the preview path
+    encode_image_frame = None
+
 #You can use this node to save full size images through the websocket, the
 #images will be sent in exactly the same format as the image previews: as
 #binary images on the websocket with a 8 byte header indicating the type
 #of binary message (first 4 bytes) and the image format (next 4 bytes).
+#The image format is 1 for JPEG, 2 for PNG and 3 for WEBP.
 
 #Note that no metadata will be put in the images saved with this node.
 
+#PIL releases the GIL while encoding so frames are encoded in parallel
+encode_threads = os.cpu_count() or 1
+encode_executor = ThreadPoolExecutor(max_workers=encode_threads, thread_name_prefix="websocket image encode")
+
+def images_to_uint8(images):
+    #scale, clip and convert the whole batch at once on its device, then copy
+    #it to the host in one go as a single uint8 buffer
+    return images.detach().mul(255.).clamp_(0, 255).byte().cpu().numpy()
+
+def encode_frame(pixels, image_format, save_args):
+    #the complete websocket message, sent as is without another copy
+    return encode_image_frame(image_format, Image.fromarray(pixels), BinaryEventTypes.PREVIEW_IMAGE, **save_args)
+
+def encode_frames(pixels, image_format, save_args):
+    #yields the encoded frames in order, keeping a bounded number in flight
+    #so a large batch does not sit in memory all at once
+    window = encode_threads * 2
+    pending = deque()
+    for frame in pixels:
+        pending.append(encode_executor.submit(encode_frame, frame, image_format, save_args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
 class SaveImageWebsocket:
     @classmethod
     def INPUT_TYPES(s):
         return {"required":
-                    {"images": ("IMAGE", ),}
+                    {"images": ("IMAGE", ),},
+                "optional":
+                    {"format": (["PNG", "JPEG", "WEBP"], ),
+                     "compress_level": ("INT", {"default": 1, "min": 0, "max": 9, "step": 1}),
+                     "quality": ("INT", {"default": 95, "min": 1, "max": 100, "step": 1}),}
                 }
 
     RETURN_TYPES = ()
@@ -26,18 +64,37 @@ class SaveImageWebsocket:
 
     CATEGORY = "api/image"
 
-    def save_images(self, images):
-        pbar = comfy.utils.ProgressBar(images.shape[0])
-        step = 0
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            pbar.update_absolute(step, images.shape[0], ("PNG", img, None))
-            step += 1
+    def save_images(self, images, format="PNG", compress_level=1, quality=95):
+        if format == "PNG":
+            save_args = {"compress_level": compress_level}
+        else:
+            save_args = {"quality": quality}
+
+        server = PromptServer.instance
+        total = images.shape[0]
+        pbar = comfy.utils.ProgressBar(total)
+        pixels = images_to_uint8(images)
+        send_frame_sync = getattr(server, "send_frame_sync", None)
+        if encode_image_frame is None or send_frame_sync is None:
+            self.send_previews(pixels, format, pbar)
+            return {}
+
+        for step, frame in enumerate(encode_frames(pixels, format, save_args)):
+            send_frame_sync(BinaryEventTypes.PREVIEW_IMAGE, frame, server.client_id)
+            pbar.update_absolute(step, total, None)
 
         return {}
 
-    def IS_CHANGED(s, images):
+    def send_previews(self, pixels, format, pbar):
+        #the progress bar preview path every server has, it only knows PNG and
+        #JPEG and encodes with its own settings
+        if format not in ("PNG", "JPEG"):
+            format = "PNG"
+        total = len(pixels)
+        for step, frame in enumerate(pixels):
+            pbar.update_absolute(step, total, (format, Image.fromarray(frame), None))
+
+    def IS_CHANGED(s, images, **kwargs):
         return time.time()
 
 NODE_CLASS_MAPPINGS = {
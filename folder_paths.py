@@ -1,6 +1,13 @@
+import bisect
+import json
 import logging
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.atomic_write import atomic_write
 
 supported_pt_extensions = set([".ckpt", ".pt", ".bin", ".pth", ".safetensors", ".pkl"])
 
@@ -88,6 +95,28 @@ input_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "inp
 user_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "user")
 
 filename_list_cache = {}
+filename_list_stats = {"hits": 0, "misses": 0}
+
+# folder_name -> {"extensions": [...], "dirs": {directory: [mtime, files, subdirs]}}
+# persisted so a restart only has to re-list directories that changed
+directory_cache = {}
+directory_cache_file = os.path.join(user_directory, "model_index.json")
+directory_cache_lock = threading.Lock()
+
+# model folders are scanned on this pool, see scan_folder_roots
+scan_threads = 8
+scan_executor = None
+
+# folder_name -> FolderIndex, only used when the filesystem watcher is enabled
+filename_index = {}
+filename_index_lock = threading.RLock()
+filename_watcher = None
+
+# folder -> SaveCounters / UploadCounters, see get_save_image_path and
+# reserve_upload_filename
+save_counters = {}
+upload_counters = {}
+counters_lock = threading.Lock()
 
 if not os.path.exists(input_directory):
     try:
@@ -190,6 +219,51 @@ def get_folder_paths(folder_name):
 
 
 def recursive_search(directory, excluded_dir_names=None):
+    files, dirs = cached_recursive_search(directory, [], {}, excluded_dir_names)
+    return files, {path: entry[0] for path, entry in dirs.items()}
+
+
+def file_has_extension(file, extensions):
+    return os.path.splitext(file)[-1].lower() in extensions or len(extensions) == 0
+
+
+def list_directory(path, extensions, cached_dirs, excluded_dir_names):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        logging.warning(f"Warning: Unable to access {path}. Skipping this path.")
+        return None
+
+    entry = cached_dirs.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry
+
+    logging.debug("listing directory {}".format(path))
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                # like os.walk(followlinks=True), symlinked directories are walked
+                if e.is_dir():
+                    if e.name not in excluded_dir_names:
+                        subdirs.append(e.name)
+                elif file_has_extension(e.name, extensions):
+                    files.append(e.name)
+    except OSError:
+        logging.warning(f"Warning: Unable to access {path}. Skipping this path.")
+        return None
+    return [mtime, files, subdirs]
+
+
+def cached_recursive_search(
+    directory, extensions, cached_dirs, excluded_dir_names=None
+):
+    """Walks directory, only listing the directories whose mtime changed.
+
+    Returns the files under directory that match extensions and the
+    [mtime, files, subdirs] listing of every directory that was visited.
+    """
     if not os.path.isdir(directory):
         return [], {}
 
@@ -198,41 +272,144 @@ def recursive_search(directory, excluded_dir_names=None):
 
     result = []
     dirs = {}
+    stack = [(directory, "")]
+    while len(stack) > 0:
+        path, relative_dir = stack.pop()
+        entry = list_directory(path, extensions, cached_dirs, excluded_dir_names)
+        if entry is None:
+            continue
+        dirs[path] = entry
+
+        if relative_dir == "":
+            result.extend(entry[1])
+        else:
+            result.extend(os.path.join(relative_dir, f) for f in entry[1])
+        for d in reversed(entry[2]):
+            stack.append((os.path.join(path, d), os.path.join(relative_dir, d)))
 
-    # Attempt to add the initial directory to dirs with error handling
+    return result, dirs
+
+
+def get_scan_executor():
+    global scan_executor
+    if scan_executor is None:
+        scan_executor = ThreadPoolExecutor(
+            max_workers=scan_threads, thread_name_prefix="folder_paths scan"
+        )
+    return scan_executor
+
+
+def scan_folder_roots(roots, extensions, cached_dirs, excluded_dir_names=None):
+    """cached_recursive_search over several roots on the scan thread pool.
+
+    The roots are listed in parallel first, then every top level
+    subdirectory is walked as its own task, so the time spent is bounded by
+    the slowest subtree instead of the sum of all of them. Results are
+    merged in root order. Returns a list of (root, files, dirs).
+    """
+    if excluded_dir_names is None:
+        excluded_dir_names = []
+
+    roots = [x for x in roots if os.path.isdir(x)]
+    if len(roots) == 0:
+        return []
+    executor = get_scan_executor()
+
+    root_entries = list(
+        executor.map(
+            lambda x: list_directory(x, extensions, cached_dirs, excluded_dir_names),
+            roots,
+        )
+    )
+
+    subtrees = []
+    for x, entry in zip(roots, root_entries):
+        if entry is None:
+            continue
+        for d in entry[2]:
+            subtrees.append(
+                (
+                    x,
+                    d,
+                    executor.submit(
+                        cached_recursive_search,
+                        os.path.join(x, d),
+                        extensions,
+                        cached_dirs,
+                        excluded_dir_names,
+                    ),
+                )
+            )
+
+    output = []
+    for x, entry in zip(roots, root_entries):
+        files = []
+        dirs = {}
+        if entry is not None:
+            files.extend(entry[1])
+            dirs[x] = entry
+        output.append((x, files, dirs))
+
+    by_root = {x: (files, dirs) for x, files, dirs in output}
+    for x, d, future in subtrees:
+        files, dirs = by_root[x]
+        subtree_files, subtree_dirs = future.result()
+        files.extend(os.path.join(d, f) for f in subtree_files)
+        dirs.update(subtree_dirs)
+    return output
+
+
+def get_cached_dirs(folder_name, extensions):
+    with directory_cache_lock:
+        cached = directory_cache.get(folder_name)
+    if cached is None or cached["extensions"] != sorted(extensions):
+        return {}
+    return cached["dirs"]
+
+
+def update_cached_dirs(folder_name, extensions, dirs):
+    cached = {"extensions": sorted(extensions), "dirs": dirs}
+    with directory_cache_lock:
+        if directory_cache.get(folder_name) == cached:
+            return
+        directory_cache[folder_name] = cached
+    save_directory_cache()
+
+
+def load_directory_cache():
+    global directory_cache
     try:
-        dirs[directory] = os.path.getmtime(directory)
+        with open(directory_cache_file) as f:
+            data = json.load(f)
     except FileNotFoundError:
-        logging.warning(f"Warning: Unable to access {directory}. Skipping this path.")
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"Unable to load model index {directory_cache_file}: {e}")
+        return
 
-    logging.debug("recursive file list on directory {}".format(directory))
-    for dirpath, subdirs, filenames in os.walk(
-        directory, followlinks=True, topdown=True
-    ):
-        subdirs[:] = [d for d in subdirs if d not in excluded_dir_names]
-        for file_name in filenames:
-            relative_path = os.path.relpath(os.path.join(dirpath, file_name), directory)
-            result.append(relative_path)
+    if data.get("version") == 1:
+        with directory_cache_lock:
+            directory_cache = data["folders"]
 
-        for d in subdirs:
-            path = os.path.join(dirpath, d)
-            try:
-                dirs[path] = os.path.getmtime(path)
-            except FileNotFoundError:
-                logging.warning(
-                    f"Warning: Unable to access {path}. Skipping this path."
-                )
-                continue
-    logging.debug("found {} files".format(len(result)))
-    return result, dirs
+
+def save_directory_cache():
+    with directory_cache_lock:
+        data = json.dumps(
+            {"version": 1, "folders": directory_cache}, separators=(",", ":")
+        )
+
+    try:
+        os.makedirs(os.path.dirname(directory_cache_file), exist_ok=True)
+        atomic_write(directory_cache_file, data)
+    except OSError as e:
+        logging.warning(f"Unable to save model index {directory_cache_file}: {e}")
 
 
 def filter_files_extensions(files, extensions):
     return sorted(
         list(
             filter(
-                lambda a: os.path.splitext(a)[-1].lower() in extensions
-                or len(extensions) == 0,
+                lambda a: file_has_extension(a, extensions),
                 files,
             )
         )
@@ -263,12 +440,16 @@ def get_filename_list_(folder_name):
     global folder_names_and_paths
     output_list = set()
     folders = folder_names_and_paths[folder_name]
-    output_folders = {}
-    for x in folders[0]:
-        files, folders_all = recursive_search(x, excluded_dir_names=[".git"])
-        output_list.update(filter_files_extensions(files, folders[1]))
-        output_folders = {**output_folders, **folders_all}
+    cached_dirs = get_cached_dirs(folder_name, folders[1])
+    dirs = {}
+    for x, files, dirs_all in scan_folder_roots(
+        folders[0], folders[1], cached_dirs, excluded_dir_names=[".git"]
+    ):
+        output_list.update(files)
+        dirs.update(dirs_all)
+    update_cached_dirs(folder_name, folders[1], dirs)
 
+    output_folders = {path: entry[0] for path, entry in dirs.items()}
     return (sorted(list(output_list)), output_folders, time.perf_counter())
 
 
@@ -294,25 +475,332 @@ def cached_filename_list_(folder_name):
     return out
 
 
+class FolderIndex:
+    """Sorted file list of one folder name kept current by filesystem events.
+
+    Files are tracked per root so a name found in several roots stays listed
+    until it is gone from all of them.
+    """
+
+    def __init__(self, roots, extensions):
+        self.roots = list(roots)
+        self.extensions = extensions
+        self.files = {root: set() for root in self.roots}
+        self.sorted = []
+        self.snapshot = ()
+        self.valid = True
+        self.watched = False
+        self.callbacks = []
+
+    def load(self, root, files):
+        self.files[root] = set(files)
+        self.sorted = sorted(set().union(*self.files.values()))
+        self.snapshot = tuple(self.sorted)
+
+    def add(self, root, relative_path):
+        if not file_has_extension(relative_path, self.extensions):
+            return
+        files = self.files[root]
+        if relative_path in files:
+            return
+        listed = any(relative_path in f for f in self.files.values())
+        files.add(relative_path)
+        if not listed:
+            bisect.insort(self.sorted, relative_path)
+            self.snapshot = None
+
+    def remove(self, root, relative_path):
+        files = self.files[root]
+        if relative_path not in files:
+            return
+        files.discard(relative_path)
+        if any(relative_path in f for f in self.files.values()):
+            return
+        i = bisect.bisect_left(self.sorted, relative_path)
+        if i < len(self.sorted) and self.sorted[i] == relative_path:
+            del self.sorted[i]
+            self.snapshot = None
+
+    def remove_tree(self, root, relative_dir):
+        prefix = os.path.join(relative_dir, "")
+        for relative_path in [f for f in self.files[root] if f.startswith(prefix)]:
+            self.remove(root, relative_path)
+
+    def get(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with filename_index_lock:
+                snapshot = self.snapshot = tuple(self.sorted)
+        return snapshot
+
+
+def enable_filesystem_watcher():
+    global filename_watcher
+    from app import fs_watcher
+
+    filename_watcher = fs_watcher.get_watcher()
+    return filename_watcher is not None
+
+
+def watch_folder_root(folder_name, index, root, folders):
+    def on_change(kind, path, is_dir):
+        if kind == "created" and not is_dir and os.path.isdir(path):
+            is_dir = True  # symlinked directory, os.walk follows those
+        if is_dir and os.path.basename(path) == ".git":
+            return
+
+        if kind == "created" and is_dir:
+            files, folders_all = recursive_search(path, excluded_dir_names=[".git"])
+        with filename_index_lock:
+            if filename_index.get(folder_name) is not index:
+                filename_watcher.unsubscribe(on_change)
+                return
+            if kind == "overflow":
+                index.valid = False
+                return
+
+            relative_path = os.path.relpath(path, root)
+            if not is_dir:
+                if kind == "created":
+                    index.add(root, relative_path)
+                else:
+                    index.remove(root, relative_path)
+            elif kind == "created":
+                for folder in folders_all:
+                    if not filename_watcher.watch(folder, on_change):
+                        index.valid = False
+                for file in files:
+                    index.add(root, os.path.join(relative_path, file))
+            else:
+                index.remove_tree(root, relative_path)
+
+    index.callbacks.append(on_change)
+    for folder in folders:
+        if not filename_watcher.watch(folder, on_change):
+            return False
+    return True
+
+
+def build_filename_index(folder_name):
+    global folder_names_and_paths
+    roots, extensions = folder_names_and_paths[folder_name]
+    old_index = filename_index.get(folder_name)
+    if old_index is not None:
+        for callback in old_index.callbacks:
+            filename_watcher.unsubscribe(callback)
+
+    index = FolderIndex(roots, extensions)
+    filename_index[folder_name] = index
+
+    cached_dirs = get_cached_dirs(folder_name, extensions)
+    dirs = {}
+    index.watched = True
+    for x, files, dirs_all in scan_folder_roots(
+        index.roots, extensions, cached_dirs, excluded_dir_names=[".git"]
+    ):
+        index.load(x, files)
+        dirs.update(dirs_all)
+        if index.watched:
+            index.watched = watch_folder_root(folder_name, index, x, dirs_all)
+    update_cached_dirs(folder_name, extensions, dirs)
+
+    output_folders = {path: entry[0] for path, entry in dirs.items()}
+
+    if not index.watched:
+        # out of inotify watches, get_filename_list falls back to mtime checks
+        for callback in index.callbacks:
+            filename_watcher.unsubscribe(callback)
+        index.callbacks = []
+    else:
+        # anything that changed between the walk and adding the watches is missed
+        for folder, time_modified in output_folders.items():
+            try:
+                if os.path.getmtime(folder) != time_modified:
+                    index.valid = False
+            except OSError:
+                index.valid = False
+
+    filename_list_cache[folder_name] = (
+        list(index.sorted),
+        output_folders,
+        time.perf_counter(),
+    )
+    return index
+
+
+def get_filename_index(folder_name):
+    global folder_names_and_paths
+    with filename_index_lock:
+        index = filename_index.get(folder_name)
+        if (
+            index is None
+            or not index.valid
+            or index.roots != folder_names_and_paths[folder_name][0]
+        ):
+            index = build_filename_index(folder_name)
+    if not index.watched:
+        return None
+    return index
+
+
 def get_filename_list(folder_name):
+    if filename_watcher is not None:
+        index = get_filename_index(folder_name)
+        if index is not None:
+            filename_list_stats["hits"] += 1
+            return list(index.get())
+
     out = cached_filename_list_(folder_name)
     if out is None:
+        filename_list_stats["misses"] += 1
         out = get_filename_list_(folder_name)
         global filename_list_cache
         filename_list_cache[folder_name] = out
+    else:
+        filename_list_stats["hits"] += 1
     return list(out[0])
 
 
-def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
-    def map_filename(filename):
-        prefix_len = len(os.path.basename(filename_prefix))
-        prefix = filename[: prefix_len + 1]
+class SaveCounters:
+    """Highest counter used per filename prefix in one output folder.
+
+    Saved files are named {prefix}_{counter:05}{tail}, e.g. ComfyUI_00001_.png.
+    The folder is listed once and counters that were handed out count as
+    used, so concurrent saves never get the same one. Files saved behind
+    its back are picked up from the filesystem watcher with
+    --watch-model-folders, otherwise next() steps over the names that
+    exist already. A prefix with no files yet lists the folder again when
+    its mtime changed, as its first file may have been saved since.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.counters = {}
+        self.tails = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def observe(self, name):
+        # the prefix may contain underscores itself, record every candidate
+        i = name.find("_")
+        while i != -1:
+            rest = name[i + 1 :]
+            digits = rest.split("_")[0]
+            if digits.isdigit():
+                prefix = name[:i]
+                counter = int(digits)
+                if counter > self.counters.get(prefix, 0):
+                    self.counters[prefix] = counter
+                self.tails.setdefault(prefix, set()).add(rest[len(digits) :])
+            i = name.find("_", i + 1)
+
+    def on_change(self, kind, path, is_dir):
+        with self.lock:
+            if kind == "overflow":
+                self.mtime = None
+            elif kind == "created":
+                self.observe(os.path.basename(path))
+
+    def is_watched(self):
+        watcher = filename_watcher
+        if watcher is None:
+            return False
+        if watcher.is_watching(self.folder, self.on_change):
+            return True
+        # files saved before the watch started are only found by listing
+        self.mtime = None
+        return watcher.watch(self.folder, self.on_change)
+
+    def sync(self):
         try:
-            digits = int(filename[prefix_len + 1 :].split("_")[0])
-        except:
-            digits = 0
-        return (digits, prefix)
+            mtime = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            os.makedirs(self.folder, exist_ok=True)
+            mtime = None
+        if mtime is None or mtime != self.mtime:
+            self.mtime = os.stat(self.folder).st_mtime_ns
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    self.observe(entry.name)
+
+    def next(self, prefix):
+        with self.lock:
+            # watch before listing so nothing is missed in between
+            watched = self.is_watched()
+            if self.mtime is None or (prefix not in self.tails and not watched):
+                self.sync()
+            counter = self.counters.get(prefix, 0) + 1
+            # a batch saves several counters at once, skip those not seen yet
+            tails = self.tails.get(prefix, ())
+            while any(
+                os.path.exists(
+                    os.path.join(self.folder, f"{prefix}_{counter:05}{tail}")
+                )
+                for tail in tails
+            ):
+                counter += 1
+            self.counters[prefix] = counter
+            return counter
+
+
+class UploadCounters:
+    """Highest "name (n).ext" number used per upload name in one folder.
+
+    The folder is listed once, names are then claimed by creating the file
+    exclusively, so files the index doesn't know about are skipped safely.
+    """
+
+    pattern = re.compile(r"(.*) \((\d+)\)$")
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.counters = {}
+        self.lock = threading.Lock()
+        with os.scandir(folder) as it:
+            for entry in it:
+                self.observe(entry.name)
+
+    def observe(self, name):
+        base, ext = os.path.splitext(name)
+        match = self.pattern.match(base)
+        if match is not None:
+            key = (match[1], ext)
+            self.counters[key] = max(self.counters.get(key, 0), int(match[2]))
+
+    def reserve(self, filename):
+        base, ext = os.path.splitext(filename)
+        candidate = filename
+        while True:
+            try:
+                fd = os.open(
+                    os.path.join(self.folder, candidate),
+                    os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                )
+                os.close(fd)
+                return candidate
+            except FileExistsError:
+                with self.lock:
+                    i = self.counters.get((base, ext), 0) + 1
+                    self.counters[(base, ext)] = i
+                candidate = f"{base} ({i}){ext}"
+
+
+def get_counters(counters, cls, folder):
+    folder = os.path.abspath(folder)
+    with counters_lock:
+        folder_counters = counters.get(folder)
+        if folder_counters is None:
+            folder_counters = counters[folder] = cls(folder)
+    return folder_counters
 
+
+def reserve_upload_filename(folder, filename):
+    """Picks a free name for an upload, filename or "name (n).ext", and
+    creates it empty so no other upload can take it."""
+    return get_counters(upload_counters, UploadCounters, folder).reserve(filename)
+
+
+def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
     def compute_vars(input, image_width, image_height):
         input = input.replace("%width%", str(image_width))
         input = input.replace("%height%", str(image_height))
@@ -341,19 +829,7 @@ def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height
         logging.error(err)
         raise Exception(err)
 
-    try:
-        counter = (
-            max(
-                filter(
-                    lambda a: a[1][:-1] == filename and a[1][-1] == "_",
-                    map(map_filename, os.listdir(full_output_folder)),
-                )
-            )[0]
-            + 1
-        )
-    except ValueError:
-        counter = 1
-    except FileNotFoundError:
-        os.makedirs(full_output_folder, exist_ok=True)
-        counter = 1
+    counter = get_counters(save_counters, SaveCounters, full_output_folder).next(
+        filename
+    )
     return full_output_folder, filename, counter, subfolder, filename_prefix
@@ -1,10 +1,15 @@
 # Copied (and simplified) from: https://github.com/comfyanonymous/ComfyUI/blob/c61eadf69a3ba4033dcf22e2e190fd54f779fc5b/main.py
 
+import comfy.options
+
+comfy.options.enable_args_parsing()
+
 import asyncio
 import os
 
 import folder_paths
 import server
+from app.dispatcher import Dispatcher, LocalWorker, RemoteWorker
 from comfy.cli_args import args
 
 
@@ -24,8 +29,32 @@ if __name__ == "__main__":
         print(f"Setting input directory to: {input_dir}")
         folder_paths.set_input_directory(input_dir)
 
+    folder_paths.load_directory_cache()
+
+    if args.watch_model_folders:
+        if not folder_paths.enable_filesystem_watcher():
+            print("Filesystem watcher not available, checking folder mtimes instead.")
+
     server.add_routes()
 
+    workers = [RemoteWorker(url, loop) for url in args.backend]
+    if args.stand_in_executor is not None:
+        from app.stand_in_executor import StandInExecutor
+
+        for i in range(args.stand_in_workers):
+            workers.append(
+                LocalWorker(
+                    f"stand-in-{i}",
+                    server,
+                    lambda relay: StandInExecutor(relay, args.stand_in_executor),
+                )
+            )
+    if len(workers) > 0:
+        server.dispatcher = Dispatcher(
+            server, server.prompt_queue, workers, args.dispatch
+        )
+        server.dispatcher.start()
+
     call_on_start = None
     if args.auto_launch:
 
@@ -44,6 +44,7 @@ def load_custom_node(module_path, ignore=set()):
             for name in module.NODE_CLASS_MAPPINGS:
                 if name not in ignore:
                     NODE_CLASS_MAPPINGS[name] = module.NODE_CLASS_MAPPINGS[name]
+            node_mappings_changed()
             if (
                 hasattr(module, "NODE_DISPLAY_NAME_MAPPINGS")
                 and getattr(module, "NODE_DISPLAY_NAME_MAPPINGS") is not None
@@ -61,6 +62,16 @@ def load_custom_node(module_path, ignore=set()):
         return False
 
 
+def node_mappings_changed():
+    global NODE_MAPPINGS_GENERATION
+    NODE_MAPPINGS_GENERATION += 1
+
+
+# Used by the http server to know when cached /object_info responses are stale
+def node_mappings_version():
+    return (NODE_MAPPINGS_GENERATION, len(NODE_CLASS_MAPPINGS))
+
+
 def load_json_file(file_path: str) -> dict:
     with open(file_path, "r") as fp:
         return json.load(fp)
@@ -71,3 +82,5 @@ EXTENSION_WEB_DIRS = load_json_file("extension_web_dirs.json")
 NODE_CLASS_MAPPINGS = load_json_file("node_class_mappings.json")
 
 NODE_DISPLAY_NAME_MAPPINGS = load_json_file("node_display_name_mappings.json")
+
+NODE_MAPPINGS_GENERATION = 0
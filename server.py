@@ -1,18 +1,15 @@
 # Copied (and simplified) from: https://github.com/comfyanonymous/ComfyUI/blob/c61eadf69a3ba4033dcf22e2e190fd54f779fc5b/server.py
 
 import asyncio
-import glob
+import functools
 import json
+import logging
 import os
+import stat
 import struct
 import sys
-import traceback
 import urllib
 import uuid
-from io import BytesIO
-
-from PIL import Image, ImageOps
-from PIL.PngImagePlugin import PngInfo
 
 import folder_paths
 
@@ -29,7 +26,24 @@ except ImportError:
 import mimetypes
 
 import nodes
+from app import image_encoding
+from app.extension_list import ExtensionList
+from app.file_lookup import StatFileResponse, get_stat_cache
+from app.preview_cache import PreviewCache
+from app.history_store import HistoryStore
+from app.metrics import ServerMetrics
+from app.prompt_handlers import PromptHandlers
+from app.prompt_queue import PromptQueue, validate_prompt
+from app.response_cache import JSONResponseCache, etag_matches
+from app.route_executor import get_route_executor
+from app.static_manifest import StaticManifest
+from app.upload_index import UploadIndex, link_file
+from app.upload_stream import read_multipart
 from app.user_manager import UserManager
+from app.websocket_broadcast import Broadcaster
+from comfy.cli_args import args
+
+STREAM_CHUNK_SIZE = 256 * 1024
 
 
 class BinaryEventTypes:
@@ -37,15 +51,8 @@ class BinaryEventTypes:
     UNENCODED_PREVIEW_IMAGE = 2
 
 
-async def send_socket_catch_exception(function, message):
-    try:
-        await function(message)
-    except (
-        aiohttp.ClientError,
-        aiohttp.ClientPayloadError,
-        ConnectionResetError,
-    ) as err:
-        print("send error:", err)
+# only the latest of these matters to a client, queued ones get replaced
+COALESCED_EVENTS = {"status", "progress"}
 
 
 @web.middleware
@@ -83,9 +90,40 @@ class PromptServer:
         mimetypes.init()
         mimetypes.types_map[".js"] = "application/javascript; charset=utf-8"
 
+        self.executor = get_route_executor()
+
+        preview_disk_dir = None
+        if args.preview_disk_cache:
+            preview_disk_dir = os.path.join(
+                folder_paths.get_temp_directory(), "preview_cache"
+            )
+        self.preview_cache = PreviewCache(
+            round(args.preview_cache_size * 1024 * 1024),
+            preview_disk_dir,
+            round(args.preview_disk_cache_size * 1024 * 1024),
+        )
         self.user_manager = UserManager()
+        self.stat_cache = get_stat_cache()
+        self.upload_index = None
+        if args.dedup_uploads is not None:
+            self.upload_index = UploadIndex(
+                os.path.join(folder_paths.user_directory, "upload_index.jsonl")
+            )
         self.supports = ["custom_nodes_from_web"]
-        self.prompt_queue = None
+        history_log = None
+        if args.persist_history:
+            history_log = os.path.join(folder_paths.user_directory, "history.jsonl")
+        self.prompt_queue = PromptQueue(
+            self,
+            HistoryStore(
+                args.max_history_items,
+                round(args.max_history_size * 1024 * 1024),
+                history_log,
+            ),
+        )
+        self.queue_update_pending = False
+        self.dispatcher = None
+        self.metrics = ServerMetrics(self) if args.enable_metrics else None
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
@@ -99,13 +137,28 @@ class PromptServer:
             client_max_size=max_upload_size, middlewares=middlewares
         )
         self.sockets = dict()
+        self.broadcaster = Broadcaster(args.websocket_queue_size)
+        # sid -> {prompt_id: node}, the node each prompt is on, per client
+        self.executing = {}
+        self.preview_slots = {}
+        self.preview_tasks = {}
+        self.preview_sent_at = {}
         self.web_root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "web")
+        self.static_manifest = StaticManifest()
+        self.extension_list = ExtensionList(self.web_root)
         routes = web.RouteTableDef()
         self.routes = routes
+        # what upstream's executor sets, custom nodes read them
         self.last_node_id = None
         self.client_id = None
+        self.last_prompt_id = None
 
-        self.on_prompt_handlers = []
+        timeout = (
+            args.prompt_handler_timeout if args.prompt_handler_timeout > 0 else None
+        )
+        self.on_prompt_handlers = PromptHandlers(
+            lambda *a: self.executor.run_io(*a), timeout
+        )
 
         @routes.get("/ws")
         async def websocket_handler(request):
@@ -119,6 +172,7 @@ class PromptServer:
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            self.broadcaster.add(sid, ws)
 
             try:
                 # Send initial state to the new client
@@ -126,59 +180,40 @@ class PromptServer:
                     "status", {"status": self.get_queue_info(), "sid": sid}, sid
                 )
                 # On reconnect if we are the currently executing client send the current node
-                if self.client_id == sid and self.last_node_id is not None:
-                    await self.send("executing", {"node": self.last_node_id}, sid)
+                for prompt_id, node in list(self.executing.get(sid, {}).items()):
+                    await self.send(
+                        "executing", {"node": node, "prompt_id": prompt_id}, sid
+                    )
 
                 async for msg in ws:
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         print("ws connection closed with exception %s" % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                # a reconnect with the same clientId may have replaced us already
+                if self.sockets.get(sid) is ws:
+                    self.sockets.pop(sid, None)
+                self.broadcaster.remove(sid, ws)
+                self.preview_sent_at.pop(sid, None)
             return ws
 
         @routes.get("/")
         async def get_root(request):
-            return web.FileResponse(os.path.join(self.web_root, "index.html"))
+            return await self.static_manifest.serve(
+                request, "/index.html", self.web_root, "index.html"
+            )
 
         @routes.get("/embeddings")
-        def get_embeddings(self):
-            embeddings = folder_paths.get_filename_list("embeddings")
+        async def get_embeddings(request):
+            embeddings = await self.executor.run_io(
+                "embeddings", folder_paths.get_filename_list, "embeddings"
+            )
             return web.json_response(
                 list(map(lambda a: os.path.splitext(a)[0], embeddings))
             )
 
         @routes.get("/extensions")
         async def get_extensions(request):
-            files = glob.glob(
-                os.path.join(glob.escape(self.web_root), "extensions/**/*.js"),
-                recursive=True,
-            )
-
-            extensions = list(
-                map(
-                    lambda f: "/"
-                    + os.path.relpath(f, self.web_root).replace("\\", "/"),
-                    files,
-                )
-            )
-
-            for name, dir in nodes.EXTENSION_WEB_DIRS.items():
-                files = glob.glob(
-                    os.path.join(glob.escape(dir), "**/*.js"), recursive=True
-                )
-                extensions.extend(
-                    list(
-                        map(
-                            lambda f: "/extensions/"
-                            + urllib.parse.quote(name)
-                            + "/"
-                            + os.path.relpath(f, dir).replace("\\", "/"),
-                            files,
-                        )
-                    )
-                )
-
-            return web.json_response(extensions)
+            return await self.extension_list.response(request)
 
         def get_dir_by_type(dir_type):
             if dir_type is None:
@@ -193,14 +228,29 @@ class PromptServer:
 
             return type_dir, dir_type
 
-        def image_upload(post, image_save_function=None):
-            image = post.get("image")
+        async def read_upload(request, route):
+            return await read_multipart(
+                request,
+                "image",
+                lambda fields: get_dir_by_type(fields.get("type"))[0],
+                functools.partial(self.executor.run_io, route),
+                request.client_max_size,
+            )
+
+        def image_upload(post, image, image_save_function=None):
+            try:
+                return save_upload(post, image, image_save_function)
+            finally:
+                if image is not None:
+                    image.discard()
+
+        def save_upload(post, image, image_save_function=None):
             overwrite = post.get("overwrite")
 
             image_upload_type = post.get("type")
             upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
 
-            if image and image.file:
+            if image is not None:
                 filename = image.filename
                 if not filename:
                     return web.Response(status=400)
@@ -217,22 +267,64 @@ class PromptServer:
                 if not os.path.exists(full_output_folder):
                     os.makedirs(full_output_folder)
 
-                split = os.path.splitext(filename)
+                overwrite = overwrite is not None and (
+                    overwrite == "true" or overwrite == "1"
+                )
+                existing = None
+                dedup = (
+                    self.upload_index is not None
+                    and image_save_function is None
+                    and image_upload_type == "input"
+                    and not overwrite
+                )
+                if dedup:
+                    existing = self.upload_index.find(image.sha256, upload_dir)
+                    if existing is not None and args.dedup_uploads == "name":
+                        existing = os.path.relpath(existing, upload_dir)
+                        return web.json_response(
+                            {
+                                "name": os.path.basename(existing),
+                                "subfolder": os.path.dirname(existing),
+                                "type": image_upload_type,
+                            }
+                        )
 
-                if overwrite is not None and (overwrite == "true" or overwrite == "1"):
-                    pass
-                else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
-
-                if image_save_function is not None:
-                    image_save_function(image, post, filepath)
-                else:
-                    with open(filepath, "wb") as f:
-                        f.write(image.file.read())
+                if (
+                    self.upload_index is not None
+                    and overwrite
+                    and os.path.isfile(filepath)
+                    and os.stat(filepath).st_nlink > 1
+                ):
+                    # saving in place would change the files linked to it too
+                    os.remove(filepath)
+
+                reserved = False
+                if not overwrite:
+                    # creates the file empty, the upload replaces it below
+                    filename = folder_paths.reserve_upload_filename(
+                        full_output_folder, filename
+                    )
+                    filepath = os.path.join(full_output_folder, filename)
+                    reserved = True
+
+                saved = False
+                try:
+                    if image_save_function is not None:
+                        response = image_save_function(image, post, filepath)
+                        if response is not None:
+                            return response
+                        saved = os.path.getsize(filepath) > 0
+                    else:
+                        if existing is None or not link_file(existing, filepath):
+                            image.commit(filepath)
+                        saved = True
+                        if dedup:
+                            self.upload_index.add(image.sha256, filepath)
+                    self.stat_cache.invalidate(filepath)
+                finally:
+                    # nothing was saved, don't leave the reserved name behind
+                    if reserved and not saved:
+                        os.remove(filepath)
 
                 return web.json_response(
                     {
@@ -246,12 +338,12 @@ class PromptServer:
 
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            post, image = await read_upload(request, "upload_image")
+            return await self.executor.run_io("upload_image", image_upload, post, image)
 
         @routes.post("/upload/mask")
         async def upload_mask(request):
-            post = await request.post()
+            post, image = await read_upload(request, "upload_mask")
 
             def image_save_function(image, post, filepath):
                 original_ref = json.loads(post.get("original_ref"))
@@ -285,21 +377,55 @@ class PromptServer:
 
                 file = os.path.join(output_dir, filename)
 
-                if os.path.isfile(file):
-                    with Image.open(file) as original_pil:
-                        metadata = PngInfo()
-                        if hasattr(original_pil, "text"):
-                            for key in original_pil.text:
-                                metadata.add_text(key, original_pil.text[key])
-                        original_pil = original_pil.convert("RGBA")
-                        mask_pil = Image.open(image.file).convert("RGBA")
+                if not os.path.isfile(file):
+                    return web.Response(status=404)
+
+                try:
+                    self.executor.call_image(
+                        image_encoding.composite_mask,
+                        file,
+                        image.temp_path,
+                        filepath,
+                        args.mask_compress_level,
+                    )
+                except ValueError as e:
+                    # the mask isn't the size of the original
+                    return web.Response(status=400, text=str(e))
+
+            return await self.executor.run_io(
+                "upload_mask", image_upload, post, image, image_save_function
+            )
+
+        @functools.lru_cache(maxsize=4096)
+        def resolve_view_path(filename, type, subfolder, *directories):
+            """Maps /view parameters to (file, filename) or an error status.
+
+            Only path arithmetic, so results are cached; directories just keys
+            the cache to the current output, input and temp folders.
+            """
+            filename, output_dir = folder_paths.annotated_filepath(filename)
+
+            # validation for security: prevent accessing arbitrary path
+            if not filename or filename[0] == "/" or ".." in filename:
+                return 400
+
+            if output_dir is None:
+                output_dir = folder_paths.get_directory_by_type(type)
 
-                        # alpha copy
-                        new_alpha = mask_pil.getchannel("A")
-                        original_pil.putalpha(new_alpha)
-                        original_pil.save(filepath, compress_level=4, pnginfo=metadata)
+            if output_dir is None:
+                return 400
 
-            return image_upload(post, image_save_function)
+            if subfolder is not None:
+                full_output_dir = os.path.join(output_dir, subfolder)
+                if (
+                    os.path.commonpath((os.path.abspath(full_output_dir), output_dir))
+                    != output_dir
+                ):
+                    return 403
+                output_dir = full_output_dir
+
+            filename = os.path.basename(filename)
+            return os.path.join(output_dir, filename), filename
 
         @routes.get("/view")
         async def view_image(request):
@@ -314,67 +440,50 @@ class PromptServer:
                     return web.Response(status=400, text="Invalid URL format.")
 
             if "filename" in request.rel_url.query:
-                filename = request.rel_url.query["filename"]
-                filename, output_dir = folder_paths.annotated_filepath(filename)
-
-                # validation for security: prevent accessing arbitrary path
-                if filename[0] == "/" or ".." in filename:
-                    return web.Response(status=400)
-
-                if output_dir is None:
-                    type = request.rel_url.query.get("type", "output")
-                    output_dir = folder_paths.get_directory_by_type(type)
-
-                if output_dir is None:
-                    return web.Response(status=400)
-
-                if "subfolder" in request.rel_url.query:
-                    full_output_dir = os.path.join(
-                        output_dir, request.rel_url.query["subfolder"]
-                    )
-                    if (
-                        os.path.commonpath(
-                            (os.path.abspath(full_output_dir), output_dir)
-                        )
-                        != output_dir
-                    ):
-                        return web.Response(status=403)
-                    output_dir = full_output_dir
-
-                filename = os.path.basename(filename)
-                file = os.path.join(output_dir, filename)
+                resolved = resolve_view_path(
+                    request.rel_url.query["filename"],
+                    request.rel_url.query.get("type", "output"),
+                    request.rel_url.query.get("subfolder"),
+                    folder_paths.get_output_directory(),
+                    folder_paths.get_input_directory(),
+                    folder_paths.get_temp_directory(),
+                )
+                if isinstance(resolved, int):
+                    return web.Response(status=resolved)
+                file, filename = resolved
 
-                if os.path.isfile(file):
+                st = self.stat_cache.stat(file)
+                if st is not None and stat.S_ISREG(st.st_mode):
                     if "preview" in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query["preview"].split(";")
-                            image_format = preview_info[0]
-                            if image_format not in [
-                                "webp",
-                                "jpeg",
-                            ] or "a" in request.rel_url.query.get("channel", ""):
-                                image_format = "webp"
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if (
-                                image_format in ["jpeg"]
-                                or request.rel_url.query.get("channel", "") == "rgb"
-                            ):
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(
-                                body=buffer.read(),
-                                content_type=f"image/{image_format}",
-                                headers={
-                                    "Content-Disposition": f'filename="{filename}"'
-                                },
-                            )
+                        preview_info = request.rel_url.query["preview"].split(";")
+                        image_format = preview_info[0]
+                        if image_format not in [
+                            "webp",
+                            "jpeg",
+                        ] or "a" in request.rel_url.query.get("channel", ""):
+                            image_format = "webp"
+
+                        quality = 90
+                        if preview_info[-1].isdigit():
+                            quality = int(preview_info[-1])
+
+                        max_size = request.rel_url.query.get("max_size", "")
+                        max_size = int(max_size) if max_size.isdigit() else None
+                        if max_size == 0:
+                            max_size = None
+
+                        return await self.image_variant_response(
+                            request,
+                            file,
+                            filename,
+                            f"image/{image_format}",
+                            "view_preview",
+                            image_encoding.encode_preview,
+                            image_format,
+                            quality,
+                            request.rel_url.query.get("channel", ""),
+                            max_size,
+                        )
 
                     if "channel" not in request.rel_url.query:
                         channel = "rgba"
@@ -382,49 +491,28 @@ class PromptServer:
                         channel = request.rel_url.query["channel"]
 
                     if channel == "rgb":
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge("RGB", (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format="PNG")
-                            buffer.seek(0)
-
-                            return web.Response(
-                                body=buffer.read(),
-                                content_type="image/png",
-                                headers={
-                                    "Content-Disposition": f'filename="{filename}"'
-                                },
-                            )
+                        return await self.image_variant_response(
+                            request,
+                            file,
+                            filename,
+                            "image/png",
+                            "view_channel",
+                            image_encoding.encode_rgb,
+                        )
 
                     elif channel == "a":
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new("L", img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new("RGBA", img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format="PNG")
-                            alpha_buffer.seek(0)
-
-                            return web.Response(
-                                body=alpha_buffer.read(),
-                                content_type="image/png",
-                                headers={
-                                    "Content-Disposition": f'filename="{filename}"'
-                                },
-                            )
+                        return await self.image_variant_response(
+                            request,
+                            file,
+                            filename,
+                            "image/png",
+                            "view_channel",
+                            image_encoding.encode_alpha,
+                        )
                     else:
-                        return web.FileResponse(
+                        return StatFileResponse(
                             file,
+                            st,
                             headers={"Content-Disposition": f'filename="{filename}"'},
                         )
 
@@ -437,29 +525,76 @@ class PromptServer:
         def node_info(node_class):
             return nodes.NODE_CLASS_MAPPINGS[node_class]
 
+        def object_info(node_class=None):
+            if node_class is None:
+                return nodes.NODE_CLASS_MAPPINGS
+            return {node_class: node_info(node_class)}
+
+        # serialized and compressed once per version of the node mappings
+        self.object_info_cache = JSONResponseCache(
+            object_info,
+            nodes.node_mappings_version,
+            lambda *a: self.executor.run_io("object_info", *a),
+        )
+
         @routes.get("/object_info")
         async def get_object_info(request):
-            return web.json_response(nodes.NODE_CLASS_MAPPINGS)
+            return await self.object_info_cache.response(request)
 
         @routes.get("/object_info/{node_class}")
         async def get_object_info_node(request):
             node_class = request.match_info.get("node_class", None)
-            out = {}
             if (node_class is not None) and (node_class in nodes.NODE_CLASS_MAPPINGS):
-                out[node_class] = node_info(node_class)
-            return web.json_response(out)
+                return await self.object_info_cache.response(request, node_class)
+            return web.json_response({})
+
+        def json_text_response(text):
+            return web.Response(text=text, content_type="application/json")
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
-            if max_items is not None:
-                max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            query = request.rel_url.query
+            history = self.prompt_queue.history
+            try:
+                max_items = query.get("max_items", None)
+                if max_items is not None:
+                    max_items = int(max_items)
+                since = query.get("since", None)
+                before = query.get("before", None)
+                if since is not None:
+                    since = int(since)
+                if before is not None:
+                    before = None if before == "" else int(before)
+            except ValueError:
+                return web.Response(status=400)
+
+            if since is not None:
+                # the entries added since a cursor, oldest first
+                items, cursor, more, truncated = history.after(since, max_items)
+            elif "before" in query:
+                # paging back from the newest entries
+                items, cursor, more = history.before(before, max_items)
+                truncated = False
+            else:
+                return json_text_response(
+                    history.encode(history.items(max_items=max_items))
+                )
+
+            return json_text_response(
+                '{"history": %s, "cursor": %s, "more": %s, "truncated": %s}'
+                % (
+                    history.encode(items),
+                    json.dumps(cursor),
+                    json.dumps(more),
+                    json.dumps(truncated),
+                )
+            )
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
             prompt_id = request.match_info.get("prompt_id", None)
-            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
+            history = self.prompt_queue.history
+            return json_text_response(history.encode(history.get(prompt_id)))
 
         @routes.get("/queue")
         async def get_queue(request):
@@ -469,33 +604,156 @@ class PromptServer:
             queue_info["queue_pending"] = current_queue[1]
             return web.json_response(queue_info)
 
+        @routes.post("/prompt")
+        async def post_prompt(request):
+            json_data = await request.json()
+            json_data = await self.trigger_on_prompt_async(json_data)
+
+            if "number" in json_data:
+                number = float(json_data["number"])
+            else:
+                number = self.number
+                if "front" in json_data:
+                    if json_data["front"]:
+                        number = -number
+
+                self.number += 1
+
+            if "prompt" in json_data:
+                prompt = json_data["prompt"]
+                valid = validate_prompt(prompt)
+                extra_data = {}
+                if "extra_data" in json_data:
+                    extra_data = json_data["extra_data"]
+
+                if "client_id" in json_data:
+                    extra_data["client_id"] = json_data["client_id"]
+                if valid[0]:
+                    prompt_id = str(json_data.get("prompt_id", uuid.uuid4()))
+                    outputs_to_execute = valid[2]
+                    self.prompt_queue.put(
+                        (number, prompt_id, prompt, extra_data, outputs_to_execute)
+                    )
+                    response = {
+                        "prompt_id": prompt_id,
+                        "number": number,
+                        "node_errors": valid[3],
+                    }
+                    return web.json_response(response)
+                else:
+                    print("invalid prompt:", valid[1])
+                    return web.json_response(
+                        {"error": valid[1], "node_errors": valid[3]}, status=400
+                    )
+            else:
+                return web.json_response(
+                    {"error": "no prompt", "node_errors": []}, status=400
+                )
+
+        @routes.post("/queue")
+        async def post_queue(request):
+            json_data = await request.json()
+            if "clear" in json_data:
+                if json_data["clear"]:
+                    self.prompt_queue.wipe_queue()
+            if "delete" in json_data:
+                self.prompt_queue.delete_queue_items(json_data["delete"])
+
+            return web.Response(status=200)
+
+        @routes.post("/history")
+        async def post_history(request):
+            json_data = await request.json()
+            # these append to the history log when it is persisted
+            if "clear" in json_data:
+                if json_data["clear"]:
+                    await self.executor.run_io(
+                        "history", self.prompt_queue.wipe_history
+                    )
+            if "delete" in json_data:
+                to_delete = json_data["delete"]
+                for id_to_delete in to_delete:
+                    await self.executor.run_io(
+                        "history", self.prompt_queue.delete_history_item, id_to_delete
+                    )
+
+            return web.Response(status=200)
+
     def add_routes(self):
+        # build the cached responses now so the first clients don't pay for it
+        self.object_info_cache.get()
+        self.extension_list.scan(self.extension_list.get_roots())
+
         self.user_manager.add_routes(self.routes)
+        self.app.on_shutdown.append(self.user_manager.settings.close)
+        if self.metrics is not None:
+
+            @self.routes.get("/metrics")
+            async def get_metrics(request):
+                return self.metrics.response()
+
+            self.app.on_response_prepare.append(self.metrics.on_response_prepare)
+            self.app.on_startup.append(self.metrics.start)
+            self.app.on_cleanup.append(self.metrics.stop)
         self.app.add_routes(self.routes)
 
         for name, dir in nodes.EXTENSION_WEB_DIRS.items():
             self.app.add_routes(
-                [
-                    web.static("/extensions/" + urllib.parse.quote(name), dir),
-                ]
+                self.static_manifest.add_directory(
+                    "/extensions/" + urllib.parse.quote(name), dir
+                )
             )
 
-        self.app.add_routes(
-            [
-                web.static("/", self.web_root),
-            ]
+        self.app.add_routes(self.static_manifest.add_directory("/", self.web_root))
+
+    async def image_variant_response(
+        self, request, file, filename, content_type, route, function, *args
+    ):
+        """Serves function(file, *args) from the preview cache, encoding on a miss."""
+        st = self.stat_cache.stat(file) or os.stat(file)
+        key = PreviewCache.make_key(file, st, function.__name__, *args)
+        headers = {
+            "Content-Disposition": f'filename="{filename}"',
+            "ETag": self.preview_cache.etag(key),
+            "Cache-Control": "no-cache",
+        }
+        if etag_matches(request, {headers["ETag"]}):
+            return web.Response(status=304, headers=headers)
+
+        body = await self.preview_cache.get_or_encode(
+            key,
+            lambda: self.executor.run_image(route, function, file, *args),
+            lambda *a: self.executor.run_io("preview_cache", *a),
         )
 
+        # stream slices of the cached buffer instead of copying it into a Response
+        response = web.StreamResponse(headers=headers)
+        response.content_type = content_type
+        response.content_length = len(body)
+        await response.prepare(request)
+        if request.method != "HEAD":
+            view = memoryview(body)
+            for i in range(0, len(view), STREAM_CHUNK_SIZE):
+                await response.write(view[i : i + STREAM_CHUNK_SIZE])
+        await response.write_eof()
+        return response
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
-        exec_info["queue_remaining"] = 0
+        exec_info["queue_remaining"] = self.prompt_queue.get_tasks_remaining()
         prompt_info["exec_info"] = exec_info
         return prompt_info
 
-    async def send(self, event, data, sid=None):
-        if event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
-            await self.send_image(data, sid=sid)
+    async def send(self, event, data, sid=None, framed=False):
+        if framed:
+            self.push_frame(event, data, sid)
+        elif event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+            if data[2] is None:
+                # full size images (e.g. SaveImageWebsocket) are outputs, send them all
+                await self.send_image(data, sid=sid)
+            else:
+                self.queue_preview(data, sid)
         elif isinstance(data, (bytes, bytearray)):
             await self.send_bytes(event, data, sid)
         else:
@@ -505,60 +763,134 @@ class PromptServer:
         if not isinstance(event, int):
             raise RuntimeError(f"Binary event types must be integers, got {event}")
 
-        packed = struct.pack(">I", event)
-        message = bytearray(packed)
-        message.extend(data)
+        message = bytearray(4 + len(data))
+        struct.pack_into(">I", message, 0, event)
+        message[4:] = data
         return message
 
     async def send_image(self, image_data, sid=None):
-        image_type = image_data[0]
-        image = image_data[1]
-        max_size = image_data[2]
-        if max_size is not None:
-            if hasattr(Image, "Resampling"):
-                resampling = Image.Resampling.BILINEAR
-            else:
-                resampling = Image.ANTIALIAS
-
-            image = ImageOps.contain(image, (max_size, max_size), resampling)
-        type_num = 1
-        if image_type == "JPEG":
-            type_num = 1
-        elif image_type == "PNG":
-            type_num = 2
-
-        bytesIO = BytesIO()
-        header = struct.pack(">I", type_num)
-        bytesIO.write(header)
-        image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
-        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
+        image_type, image, max_size = image_data
+        frame = await self.executor.run_io(
+            "preview_image",
+            image_encoding.encode_preview_image,
+            image_type,
+            image,
+            max_size,
+            BinaryEventTypes.PREVIEW_IMAGE,
+        )
+        self.push_frame(BinaryEventTypes.PREVIEW_IMAGE, frame, sid)
+
+    def push_frame(self, event, frame, sid=None):
+        if self.metrics is not None:
+            self.metrics.sent(event, len(frame))
+        self.broadcaster.push(True, frame, sid)
+
+    def queue_preview(self, image_data, sid=None):
+        # latest wins: only the newest unencoded preview per client and node is kept
+        # previews carry no prompt_id, they are for the client's latest node
+        running = self.executing.get(sid)
+        node = next(reversed(running.values())) if running else None
+        slot = (sid, node)
+        self.preview_slots[slot] = image_data
+        if slot not in self.preview_tasks:
+            self.preview_tasks[slot] = asyncio.create_task(self.preview_writer(slot))
+
+    async def preview_writer(self, slot):
+        sid, node = slot
+        try:
+            while slot in self.preview_slots:
+                if args.preview_max_rate > 0:
+                    next_time = (
+                        self.preview_sent_at.get(sid, 0) + 1 / args.preview_max_rate
+                    )
+                    delay = next_time - self.loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                image_data = self.preview_slots.pop(slot)
+                if not self.preview_is_current(sid, node):
+                    continue
+                self.preview_sent_at[sid] = self.loop.time()
+                frame = await self.executor.run_io(
+                    "preview_image",
+                    image_encoding.encode_preview_image,
+                    *image_data,
+                    BinaryEventTypes.PREVIEW_IMAGE,
+                )
+                if not self.preview_is_current(sid, node):
+                    continue
+                if self.metrics is not None:
+                    self.metrics.sent(BinaryEventTypes.PREVIEW_IMAGE, len(frame))
+                self.broadcaster.push(
+                    True, frame, sid, (BinaryEventTypes.PREVIEW_IMAGE, node)
+                )
+        finally:
+            del self.preview_tasks[slot]
+
+    def track_executing(self, data, sid):
+        # tracked in message order, per client and prompt, so prompts running
+        # side by side on several workers each keep their own node
+        if not isinstance(data, dict):
+            return
+        prompt_id = data.get("prompt_id")
+        node = data.get("node")
+        running = self.executing.setdefault(sid, {})
+        running.pop(prompt_id, None)  # the newest node goes last
+        if node is not None:
+            running[prompt_id] = node
+        elif len(running) == 0:
+            del self.executing[sid]
+
+    def preview_is_current(self, sid, node):
+        # the frontend shows previews on the running node, drop stale ones.
+        # Ones sent while the client had nothing running aren't tied to a node
+        return node is None or node in self.executing.get(sid, {}).values()
+
+    def coalesce_key(self, event, data=None, sid=None):
+        if event not in COALESCED_EVENTS:
+            return None
+        if isinstance(data, dict):
+            if "sid" in data:
+                # the status that tells a client its sid must always arrive
+                return None
+            # progress of prompts running side by side doesn't replace each other
+            return (event, sid, data.get("prompt_id"))
+        return (event, sid)
 
     async def send_bytes(self, event, data, sid=None):
         message = self.encode_bytes(event, data)
-
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+        if self.metrics is not None:
+            self.metrics.sent(event, len(message))
+        self.broadcaster.push(True, message, sid, self.coalesce_key(event, sid=sid))
 
     async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
-
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+        if event == "executing":
+            self.track_executing(data, sid)
+        message = json.dumps({"type": event, "data": data})
+        if self.metrics is not None:
+            self.metrics.sent(event, len(message.encode()))
+        self.broadcaster.push(False, message, sid, self.coalesce_key(event, data, sid))
 
     def send_sync(self, event, data, sid=None):
         self.loop.call_soon_threadsafe(self.messages.put_nowait, (event, data, sid))
 
+    def send_frame_sync(self, event, frame, sid=None):
+        """Sends a binary message that already starts with its event header,
+        like the buffers image_encoding builds, without copying it. It is
+        queued behind the messages sent with send_sync before it."""
+        self.loop.call_soon_threadsafe(
+            self.messages.put_nowait, (event, frame, sid, True)
+        )
+
     def queue_updated(self):
-        self.send_sync("status", {"status": self.get_queue_info()})
+        # called from any thread, a burst of queue changes is sent as one status
+        if not self.queue_update_pending:
+            self.queue_update_pending = True
+            self.loop.call_soon_threadsafe(self.send_queue_status)
+
+    def send_queue_status(self):
+        self.queue_update_pending = False
+        self.messages.put_nowait(("status", {"status": self.get_queue_info()}, None))
 
     async def publish_loop(self):
         while True:
@@ -566,7 +898,15 @@ class PromptServer:
             await self.send(*msg)
 
     async def start(self, address, port, verbose=True, call_on_start=None):
-        runner = web.AppRunner(self.app, access_log=None)
+        if self.metrics is not None:
+            # requests are recorded from the access log, see ServerMetrics
+            runner = web.AppRunner(
+                self.app,
+                access_log_class=self.metrics.access_log_class(),
+                access_log=logging.getLogger("aiohttp.access"),
+            )
+        else:
+            runner = web.AppRunner(self.app, access_log=None)
         await runner.setup()
         site = web.TCPSite(runner, address, port)
         await site.start()
@@ -577,17 +917,24 @@ class PromptServer:
         if call_on_start is not None:
             call_on_start(address, port)
 
-    def add_on_prompt_handler(self, handler):
-        self.on_prompt_handlers.append(handler)
+    def add_on_prompt_handler(self, handler, timeout=None, budget=None, pure=False):
+        """handler(json_data) returns the json_data to go on with, it may be
+        async. See PromptHandler for timeout, budget and pure."""
+        self.on_prompt_handlers.add(handler, timeout, budget, pure)
 
-    def trigger_on_prompt(self, json_data):
-        for handler in self.on_prompt_handlers:
-            try:
-                json_data = handler(json_data)
-            except Exception as e:
-                print(
-                    f"[ERROR] An error occurred during the on_prompt_handler processing"
-                )
-                traceback.print_exc()
+    async def trigger_on_prompt_async(self, json_data):
+        return await self.on_prompt_handlers.run(json_data)
 
-        return json_data
+    def trigger_on_prompt(self, json_data):
+        """The synchronous version upstream has. From another thread it waits
+        for trigger_on_prompt_async. On the loop, where it can't wait, it
+        calls the sync handlers inline and skips the async ones."""
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            return self.on_prompt_handlers.run_inline(json_data)
+        return asyncio.run_coroutine_threadsafe(
+            self.trigger_on_prompt_async(json_data), self.loop
+        ).result()
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+from app import app_settings
+
+
+def test_settings_are_written_after_the_posts_settle(
+    with_server, comfy_dirs, monkeypatch
+):
+    monkeypatch.setattr(app_settings, "FLUSH_DELAY", 0.05)
+    settings_file = comfy_dirs["user"] / "default" / app_settings.SETTINGS_FILE
+
+    async def test(server, client):
+        await client.post("/settings/a", json=1)
+        await client.post("/settings/b", json=2)
+        assert not settings_file.exists()
+        await asyncio.sleep(0.3)
+        assert json.loads(settings_file.read_text()) == {"a": 1, "b": 2}
+
+    with_server(test)
+
+
+def test_steady_posts_are_written_within_the_max_delay(
+    with_server, comfy_dirs, monkeypatch
+):
+    monkeypatch.setattr(app_settings, "FLUSH_DELAY", 0.1)
+    monkeypatch.setattr(app_settings, "FLUSH_MAX_DELAY", 0.25)
+    settings_file = comfy_dirs["user"] / "default" / app_settings.SETTINGS_FILE
+
+    async def test(server, client):
+        for i in range(20):
+            await client.post("/settings/a", json=i)
+            await asyncio.sleep(0.03)
+        # posts never paused for FLUSH_DELAY, but some were written
+        assert json.loads(settings_file.read_text())["a"] > 0
+
+    with_server(test)
+
+
+def test_close_writes_pending_settings(with_server, comfy_dirs):
+    settings_file = comfy_dirs["user"] / "default" / app_settings.SETTINGS_FILE
+
+    async def test(server, client):
+        await client.post("/settings/a", json="x")
+        await server.user_manager.settings.close()
+        assert json.loads(settings_file.read_text()) == {"a": "x"}
+        assert len(server.user_manager.settings.flush_tasks) == 0
+
+    with_server(test)
+
+
+def test_failed_write_is_tried_again(with_server, comfy_dirs, monkeypatch, caplog):
+    monkeypatch.setattr(app_settings, "FLUSH_DELAY", 0.01)
+    monkeypatch.setattr(app_settings, "FLUSH_RETRY_DELAY", 0.1)
+    settings_file = comfy_dirs["user"] / "default" / app_settings.SETTINGS_FILE
+    atomic_write = app_settings.atomic_write
+    attempts = []
+
+    def failing_write(path, data):
+        attempts.append(data)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+        atomic_write(path, data)
+
+    monkeypatch.setattr(app_settings, "atomic_write", failing_write)
+
+    async def test(server, client):
+        await client.post("/settings/a", json=1)
+        await asyncio.sleep(0.05)
+        assert len(attempts) == 1
+        assert not settings_file.exists()
+        assert "Unable to save settings" in caplog.text
+        assert "disk full" in caplog.text
+
+        await asyncio.sleep(0.2)
+        assert len(attempts) == 2
+        assert json.loads(settings_file.read_text()) == {"a": 1}
+
+    with_server(test)
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from app.atomic_write import atomic_write
+
+
+def test_replaces_the_file(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text("old")
+    atomic_write(str(path), '{"a": 1}')
+    assert path.read_text() == '{"a": 1}'
+    atomic_write(str(path), b"bytes")
+    assert path.read_bytes() == b"bytes"
+    assert os.listdir(tmp_path) == ["settings.json"]
+
+
+def test_failed_write_keeps_the_old_file_and_removes_the_temp(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text("old")
+    with pytest.raises(TypeError):
+        atomic_write(str(path), 1)
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["settings.json"]
+
+
+def test_missing_directory_raises(tmp_path):
+    with pytest.raises(OSError):
+        atomic_write(str(tmp_path / "missing" / "users.json"), "{}")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX permissions")
+def test_keeps_the_file_mode(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text("old")
+    os.chmod(path, 0o640)
+    atomic_write(str(path), "new")
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+    umask = os.umask(0o022)
+    try:
+        atomic_write(str(tmp_path / "new.json"), "{}")
+    finally:
+        os.umask(umask)
+    assert os.stat(tmp_path / "new.json").st_mode & 0o777 == 0o644
@@ -0,0 +1,178 @@
+import threading
+import time
+
+from app.dispatcher import Dispatcher, Job, LocalWorker, Worker
+from app.prompt_queue import ExecutionStatus, PromptQueue
+from app.stand_in_executor import StandInExecutor
+
+SUCCESS = ExecutionStatus(status_str="success", completed=True, messages=[])
+
+
+class FakeServer:
+    def __init__(self):
+        self.messages = []
+        self.last_prompt_id = None
+        self.lock = threading.Lock()
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        with self.lock:
+            self.messages.append((event, data, sid))
+
+
+class FakeWorker(Worker):
+    """Finishes prompts right away, or loses them with `error`."""
+
+    def __init__(self, name, capacity=1, error=None):
+        super().__init__(name, capacity)
+        self.error = error
+        self.submitted = []
+
+    def submit(self, job):
+        self.submitted.append(job.prompt_id)
+        if self.error is None:
+            self.dispatcher.finish(self, job, {}, SUCCESS)
+        else:
+            # what a RemoteWorker does when its backend goes away
+            self.dispatcher.set_health(self, False, self.error)
+            self.dispatcher.retry(self, job, self.error)
+
+
+def item(number, prompt_id, prompt=None, client_id=None):
+    if prompt is None:
+        prompt = {"1": {"class_type": "SaveImage", "inputs": {}}}
+    return (number, prompt_id, prompt, {"client_id": client_id}, ["1"])
+
+
+def checkpoint(name):
+    return {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt": name}}}
+
+
+def job(prompt, cost=1):
+    prompt = {**prompt, **{str(i): {} for i in range(2, cost + 1)}}
+    return Job(item(0, "p", prompt), 0)
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def start(workers, server=None):
+    server = server or FakeServer()
+    queue = PromptQueue(server)
+    dispatcher = Dispatcher(server, queue, workers)
+    dispatcher.start()
+    return server, queue, dispatcher
+
+
+def test_local_worker_runs_the_prompt():
+    server = FakeServer()
+    worker = LocalWorker("local", server, StandInExecutor)
+    server, queue, dispatcher = start([worker], server)
+
+    queue.put(item(0, "a", client_id="abc"))
+    assert wait_for(lambda: queue.get_history("a") != {})
+    assert wait_for(lambda: worker.completed == 1)
+    history = queue.get_history("a")["a"]
+    assert history["outputs"] == {"1": {}}
+    assert history["status"]["completed"]
+    assert queue.get_current_queue() == ([], [])
+    assert server.last_prompt_id == "a"
+
+    events = [(event, sid) for event, data, sid in server.messages]
+    assert events[0] == ("execution_start", "abc")
+    assert events[-1] == ("executing", "abc")
+    assert server.messages[-1][1] == {"node": None, "prompt_id": "a"}
+    # the executor's state stays with the worker
+    assert worker.relay.client_id == "abc"
+
+
+def test_least_work_prefers_the_worker_done_first():
+    fast, slow = FakeWorker("fast", capacity=4), FakeWorker("slow", capacity=4)
+    dispatcher = Dispatcher(FakeServer(), None, [slow, fast])
+    fast.node_time, slow.node_time = 1.0, 3.0
+    assert dispatcher.pick(job({})) is fast
+
+    # 4 nodes waiting on fast take longer than 1 on slow
+    fast.jobs["x"] = job({}, cost=4)
+    assert dispatcher.pick(job({})) is slow
+
+    slow.healthy = False
+    assert dispatcher.pick(job({})) is fast
+    fast.jobs.update({str(i): job({}) for i in range(3)})
+    assert dispatcher.pick(job({})) is None
+
+
+def test_affinity_keeps_models_on_one_worker():
+    workers = [FakeWorker(f"w{i}") for i in range(4)]
+    dispatcher = Dispatcher(FakeServer(), None, workers, "affinity")
+    prompts = [checkpoint(f"model{i}.safetensors") for i in range(8)]
+    picked = [dispatcher.pick(job(prompt)) for prompt in prompts]
+    assert len(set(picked)) > 1
+
+    # losing a worker only moves the prompts that were picking it
+    lost = workers[0]
+    lost.healthy = False
+    for prompt, worker in zip(prompts, picked):
+        again = dispatcher.pick(job(prompt))
+        assert again is worker or worker is lost
+
+    # a worker that ran the models last is preferred over the hash
+    lost.healthy = True
+    other = next(w for w in workers if w is not picked[0])
+    other.models = job(prompts[0]).models
+    assert dispatcher.pick(job(prompts[0])) is other
+
+    # prompts without models use least-work
+    other.node_time = 0.5
+    assert dispatcher.pick(job({})) is other
+
+
+def test_failed_backend_retries_on_another_worker():
+    broken = FakeWorker("broken", error="connection closed")
+    working = FakeWorker("working")
+    server, queue, dispatcher = start([broken, working])
+
+    queue.put(item(0, "a"))
+    assert wait_for(lambda: queue.get_history("a") != {})
+    assert broken.submitted == ["a"]
+    assert working.submitted == ["a"]
+
+    metrics = dispatcher.metrics()
+    assert metrics["broken"]["healthy"] is False
+    assert metrics["broken"]["last_error"] == "connection closed"
+    assert metrics["broken"]["failed"] == 1
+    assert wait_for(lambda: dispatcher.metrics()["working"]["completed"] == 1)
+
+    # healthy again, it gets prompts again
+    broken.error = None
+    dispatcher.set_health(broken, True)
+    dispatcher.set_health(working, False)
+    queue.put(item(1, "b"))
+    assert wait_for(lambda: queue.get_history("b") != {})
+    assert broken.submitted == ["a", "b"]
+
+
+def test_metrics():
+    worker = FakeWorker("w", capacity=2)
+    worker.jobs["x"] = job({})
+    dispatcher = Dispatcher(FakeServer(), None, [worker])
+    worker.record(job({}, cost=2), success=True)
+    worker.record(job({}), success=False)
+    metrics = dispatcher.metrics()["w"]
+    assert metrics["seconds_per_node"] is not None
+    assert metrics == {
+        "healthy": True,
+        "last_error": None,
+        "running": 1,
+        "capacity": 2,
+        "completed": 1,
+        "failed": 1,
+        "seconds_per_node": metrics["seconds_per_node"],
+        "ping": None,
+    }
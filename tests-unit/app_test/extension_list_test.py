@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+
+import folder_paths
+from app import extension_list
+from app.extension_list import ExtensionList
+
+
+@pytest.fixture
+def extensions_dir(tmp_path):
+    directory = tmp_path / "extensions"
+    (directory / "core").mkdir(parents=True)
+    (directory / "core" / "a.js").write_text("")
+    return [("/extensions", str(directory))]
+
+
+def listing(body):
+    return json.loads(body.body)
+
+
+def test_listing_is_not_checked_again_within_the_interval(extensions_dir, monkeypatch):
+    monkeypatch.setattr(folder_paths, "filename_watcher", None)
+    extensions = ExtensionList("web")
+    extensions.scan(extensions_dir)
+    assert extensions.cached(extensions_dir) is not None
+
+    new_file = extensions_dir[0][1] + "/core/b.js"
+    open(new_file, "w").close()
+    # served without looking at the disk
+    assert listing(extensions.cached(extensions_dir)) == ["/extensions/core/a.js"]
+
+    monkeypatch.setattr(extension_list, "CHECK_INTERVAL", 0)
+    assert extensions.cached(extensions_dir) is None
+    assert listing(extensions.revalidate(extensions_dir)) == [
+        "/extensions/core/a.js",
+        "/extensions/core/b.js",
+    ]
+
+
+def test_changes_are_found_without_the_model_folder_watcher(
+    extensions_dir, monkeypatch
+):
+    # whether or not --watch-model-folders is set
+    monkeypatch.setattr(folder_paths, "filename_watcher", object())
+    monkeypatch.setattr(extension_list, "CHECK_INTERVAL", 0)
+    directory = extensions_dir[0][1]
+    extensions = ExtensionList("web")
+    first = extensions.scan(extensions_dir)
+    assert extensions.revalidate(extensions_dir) is first
+
+    os.mkdir(directory + "/more")
+    open(directory + "/more/c.js", "w").close()
+    assert listing(extensions.revalidate(extensions_dir)) == [
+        "/extensions/core/a.js",
+        "/extensions/more/c.js",
+    ]
+
+    os.remove(directory + "/core/a.js")
+    assert listing(extensions.revalidate(extensions_dir)) == ["/extensions/more/c.js"]
+
+    # a root that shows up later
+    other = directory + "-other"
+    roots = extensions_dir + [("/extensions/other", other)]
+    assert listing(extensions.revalidate(roots)) == ["/extensions/more/c.js"]
+    os.mkdir(other)
+    open(other + "/d.js", "w").close()
+    assert listing(extensions.revalidate(roots)) == [
+        "/extensions/more/c.js",
+        "/extensions/other/d.js",
+    ]
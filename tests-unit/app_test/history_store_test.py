@@ -0,0 +1,150 @@
+from app.history_store import HistoryStore
+
+
+def ids(items):
+    return [prompt_id for prompt_id, text in items]
+
+
+def fill(store, count, start=0):
+    return [store.add(str(i), {"n": i}) for i in range(start, start + count)]
+
+
+def test_after_returns_what_was_added_since_the_cursor():
+    store = HistoryStore()
+    seqs = fill(store, 5)
+    assert seqs == [1, 2, 3, 4, 5]
+
+    items, cursor, more, truncated = store.after(0)
+    assert ids(items) == ["0", "1", "2", "3", "4"]
+    assert (cursor, more, truncated) == (5, False, False)
+
+    items, cursor, more, truncated = store.after(2, max_items=2)
+    assert ids(items) == ["2", "3"]
+    assert (cursor, more) == (4, True)
+    items, cursor, more, truncated = store.after(cursor, max_items=2)
+    assert ids(items) == ["4"]
+    assert (cursor, more) == (5, False)
+
+    # deleting and adding again moves the prompt to the end
+    store.delete("1")
+    assert store.after(5)[0:2] == ([], 6)
+    store.add("0", {"n": 0})
+    assert ids(store.after(6)[0]) == ["0"]
+    assert ids(store.items()) == ["2", "3", "4", "0"]
+
+
+def test_before_pages_back_from_the_newest():
+    store = HistoryStore()
+    fill(store, 5)
+    items, cursor, more = store.before(None, max_items=2)
+    assert (ids(items), cursor, more) == (["4", "3"], 4, True)
+    items, cursor, more = store.before(cursor, max_items=2)
+    assert (ids(items), cursor, more) == (["2", "1"], 2, True)
+    items, cursor, more = store.before(cursor, max_items=2)
+    assert (ids(items), cursor, more) == (["0"], 1, False)
+
+    assert ids(store.items(max_items=2)) == ["3", "4"]
+    assert ids(store.items(max_items=2, offset=1)) == ["1", "2"]
+
+
+def test_eviction_and_clears_truncate_older_cursors():
+    store = HistoryStore(max_items=3)
+    fill(store, 5)
+    assert ids(store.items()) == ["2", "3", "4"]
+    assert store.after(0)[3] is True
+    assert store.after(2)[3] is False
+
+    store.wipe()
+    assert len(store) == 0
+    items, cursor, more, truncated = store.after(3)
+    assert (items, cursor, truncated) == ([], 6, True)
+    assert store.after(5)[3] is False
+
+    # a cursor from before a restart starts over
+    fill(store, 1, start=10)
+    items, cursor, more, truncated = store.after(1000)
+    assert (ids(items), truncated) == (["10"], True)
+
+
+def test_max_size_keeps_the_newest_entry():
+    store = HistoryStore(max_items=0, max_size=40)
+    store.add("a", {"text": "x" * 20})
+    store.add("b", {"text": "x" * 20})
+    assert ids(store.items()) == ["b"]
+    store.add("c", {"text": "x" * 100})
+    assert ids(store.items()) == ["c"]
+
+
+def test_dead_slots_are_compacted():
+    store = HistoryStore(max_items=10)
+    fill(store, 200)
+    assert len(store.ids) <= 2 * len(store) + 64
+    for i in range(190, 199):
+        store.delete(str(i))
+    assert ids(store.items()) == ["199"]
+    assert ids(store.after(0)[0]) == ["199"]
+
+
+def test_log_is_replayed_and_compacted(tmp_path):
+    log_file = str(tmp_path / "history" / "history.jsonl")
+    store = HistoryStore(log_file=log_file)
+    fill(store, 3)
+    store.delete("0")
+    store.add("1", {"n": "again"})
+    cursor = store.cursor()
+
+    with open(log_file, "a") as f:
+        f.write('{"seq": 99, "id": "cut')  # a crash mid-write
+
+    loaded = HistoryStore(log_file=log_file)
+    assert loaded.decode(loaded.items()) == {"2": {"n": 2}, "1": {"n": "again"}}
+    assert loaded.cursor() == cursor
+    assert ids(loaded.after(3)[0]) == ["1"]
+
+    # the cut off line was dropped, later appends are read back
+    with open(log_file) as f:
+        assert "cut" not in f.read()
+    loaded.add("3", {"n": 3})
+    assert ids(HistoryStore(log_file=log_file).items()) == ["2", "1", "3"]
+
+    # mostly dead on startup, rewritten with only the live entries
+    fill(loaded, 150, start=100)
+    for i in range(100, 250):
+        loaded.delete(str(i))
+    reloaded = HistoryStore(log_file=log_file)
+    assert ids(reloaded.items()) == ["2", "1", "3"]
+    assert reloaded.log_lines == 3
+    with open(log_file) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_history_cursor_routes(with_server):
+    async def test(server, client):
+        history = server.prompt_queue.history
+        fill(history, 3)
+
+        response = await client.get("/history?since=1")
+        body = await response.json()
+        assert list(body["history"]) == ["1", "2"]
+        assert (body["cursor"], body["more"], body["truncated"]) == (3, False, False)
+
+        response = await client.get("/history?before=&max_items=2")
+        body = await response.json()
+        assert list(body["history"]) == ["2", "1"]
+        assert (body["cursor"], body["more"]) == (2, True)
+
+        response = await client.get("/history?max_items=1")
+        assert await response.json() == {"2": {"n": 2}}
+        response = await client.get("/history/0")
+        assert await response.json() == {"0": {"n": 0}}
+
+        response = await client.get("/history?since=x")
+        assert response.status == 400
+
+        response = await client.post("/history", json={"delete": ["2"]})
+        assert response.status == 200
+        response = await client.get("/history?since=3")
+        body = await response.json()
+        assert (body["history"], body["cursor"]) == ({}, 4)
+
+    with_server(test)
@@ -0,0 +1,103 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from app import image_encoding
+
+
+def save_png(path, image):
+    image.save(path, format="PNG")
+    return str(path)
+
+
+def test_encode_rgb_drops_alpha(tmp_path):
+    file = save_png(tmp_path / "a.png", Image.new("RGBA", (4, 3), (10, 20, 30, 40)))
+    with Image.open(BytesIO(image_encoding.encode_rgb(file))) as img:
+        assert img.mode == "RGB"
+        assert img.size == (4, 3)
+        assert img.getpixel((1, 1)) == (10, 20, 30)
+
+
+def test_encode_alpha_keeps_only_alpha(tmp_path):
+    file = save_png(tmp_path / "a.png", Image.new("RGBA", (4, 3), (10, 20, 30, 40)))
+    with Image.open(BytesIO(image_encoding.encode_alpha(file))) as img:
+        assert img.mode == "RGBA"
+        assert img.getpixel((2, 2)) == (0, 0, 0, 40)
+
+    file = save_png(tmp_path / "b.png", Image.new("RGB", (4, 3), (10, 20, 30)))
+    with Image.open(BytesIO(image_encoding.encode_alpha(file))) as img:
+        assert img.getpixel((2, 2)) == (0, 0, 0, 255)
+
+
+def baseline_composite(original_file, mask_file):
+    """What /upload/mask did before composite_mask."""
+    with Image.open(original_file) as original, Image.open(mask_file) as mask:
+        original = original.convert("RGBA")
+        original.putalpha(mask.convert("RGBA").getchannel("A"))
+        return np.asarray(original)
+
+
+def test_composite_mask_matches_the_baseline(tmp_path):
+    rng = np.random.default_rng(0)
+    rgba = rng.integers(0, 256, (5, 7, 4), dtype=np.uint8)
+    images = {
+        "RGB": Image.fromarray(rgba[:, :, :3], "RGB"),
+        "RGBA": Image.fromarray(rgba, "RGBA"),
+        "L": Image.fromarray(rgba[:, :, 0], "L"),
+        "LA": Image.fromarray(rgba[:, :, :2].copy(), "LA"),
+        "P": Image.fromarray(rgba[:, :, :3], "RGB").quantize(8),
+    }
+    transparent = images["P"].copy()
+    transparent.info["transparency"] = 3
+    masks = {**images, "P with transparency": transparent}
+
+    info = PngInfo()
+    info.add_text("prompt", "{}")
+    for original_mode, original in images.items():
+        original_file = str(tmp_path / f"{original_mode}.png")
+        original.save(original_file, format="PNG", pnginfo=info)
+        for mask_mode, mask in masks.items():
+            mask_file = save_png(tmp_path / "mask.png", mask)
+            out = str(tmp_path / "out.png")
+            image_encoding.composite_mask(original_file, mask_file, out, 4)
+            with Image.open(out) as img:
+                assert img.mode == "RGBA"
+                assert img.text == {"prompt": "{}"}
+                expected = baseline_composite(original_file, mask_file)
+                assert np.array_equal(np.asarray(img), expected), (
+                    original_mode,
+                    mask_mode,
+                )
+
+
+def test_composite_mask_of_another_size_is_rejected(tmp_path):
+    original = save_png(tmp_path / "a.png", Image.new("RGB", (4, 3)))
+    mask = save_png(tmp_path / "mask.png", Image.new("RGBA", (3, 4)))
+    with pytest.raises(ValueError):
+        image_encoding.composite_mask(original, mask, str(tmp_path / "out.png"), 4)
+    assert not (tmp_path / "out.png").exists()
+
+
+def test_view_channel_is_cached_and_revalidated(with_server, comfy_dirs):
+    save_png(comfy_dirs["output"] / "a.png", Image.new("RGBA", (8, 8), (1, 2, 3, 4)))
+
+    async def test(server, client):
+        response = await client.get("/view?filename=a.png&channel=rgb")
+        assert response.status == 200
+        assert response.headers["Content-Type"] == "image/png"
+        with Image.open(BytesIO(await response.read())) as img:
+            assert img.getpixel((0, 0)) == (1, 2, 3)
+
+        etag = response.headers["ETag"]
+        response = await client.get(
+            "/view?filename=a.png&channel=rgb", headers={"If-None-Match": etag}
+        )
+        assert response.status == 304
+
+        response = await client.get("/view?filename=a.png&channel=a")
+        assert response.headers["ETag"] != etag
+
+    with_server(test)
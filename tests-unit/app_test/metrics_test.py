@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from app.metrics import SIZE_BUCKETS, ServerMetrics
+from comfy.cli_args import args
+from server import BinaryEventTypes
+
+
+async def streamed(request):
+    response = web.StreamResponse()
+    await response.prepare(request)
+    for _ in range(3):
+        await response.write(b"x" * 1000)
+    await response.write_eof()
+    return response
+
+
+async def sized(request):
+    return web.Response(body=b"y" * 300)
+
+
+async def not_modified(request):
+    return web.Response(status=304, headers={"ETag": '"a"'})
+
+
+def test_response_size_counts_payload_bytes_only():
+    metrics = ServerMetrics(None)
+    app = web.Application()
+    app.router.add_get("/streamed", streamed)
+    app.router.add_get("/sized", sized)
+    app.router.add_get("/not_modified", not_modified)
+    app.on_response_prepare.append(metrics.on_response_prepare)
+
+    async def main():
+        server = TestServer(app)
+        await server.start_server(
+            access_log_class=metrics.access_log_class(),
+            access_log=logging.getLogger("aiohttp.access"),
+        )
+        async with TestClient(server) as client:
+            for path in ("/streamed", "/sized", "/not_modified"):
+                response = await client.get(path)
+                await response.read()
+            response = await client.head("/sized")
+            await response.read()
+        # the access log runs after the response is sent
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    size = lambda route: metrics.requests[("GET", route)].size.sum
+    assert size("/streamed") == 3000
+    assert size("/sized") == 300
+    assert size("/not_modified") == 0
+    assert metrics.requests[("HEAD", "/sized")].size.sum == 0
+    assert (
+        dict(metrics.requests[("GET", "/streamed")].size.cumulative())[SIZE_BUCKETS[2]]
+        == 1
+    )
+
+
+def test_websocket_metrics(with_server, monkeypatch):
+    monkeypatch.setattr(args, "enable_metrics", True)
+
+    async def test(server, client):
+        monkeypatch.setattr(
+            server.broadcaster, "queue_depths", lambda: {"a": 3, "b": 5, "c": 0}
+        )
+        await server.send_json("progress", {"value": "é"})
+        await server.send_bytes(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, b"xyz")
+        text = await (await client.get("/metrics")).text()
+        lines = text.splitlines()
+        assert "comfyui_websocket_send_queue_depth_max 5" in lines
+        assert "comfyui_websocket_send_queue_depth_total 8" in lines
+        assert "client=" not in text
+
+        size = len(json.dumps({"type": "progress", "data": {"value": "é"}}).encode())
+        assert server.metrics.messages["progress"] == [1, size]
+        event = BinaryEventTypes.UNENCODED_PREVIEW_IMAGE
+        assert server.metrics.messages[event] == [1, 7]
+
+    with_server(test)
@@ -0,0 +1,117 @@
+import asyncio
+import os
+
+from app.preview_cache import PreviewCache
+
+
+async def run_io(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def encoder(data, calls):
+    async def encode():
+        calls.append(data)
+        await asyncio.sleep(0.01)
+        return data
+
+    return encode
+
+
+def get_or_encode(cache, key, data, calls):
+    return asyncio.run(cache.get_or_encode(key, encoder(data, calls), run_io))
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PreviewCache(max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa" and cache.get("c") == b"cccc"
+    assert cache.size == 8
+
+    cache.put("big", b"x" * 11)
+    assert cache.get("big") is None
+    assert cache.size == 8
+
+
+def test_concurrent_misses_encode_once():
+    cache = PreviewCache(max_bytes=100)
+    calls = []
+
+    async def main():
+        encode = encoder(b"data", calls)
+        return await asyncio.gather(
+            *(cache.get_or_encode("key", encode, run_io) for _ in range(5))
+        )
+
+    assert asyncio.run(main()) == [b"data"] * 5
+    assert calls == [b"data"]
+    assert (cache.hits, cache.misses) == (4, 1)
+    assert cache.loading == {}
+
+    # and a failed encode isn't cached
+    async def fail():
+        raise ValueError("broken")
+
+    async def failing():
+        try:
+            await cache.get_or_encode("other", fail, run_io)
+        except ValueError:
+            return True
+
+    assert asyncio.run(failing())
+    assert cache.loading == {} and cache.get("other") is None
+
+
+def test_disk_tier_is_used_after_a_restart(tmp_path):
+    disk_dir = str(tmp_path / "previews")
+    cache = PreviewCache(max_bytes=100, disk_dir=disk_dir, max_disk_bytes=10)
+    calls = []
+    assert get_or_encode(cache, "a", b"aaaa", calls) == b"aaaa"
+    assert get_or_encode(cache, "b", b"bbbb", calls) == b"bbbb"
+    assert len(os.listdir(disk_dir)) == 2
+
+    (tmp_path / "previews" / "crashed.tmp").write_bytes(b"x")
+    restarted = PreviewCache(max_bytes=100, disk_dir=disk_dir, max_disk_bytes=10)
+    assert not (tmp_path / "previews" / "crashed.tmp").exists()
+    assert get_or_encode(restarted, "a", b"new", calls) == b"aaaa"
+    assert calls == [b"aaaa", b"bbbb"]
+    assert restarted.hits == 1
+
+    # over max_disk_bytes the least recently used file is removed
+    get_or_encode(restarted, "c", b"cccc", calls)
+    on_disk = lambda key: os.path.exists(restarted.disk_path(restarted.digest(key)))
+    assert (on_disk("a"), on_disk("b"), on_disk("c")) == (True, False, True)
+
+
+def test_failed_disk_write_leaves_no_temp_file(tmp_path, monkeypatch):
+    disk_dir = str(tmp_path / "previews")
+    cache = PreviewCache(max_bytes=100, disk_dir=disk_dir, max_disk_bytes=100)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    cache.put_disk("a", b"aaaa")
+    assert os.listdir(disk_dir) == []
+    assert cache.disk_entries == {}
+
+
+def test_changed_source_file_gets_a_new_key(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"old")
+    first = PreviewCache.make_key(str(path), os.stat(path), "encode_rgb")
+
+    cache = PreviewCache(max_bytes=100)
+    calls = []
+    get_or_encode(cache, first, b"old preview", calls)
+
+    path.write_bytes(b"new!")
+    os.utime(path, (0, os.stat(path).st_mtime + 10))
+    second = PreviewCache.make_key(str(path), os.stat(path), "encode_rgb")
+    assert second != first
+    assert cache.etag(second) != cache.etag(first)
+    assert get_or_encode(cache, second, b"new preview", calls) == b"new preview"
+    assert calls == [b"old preview", b"new preview"]
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from app.prompt_handlers import PromptHandlers
+
+
+async def run_io(route, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def add_key(key):
+    def handler(json_data):
+        return {**json_data, key: True}
+
+    return handler
+
+
+def test_handlers_can_be_appended_like_a_list():
+    handlers = PromptHandlers(run_io)
+    first = add_key("a")
+    handlers.append(first)
+    handlers.append(add_key("b"))
+    assert len(handlers) == 2
+    assert list(handlers)[0] is first
+    assert asyncio.run(handlers.run({})) == {"a": True, "b": True}
+
+
+def test_failing_and_slow_handlers_leave_the_prompt_as_it_was():
+    def fails(json_data):
+        raise ValueError("broken")
+
+    def slow(json_data):
+        time.sleep(0.5)
+        json_data["slow"] = True
+        return json_data
+
+    async def main():
+        handlers = PromptHandlers(run_io)
+        handlers.add(fails)
+        handlers.add(slow, timeout=0.05)
+        handlers.add(add_key("after"))
+        prompt = {"prompt": 1}
+        assert await handlers.run(prompt) == {"prompt": 1, "after": True}
+        # the abandoned handler got a copy
+        await asyncio.sleep(0.6)
+        assert prompt == {"prompt": 1}
+        assert [h.errors for h in handlers.handlers] == [1, 0, 0]
+        assert [h.timeouts for h in handlers.handlers] == [0, 1, 0]
+
+    asyncio.run(main())
+
+
+def test_pure_handler_runs_once_per_prompt():
+    calls = []
+
+    async def pure(json_data):
+        calls.append(json_data)
+        await asyncio.sleep(0.01)
+        return {**json_data, "seen": len(calls)}
+
+    async def main():
+        handlers = PromptHandlers(run_io)
+        handlers.add(pure, pure=True)
+        results = await asyncio.gather(*(handlers.run({"a": 1}) for _ in range(3)))
+        assert results == [{"a": 1, "seen": 1}] * 3
+        assert await handlers.run({"a": 2}) == {"a": 2, "seen": 2}
+
+    asyncio.run(main())
+
+
+def test_sync_trigger_on_prompt(with_server):
+    async def test(server, client):
+        async def async_handler(json_data):
+            return {**json_data, "async": True}
+
+        server.on_prompt_handlers.append(add_key("sync"))
+        server.add_on_prompt_handler(async_handler)
+
+        # from another thread it runs the whole pipeline on the loop
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, server.trigger_on_prompt, {})
+        assert result == {"sync": True, "async": True}
+
+        # on the loop it can't wait for the async handler
+        assert server.trigger_on_prompt({}) == {"sync": True}
+        assert await server.trigger_on_prompt_async({}) == {
+            "sync": True,
+            "async": True,
+        }
+
+    with_server(test)
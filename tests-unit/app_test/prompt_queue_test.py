@@ -0,0 +1,128 @@
+from app.prompt_queue import ExecutionStatus, PromptQueue, validate_prompt
+
+SAVE_PROMPT = {"1": {"class_type": "SaveImage", "inputs": {}}}
+
+
+class FakeServer:
+    def __init__(self):
+        self.updates = 0
+
+    def queue_updated(self):
+        self.updates += 1
+
+
+def item(number, prompt_id):
+    return (number, prompt_id, {}, {}, [])
+
+
+def pending_ids(queue):
+    return [i[1] for i in queue.get_current_queue()[1]]
+
+
+def test_items_run_in_number_order():
+    queue = PromptQueue(FakeServer())
+    for number, prompt_id in ((2, "c"), (0, "a"), (1, "b"), (-1, "front")):
+        queue.put(item(number, prompt_id))
+    assert pending_ids(queue) == ["front", "a", "b", "c"]
+    assert [queue.get()[0][1] for _ in range(4)] == ["front", "a", "b", "c"]
+    assert queue.get(timeout=0) is None
+
+
+def test_deleted_items_are_skipped_and_the_heap_rebuilt():
+    queue = PromptQueue(FakeServer())
+    for number in range(10):
+        queue.put(item(number, str(number)))
+    assert queue.delete_queue_items(["0", "2", "3"])
+    assert not queue.delete_queue_items(["0", "missing"])
+    assert queue.delete_queue_item(lambda i: i[1] == "5")
+    assert pending_ids(queue) == ["1", "4", "6", "7", "8", "9"]
+    assert queue.get_tasks_remaining() == 6
+
+    # more stale entries than live ones rebuilds the heap
+    assert queue.delete_queue_items(["1", "4", "6"])
+    assert queue.stale == 0
+    assert len(queue.queue) == 3
+    assert [queue.get()[0][1] for _ in range(3)] == ["7", "8", "9"]
+
+
+def test_putting_a_prompt_again_replaces_it():
+    queue = PromptQueue(FakeServer())
+    queue.put(item(5, "a"))
+    queue.put(item(1, "b"))
+    queue.put(item(0, "a"))
+    assert pending_ids(queue) == ["a", "b"]
+    assert [queue.get()[0][1] for _ in range(2)] == ["a", "b"]
+    assert queue.get(timeout=0) is None
+
+
+def test_requeue_keeps_the_place_and_task_done_adds_history():
+    queue = PromptQueue(FakeServer())
+    queue.put(item(1, "a"))
+    queue.put(item(2, "b"))
+    running, item_id = queue.get()
+    assert queue.get_current_queue()[0] == [running]
+    queue.requeue(item_id)
+    assert pending_ids(queue) == ["a", "b"]
+
+    running, item_id = queue.get()
+    queue.task_done(item_id, {"1": {}}, ExecutionStatus("success", True, []))
+    assert queue.get_current_queue() == ([], [item(2, "b")])
+    history = queue.get_history("a")
+    assert history["a"]["status"]["status_str"] == "success"
+    assert history["a"]["prompt"] == list(running)
+
+
+def test_snapshot_is_reused_until_the_queue_changes():
+    server = FakeServer()
+    queue = PromptQueue(server)
+    queue.put(item(1, "a"))
+    first = queue.get_current_queue()[1]
+    assert queue.snapshot is not None
+    assert queue.get_current_queue()[1] == first
+    updates = server.updates
+    queue.put(item(0, "b"))
+    assert queue.snapshot is None
+    assert server.updates == updates + 1
+
+
+def test_validate_prompt():
+    assert validate_prompt(SAVE_PROMPT) == (True, None, ["1"], {})
+    valid, error, _, _ = validate_prompt({"1": {"class_type": "NoSuchNode"}})
+    assert not valid and error["type"] == "invalid_prompt"
+    valid, error, _, _ = validate_prompt({"1": {"class_type": "LoadImage"}})
+    assert not valid and error["type"] == "prompt_no_outputs"
+
+
+def test_posted_prompts_are_queued_in_order(with_server):
+    async def test(server, client):
+        ids = []
+        for body in ({}, {}, {"front": True}, {"number": 100}):
+            response = await client.post(
+                "/prompt", json={**body, "prompt": SAVE_PROMPT}
+            )
+            assert response.status == 200
+            ids.append((await response.json())["prompt_id"])
+
+        response = await client.get("/queue")
+        queue = await response.json()
+        assert queue["queue_running"] == []
+        assert [i[1] for i in queue["queue_pending"]] == [
+            ids[2],
+            ids[0],
+            ids[1],
+            ids[3],
+        ]
+
+        response = await client.post("/queue", json={"delete": [ids[0]]})
+        assert response.status == 200
+        response = await client.get("/queue")
+        pending = (await response.json())["queue_pending"]
+        assert [i[1] for i in pending] == [ids[2], ids[1], ids[3]]
+
+        response = await client.get("/prompt")
+        assert (await response.json())["exec_info"]["queue_remaining"] == 3
+
+        response = await client.post("/prompt", json={"prompt": {"1": {}}})
+        assert response.status == 400
+
+    with_server(test)
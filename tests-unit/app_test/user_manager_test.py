@@ -0,0 +1,92 @@
+import atexit
+import json
+import threading
+import uuid
+
+import pytest
+
+from app import user_manager
+from comfy.cli_args import args
+
+
+@pytest.fixture
+def multi_user(comfy_dirs, monkeypatch):
+    monkeypatch.setattr(args, "multi_user", True)
+    return comfy_dirs["user"] / "users.json"
+
+
+def test_duplicate_usernames_are_rejected(with_server, multi_user):
+    async def test(server, client):
+        response = await client.post("/users", json={"username": "alice"})
+        user_id = await response.json()
+        assert user_id.startswith("alice_")
+        for name in ("alice", " alice "):
+            response = await client.post("/users", json={"username": name})
+            assert response.status == 400
+        response = await client.post("/users", json={"username": "bob"})
+        assert response.status == 200
+        assert set(json.loads(multi_user.read_text()).values()) == {"alice", "bob"}
+
+    with_server(test)
+
+    # and after a restart, from users.json
+    manager = user_manager.UserManager()
+    assert set(manager.user_names) == {"alice", "bob"}
+
+
+def test_registrations_are_written_together(multi_user, monkeypatch):
+    writes = []
+    first_write = threading.Event()
+    release = threading.Event()
+
+    def slow_write(path, data):
+        writes.append(json.loads(data))
+        first_write.set()
+        release.wait(5)
+
+    monkeypatch.setattr(user_manager, "atomic_write", slow_write)
+    manager = user_manager.UserManager()
+    manager.add_user("a")
+    threads = [threading.Thread(target=manager.save_users)]
+    threads[0].start()
+    assert first_write.wait(5)
+
+    # these wait on the first write and go out in one
+    manager.add_user("b")
+    manager.add_user("c")
+    threads += [threading.Thread(target=manager.save_users) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [sorted(users.values()) for users in writes] == [["a"], ["a", "b", "c"]]
+    manager.save_users()
+    assert len(writes) == 2
+
+
+def test_unsaved_registrations_are_written_at_exit(multi_user, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", registered.append)
+    manager = user_manager.UserManager()
+    assert manager.save_users in registered
+
+    user_id = manager.add_user("a")
+    assert not multi_user.exists()
+    for function in registered:
+        function()
+    assert json.loads(multi_user.read_text()) == {user_id: "a"}
+
+
+def test_add_user_forgets_a_memoized_directory(multi_user, monkeypatch):
+    monkeypatch.setattr(uuid, "uuid4", lambda: "fixed")
+    manager = user_manager.UserManager()
+    manager.user_roots["a_fixed"] = "/stale"
+
+    user_id = manager.add_user("a")
+    assert user_id == "a_fixed"
+    assert "a_fixed" not in manager.user_roots
+    assert manager.get_user_root(user_id) == str(multi_user.parent / user_id)
+    assert manager.user_roots[user_id] == str(multi_user.parent / user_id)
+    manager.save_users()
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import folder_paths
+from app import route_executor, user_manager
+
+
+@pytest.fixture
+def comfy_dirs(tmp_path, monkeypatch):
+    """Points the input, output, temp and user directories at tmp_path."""
+    dirs = {}
+    for name in ("input", "output", "temp", "user"):
+        dirs[name] = tmp_path / name
+        dirs[name].mkdir()
+    monkeypatch.setattr(folder_paths, "input_directory", str(dirs["input"]))
+    monkeypatch.setattr(folder_paths, "output_directory", str(dirs["output"]))
+    monkeypatch.setattr(folder_paths, "temp_directory", str(dirs["temp"]))
+    monkeypatch.setattr(folder_paths, "user_directory", str(dirs["user"]))
+    monkeypatch.setattr(user_manager, "user_directory", str(dirs["user"]))
+    monkeypatch.setattr(user_manager, "users_file", str(dirs["user"] / "users.json"))
+    return dirs
+
+
+@pytest.fixture
+def model_folders(tmp_path, monkeypatch):
+    """Registers the folder name "test_models" with two roots under tmp_path
+    and gives folder_paths fresh caches and a model index file there."""
+    roots = [tmp_path / "models_a", tmp_path / "models_b"]
+    for root in roots:
+        root.mkdir()
+    monkeypatch.setitem(
+        folder_paths.folder_names_and_paths,
+        "test_models",
+        ([str(root) for root in roots], {".safetensors"}),
+    )
+    monkeypatch.setattr(folder_paths, "filename_list_cache", {})
+    monkeypatch.setattr(folder_paths, "filename_index", {})
+    monkeypatch.setattr(folder_paths, "filename_watcher", None)
+    monkeypatch.setattr(folder_paths, "directory_cache", {})
+    monkeypatch.setattr(
+        folder_paths, "directory_cache_file", str(tmp_path / "model_index.json")
+    )
+    return roots
+
+
+@pytest.fixture
+def with_server(comfy_dirs, monkeypatch):
+    """Runs `await test(server, client)` against a PromptServer with its
+    routes added, on its own event loop."""
+    # its semaphores belong to the loop of the test that created them
+    monkeypatch.setattr(route_executor, "route_executor", None)
+
+    def run(test):
+        async def main():
+            import server
+
+            prompt_server = server.PromptServer(asyncio.get_running_loop())
+            prompt_server.add_routes()
+            client = TestClient(TestServer(prompt_server.app))
+            await client.start_server()
+            try:
+                await test(prompt_server, client)
+            finally:
+                await client.close()
+
+        asyncio.run(main())
+
+    return run
@@ -0,0 +1,135 @@
+import asyncio
+import importlib.util
+import os
+import struct
+import sys
+import types
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import comfy
+import server as server_module
+
+NODE_PATH = os.path.join(
+    os.path.dirname(server_module.__file__), "custom_nodes", "websocket_image_save.py"
+)
+
+
+class StubTensor:
+    """The few torch.Tensor methods the node uses, over a numpy array."""
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def detach(self):
+        return self
+
+    def mul(self, value):
+        return StubTensor(self.array * value)
+
+    def clamp_(self, low, high):
+        np.clip(self.array, low, high, out=self.array)
+        return self
+
+    def byte(self):
+        return StubTensor(self.array.astype(np.uint8))
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class ProgressBar:
+    updates = []
+
+    def __init__(self, total):
+        self.total = total
+
+    def update_absolute(self, value, total=None, preview=None):
+        self.updates.append((value, total, preview))
+
+
+@pytest.fixture
+def node_module(monkeypatch):
+    """Loads the node with a comfy.utils that only has a ProgressBar."""
+    utils = types.ModuleType("comfy.utils")
+    utils.ProgressBar = ProgressBar
+    monkeypatch.setitem(sys.modules, "comfy.utils", utils)
+    monkeypatch.setattr(comfy, "utils", utils, raising=False)
+    monkeypatch.setattr(ProgressBar, "updates", [])
+
+    spec = importlib.util.spec_from_file_location("websocket_image_save", NODE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def batch():
+    images = np.random.default_rng(0).random((2, 4, 5, 3), dtype=np.float32)
+    images[0, 0, 0] = [1.5, -0.5, 1.0]  # out of range values are clipped
+    expected = (np.clip(images, 0, 1) * 255).astype(np.uint8)
+    return StubTensor(images), expected
+
+
+def test_frames_are_sent_to_the_client(node_module, with_server):
+    images, expected = batch()
+
+    async def test(server, client):
+        publish = asyncio.create_task(server.publish_loop())
+        ws = await client.ws_connect("/ws?clientId=abc")
+        await ws.receive_json(timeout=5)
+        server.client_id = "abc"
+
+        node = node_module.SaveImageWebsocket()
+        loop = asyncio.get_running_loop()
+        assert await loop.run_in_executor(None, node.save_images, images) == {}
+
+        for pixels in expected:
+            message = await ws.receive_bytes(timeout=5)
+            event = server_module.BinaryEventTypes.PREVIEW_IMAGE
+            assert message[:8] == struct.pack(">II", event, 2)
+            with Image.open(BytesIO(message[8:])) as img:
+                assert img.format == "PNG"
+                assert np.array_equal(np.asarray(img), pixels)
+        await ws.close()
+        publish.cancel()
+
+    with_server(test)
+    assert ProgressBar.updates == [(0, 2, None), (1, 2, None)]
+
+
+def check_previews(expected, image_format):
+    assert [u[:2] for u in ProgressBar.updates] == [(0, 2), (1, 2)]
+    for (_, _, preview), pixels in zip(ProgressBar.updates, expected):
+        assert preview[0] == image_format and preview[2] is None
+        assert np.array_equal(np.asarray(preview[1]), pixels)
+
+
+def test_falls_back_to_previews_without_send_frame_sync(node_module, monkeypatch):
+    # an upstream server
+    monkeypatch.setattr(
+        node_module.PromptServer, "instance", types.SimpleNamespace(client_id=None)
+    )
+    images, expected = batch()
+    node_module.SaveImageWebsocket().save_images(images, format="JPEG")
+    check_previews(expected, "JPEG")
+
+
+def test_falls_back_to_previews_without_encode_image_frame(node_module, monkeypatch):
+    monkeypatch.setattr(node_module, "encode_image_frame", None)
+    monkeypatch.setattr(
+        node_module.PromptServer, "instance", types.SimpleNamespace(client_id=None)
+    )
+    images, expected = batch()
+    # the preview path doesn't know WEBP
+    node_module.SaveImageWebsocket().save_images(images, format="WEBP")
+    check_previews(expected, "PNG")
@@ -0,0 +1,89 @@
+import json
+import os
+
+import folder_paths
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+
+
+def files():
+    return folder_paths.get_filename_list("test_models")
+
+
+def restart(monkeypatch):
+    """Forgets everything in memory and loads model_index.json again."""
+    monkeypatch.setattr(folder_paths, "filename_list_cache", {})
+    monkeypatch.setattr(folder_paths, "directory_cache", {})
+    folder_paths.load_directory_cache()
+
+
+def count_listings(monkeypatch):
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    return listed
+
+
+def test_index_is_reused_after_a_restart(model_folders, monkeypatch):
+    a, b = model_folders
+    touch(a / "m.safetensors")
+    touch(a / "sub" / "n.safetensors")
+    touch(b / "o.safetensors")
+    expected = files()
+    with open(folder_paths.directory_cache_file) as f:
+        assert json.load(f)["version"] == 1
+
+    restart(monkeypatch)
+    assert "test_models" in folder_paths.directory_cache
+    listed = count_listings(monkeypatch)
+    assert files() == expected
+    assert listed == []
+
+
+def test_changed_directories_are_listed_again(model_folders, monkeypatch):
+    a, b = model_folders
+    touch(a / "sub" / "n.safetensors")
+    touch(a / "other" / "o.safetensors")
+    files()
+
+    touch(a / "sub" / "new.safetensors")
+    os.utime(a / "sub", (0, os.stat(a / "sub").st_mtime + 10))
+    restart(monkeypatch)
+    listed = count_listings(monkeypatch)
+    assert os.path.join("sub", "new.safetensors") in files()
+    assert listed == [str(a / "sub")]
+
+
+def test_index_for_other_extensions_is_not_used(model_folders, monkeypatch):
+    touch(model_folders[0] / "m.safetensors")
+    files()
+    restart(monkeypatch)
+    assert folder_paths.get_cached_dirs("test_models", [".ckpt"]) == {}
+    assert folder_paths.get_cached_dirs("test_models", {".safetensors"}) != {}
+
+
+def test_corrupt_or_unknown_index_is_ignored(model_folders, monkeypatch):
+    touch(model_folders[0] / "m.safetensors")
+    expected = files()
+    index_file = folder_paths.directory_cache_file
+    with open(index_file) as f:
+        data = json.load(f)
+
+    for contents in ('{"version": 1, "folders": {', json.dumps({**data, "version": 2})):
+        with open(index_file, "w") as f:
+            f.write(contents)
+        restart(monkeypatch)
+        assert folder_paths.directory_cache == {}
+        assert files() == expected
+
+    # and written again in the current format
+    with open(index_file) as f:
+        assert json.load(f)["version"] == 1
@@ -0,0 +1,191 @@
+import os
+import time
+
+import pytest
+
+import folder_paths
+from app import fs_watcher
+
+
+class FakeWatcher:
+    """Records the watched folders, events are delivered by emit()."""
+
+    def __init__(self, max_watches=None):
+        self.callbacks = {}
+        self.max_watches = max_watches
+
+    def watch(self, path, callback):
+        if self.max_watches is not None and len(self.callbacks) >= self.max_watches:
+            return False
+        callbacks = self.callbacks.setdefault(path, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+        return True
+
+    def unsubscribe(self, callback):
+        for callbacks in self.callbacks.values():
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def emit(self, kind, path, is_dir=False):
+        path = str(path)
+        if kind == "deleted" and is_dir:
+            # like InotifyWatcher, a directory that's gone loses its watches
+            prefix = os.path.join(path, "")
+            for p in [p for p in self.callbacks if p == path or p.startswith(prefix)]:
+                del self.callbacks[p]
+        for callback in list(self.callbacks.get(os.path.dirname(path), [])):
+            callback(kind, path, is_dir)
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    return path
+
+
+def files():
+    return folder_paths.get_filename_list("test_models")
+
+
+@pytest.fixture
+def watcher(model_folders, monkeypatch):
+    watcher = FakeWatcher()
+    monkeypatch.setattr(folder_paths, "filename_watcher", watcher)
+    return watcher
+
+
+def test_created_and_deleted_files(model_folders, watcher):
+    a, b = model_folders
+    touch(a / "x.safetensors")
+    touch(b / "x.safetensors")
+    touch(b / "y.safetensors")
+    assert files() == ["x.safetensors", "y.safetensors"]
+    assert folder_paths.filename_index["test_models"].watched
+
+    watcher.emit("created", touch(a / "new.safetensors"))
+    watcher.emit("created", touch(a / "notes.txt"))
+    assert files() == ["new.safetensors", "x.safetensors", "y.safetensors"]
+
+    # still in the other root
+    os.remove(a / "x.safetensors")
+    watcher.emit("deleted", a / "x.safetensors")
+    assert files() == ["new.safetensors", "x.safetensors", "y.safetensors"]
+    os.remove(b / "x.safetensors")
+    watcher.emit("deleted", b / "x.safetensors")
+    assert files() == ["new.safetensors", "y.safetensors"]
+
+
+def test_created_directory_is_listed_and_watched(model_folders, watcher):
+    a, b = model_folders
+    assert files() == []
+
+    touch(a / "sdxl" / "base" / "m.safetensors")
+    touch(a / "sdxl" / ".git" / "objects.safetensors")
+    watcher.emit("created", a / "sdxl", is_dir=True)
+    assert files() == [os.path.join("sdxl", "base", "m.safetensors")]
+    assert str(a / "sdxl" / "base") in watcher.callbacks
+    assert str(a / "sdxl" / ".git") not in watcher.callbacks
+
+    watcher.emit("created", touch(a / "sdxl" / "base" / "n.safetensors"))
+    assert len(files()) == 2
+    watcher.emit("created", a / "sdxl" / ".git", is_dir=True)
+    assert len(files()) == 2
+
+
+def test_directory_moved_out_and_back(model_folders, watcher, tmp_path):
+    a, b = model_folders
+    touch(a / "sub" / "m.safetensors")
+    touch(a / "sub" / "deeper" / "n.safetensors")
+    touch(a / "top.safetensors")
+    listed = files()
+    assert len(listed) == 3
+
+    os.rename(a / "sub", tmp_path / "elsewhere")
+    watcher.emit("deleted", a / "sub", is_dir=True)
+    assert files() == ["top.safetensors"]
+    assert str(a / "sub" / "deeper") not in watcher.callbacks
+
+    os.rename(tmp_path / "elsewhere", a / "sub")
+    watcher.emit("created", a / "sub", is_dir=True)
+    assert files() == listed
+    watcher.emit("created", touch(a / "sub" / "deeper" / "o.safetensors"))
+    assert len(files()) == 4
+
+
+def test_overflow_rebuilds_the_index(model_folders, watcher):
+    a, b = model_folders
+    assert files() == []
+    index = folder_paths.filename_index["test_models"]
+
+    touch(a / "missed.safetensors")
+    watcher.emit("overflow", a / "unknown")
+    assert not index.valid
+    assert files() == ["missed.safetensors"]
+    assert folder_paths.filename_index["test_models"] is not index
+
+
+def test_index_hits_dont_touch_the_disk(model_folders, watcher, monkeypatch):
+    touch(model_folders[0] / "a.safetensors")
+    assert files() == ["a.safetensors"]
+
+    def fail(*args):
+        raise AssertionError("the disk was checked")
+
+    monkeypatch.setattr(os, "scandir", fail)
+    monkeypatch.setattr(os.path, "getmtime", fail)
+    assert files() == ["a.safetensors"]
+
+
+def test_mtime_checks_without_enough_watches(model_folders, monkeypatch):
+    a, b = model_folders
+    monkeypatch.setattr(folder_paths, "filename_watcher", FakeWatcher(max_watches=1))
+    touch(a / "m.safetensors")
+    assert files() == ["m.safetensors"]
+    assert not folder_paths.filename_index["test_models"].watched
+
+    # no events, the folder's mtime changed
+    touch(b / "n.safetensors")
+    assert files() == ["m.safetensors", "n.safetensors"]
+
+
+def test_mtime_checks_without_inotify(model_folders, monkeypatch):
+    monkeypatch.setattr(fs_watcher, "is_supported", lambda: False)
+    monkeypatch.setattr(fs_watcher, "watcher", None)
+    assert not folder_paths.enable_filesystem_watcher()
+    assert folder_paths.filename_watcher is None
+
+    a, b = model_folders
+    touch(a / "m.safetensors")
+    assert files() == ["m.safetensors"]
+    touch(a / "sub" / "n.safetensors")
+    assert files() == ["m.safetensors", os.path.join("sub", "n.safetensors")]
+    assert folder_paths.filename_index == {}
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.skipif(not fs_watcher.is_supported(), reason="needs inotify")
+def test_inotify_events_update_the_index(model_folders, monkeypatch, tmp_path):
+    if fs_watcher.get_watcher() is None:
+        pytest.skip("inotify is not available")
+    assert folder_paths.enable_filesystem_watcher()
+    a, b = model_folders
+    assert files() == []
+
+    touch(a / "m.safetensors")
+    assert wait_for(lambda: files() == ["m.safetensors"])
+
+    touch(tmp_path / "outside" / "n.safetensors")
+    os.rename(tmp_path / "outside", b / "moved")
+    moved = os.path.join("moved", "n.safetensors")
+    assert wait_for(lambda: files() == ["m.safetensors", moved])
+
+    os.rename(b / "moved", tmp_path / "outside")
+    os.remove(a / "m.safetensors")
+    assert wait_for(lambda: files() == [])
@@ -0,0 +1,67 @@
+import os
+
+import folder_paths
+
+EXTENSIONS = {".safetensors"}
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+
+
+def serial_walk(root, excluded_dir_names):
+    """What the search did before it was parallel, os.walk in one thread."""
+    files = []
+    dirs = []
+    for dirpath, subdirs, filenames in os.walk(root, followlinks=True):
+        subdirs[:] = [d for d in subdirs if d not in excluded_dir_names]
+        dirs.append(dirpath)
+        relative_dir = os.path.relpath(dirpath, root)
+        for name in filenames:
+            if folder_paths.file_has_extension(name, EXTENSIONS):
+                files.append(os.path.normpath(os.path.join(relative_dir, name)))
+    return files, dirs
+
+
+def make_tree(root, name):
+    touch(root / f"{name}.safetensors")
+    touch(root / "shared.safetensors")
+    touch(root / "skip.txt")
+    for i in range(12):
+        touch(root / f"dir{i}" / f"{name}{i}.safetensors")
+        touch(root / f"dir{i}" / "nested" / "deep" / f"{name}{i}.safetensors")
+        touch(root / f"dir{i}" / ".git" / f"{name}{i}.safetensors")
+    touch(root / ".git" / "objects.safetensors")
+
+
+def test_parallel_scan_matches_the_serial_walk(model_folders, tmp_path):
+    roots = model_folders + [tmp_path / "missing"]
+    make_tree(roots[0], "a")
+    make_tree(roots[1], "b")
+    touch(roots[1] / "dir3" / "a3.safetensors")  # also in the first root
+
+    output = folder_paths.scan_folder_roots(
+        [str(root) for root in roots], EXTENSIONS, {}, [".git"]
+    )
+    assert [x for x, files, dirs in output] == [str(root) for root in roots[:2]]
+    for x, files, dirs in output:
+        serial_files, serial_dirs = serial_walk(x, [".git"])
+        assert files == serial_files
+        assert sorted(dirs) == sorted(serial_dirs)
+        assert not any(".git" in f for f in files)
+
+    merged = folder_paths.get_filename_list("test_models")
+    assert merged == sorted(
+        set(serial_walk(roots[0], [".git"])[0] + serial_walk(roots[1], [".git"])[0])
+    )
+    assert merged.count(os.path.join("dir3", "a3.safetensors")) == 1
+    assert merged.count("shared.safetensors") == 1
+
+
+def test_cached_listings_give_the_same_result(model_folders):
+    make_tree(model_folders[0], "a")
+    roots = [str(model_folders[0])]
+    first = folder_paths.scan_folder_roots(roots, EXTENSIONS, {}, [".git"])
+    cached = folder_paths.scan_folder_roots(roots, EXTENSIONS, first[0][2], [".git"])
+    assert cached == first
@@ -0,0 +1,81 @@
+import asyncio
+import gzip
+import json
+
+import nodes
+from app.response_cache import JSONResponseCache
+
+
+def test_object_info_is_revalidated_by_etag(with_server):
+    async def test(server, client):
+        response = await client.get(
+            "/object_info", headers={"Accept-Encoding": "identity"}
+        )
+        assert response.status == 200
+        assert (
+            json.loads(await response.read()).keys() == nodes.NODE_CLASS_MAPPINGS.keys()
+        )
+        etag = response.headers["ETag"]
+
+        response = await client.get(
+            "/object_info",
+            headers={"Accept-Encoding": "identity", "If-None-Match": etag},
+        )
+        assert response.status == 304
+        assert await response.read() == b""
+
+        response = await client.get("/object_info", headers={"Accept-Encoding": "gzip"})
+        # the gzip variant is another representation with its own ETag
+        assert response.status == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["ETag"] != etag
+
+        # both describe the same content, either one revalidates
+        response = await client.get(
+            "/object_info",
+            headers={
+                "Accept-Encoding": "gzip",
+                "If-None-Match": response.headers["ETag"],
+            },
+        )
+        assert response.status == 304
+
+    with_server(test)
+
+
+def test_single_node_info(with_server):
+    async def test(server, client):
+        node_class = next(iter(nodes.NODE_CLASS_MAPPINGS))
+        response = await client.get(f"/object_info/{node_class}")
+        assert list(await response.json()) == [node_class]
+        response = await client.get("/object_info/NoSuchNode")
+        assert await response.json() == {}
+
+    with_server(test)
+
+
+def test_concurrent_misses_build_once_off_the_loop():
+    builds = []
+    version = [1]
+
+    def get_data(*key):
+        builds.append(key)
+        return {"value": "x" * 4096, "version": version[0]}
+
+    async def run_io(function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def main():
+        cache = JSONResponseCache(get_data, lambda: version[0], run_io)
+        entries = await asyncio.gather(*(cache.get_async() for _ in range(5)))
+        assert len(builds) == 1
+        assert all(entry is entries[0] for entry in entries)
+        assert "gzip" in entries[0].encoded
+
+        version[0] = 2
+        entry = await cache.get_async()
+        assert json.loads(gzip.decompress(entry.encoded["gzip"]))["version"] == 2
+        assert len(builds) == 2
+        assert cache.building == {}
+
+    asyncio.run(main())
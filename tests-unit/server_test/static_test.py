@@ -0,0 +1,83 @@
+import asyncio
+import re
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from app import static_manifest
+from app.static_manifest import StaticManifest
+
+
+def versioned_urls(html):
+    return dict(re.findall(r'(?:href|src)="([^"?]+)\?v=([0-9a-f]+)"', html))
+
+
+def test_index_links_stylesheets_and_scripts_by_version(with_server):
+    async def test(server, client):
+        response = await client.get("/")
+        html = await response.text()
+        assert response.headers["Cache-Control"] == "no-cache"
+        urls = versioned_urls(html)
+        assert set(urls) == {
+            "./lib/litegraph.css",
+            "./style.css",
+            "./user.css",
+            "./lib/litegraph.core.js",
+            "./lib/litegraph.extensions.js",
+        }
+        # modules are imported by their plain url everywhere
+        assert 'import { app } from "./scripts/app.js";' in html
+
+        response = await client.get("/style.css?v=" + urls["./style.css"])
+        assert response.headers["Cache-Control"] == (
+            static_manifest.IMMUTABLE_CACHE_CONTROL
+        )
+        response = await client.get("/style.css?v=0")
+        assert response.headers["Cache-Control"] == "no-cache"
+
+        etag = response.headers["ETag"]
+        response = await client.get("/style.css", headers={"If-None-Match": etag})
+        assert response.status == 304
+
+    with_server(test)
+
+
+def test_range_requests_get_partial_content(with_server):
+    async def test(server, client):
+        with open("web/style.css", "rb") as f:
+            data = f.read()
+        response = await client.get("/style.css", headers={"Range": "bytes=10-19"})
+        assert response.status == 206
+        assert response.headers["Content-Range"] == f"bytes 10-19/{len(data)}"
+        assert await response.read() == data[10:20]
+
+    with_server(test)
+
+
+def test_changed_stylesheet_gets_a_new_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(static_manifest, "CHECK_INTERVAL", 0)
+    (tmp_path / "index.html").write_text(
+        '<link rel="stylesheet" href="./user.css" />'
+        '<script type="module" src="./app.js"></script>'
+    )
+    (tmp_path / "user.css").write_text("body {}")
+    (tmp_path / "app.js").write_text("")
+
+    async def main():
+        manifest = StaticManifest()
+        app = web.Application()
+        app.add_routes(manifest.add_directory("/", str(tmp_path)))
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/index.html")
+            first = versioned_urls(await response.text())
+            assert list(first) == ["./user.css"]
+
+            (tmp_path / "user.css").write_text("body { color: red }")
+            response = await client.get("/index.html")
+            second = versioned_urls(await response.text())
+            assert second["./user.css"] != first["./user.css"]
+
+            response = await client.get("/user.css?v=" + second["./user.css"])
+            assert await response.text() == "body { color: red }"
+
+    asyncio.run(main())
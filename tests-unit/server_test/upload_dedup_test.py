@@ -0,0 +1,91 @@
+import hashlib
+import os
+
+import aiohttp
+
+from app.upload_index import UploadIndex
+from comfy.cli_args import args
+
+
+def post_image(client, data, filename, **fields):
+    form = aiohttp.FormData()
+    for name, value in fields.items():
+        form.add_field(name, value)
+    form.add_field("image", data, filename=filename, content_type="image/png")
+    return client.post("/upload/image", data=form)
+
+
+async def upload_names(client, *uploads):
+    names = []
+    for data, filename in uploads:
+        response = await post_image(client, data, filename)
+        assert response.status == 200
+        names.append((await response.json())["name"])
+    return names
+
+
+def test_dedup_by_name_returns_the_earlier_upload(with_server, comfy_dirs, monkeypatch):
+    monkeypatch.setattr(args, "dedup_uploads", "name")
+    input_dir = comfy_dirs["input"]
+
+    async def test(server, client):
+        names = await upload_names(
+            client, (b"same", "a.png"), (b"same", "b.png"), (b"other", "c.png")
+        )
+        assert names == ["a.png", "a.png", "c.png"]
+        assert sorted(os.listdir(input_dir)) == ["a.png", "c.png"]
+
+        # a file changed behind the index's back isn't reused
+        (input_dir / "a.png").write_bytes(b"edited")
+        assert await upload_names(client, (b"same", "d.png")) == ["d.png"]
+        assert (input_dir / "d.png").read_bytes() == b"same"
+
+        # only input uploads are deduplicated
+        response = await post_image(client, b"same", "e.png", type="temp")
+        assert (await response.json())["name"] == "e.png"
+        assert (comfy_dirs["temp"] / "e.png").exists()
+
+    with_server(test)
+
+
+def test_dedup_by_hardlink_keeps_the_name(with_server, comfy_dirs, monkeypatch):
+    monkeypatch.setattr(args, "dedup_uploads", "hardlink")
+    input_dir = comfy_dirs["input"]
+
+    async def test(server, client):
+        names = await upload_names(client, (b"same", "a.png"), (b"same", "b.png"))
+        assert names == ["a.png", "b.png"]
+        a, b = os.stat(input_dir / "a.png"), os.stat(input_dir / "b.png")
+        assert a.st_ino == b.st_ino and a.st_nlink == 2
+
+        # overwriting one of them must not change the other
+        response = await post_image(client, b"new", "b.png", overwrite="true")
+        assert (await response.json())["name"] == "b.png"
+        assert (input_dir / "a.png").read_bytes() == b"same"
+        assert (input_dir / "b.png").read_bytes() == b"new"
+
+    with_server(test)
+
+
+def test_index_is_replayed_and_a_torn_line_dropped(tmp_path):
+    index_file = str(tmp_path / "user" / "upload_index.jsonl")
+    path = tmp_path / "a.png"
+    path.write_bytes(b"a")
+    sha256 = hashlib.sha256(b"a").hexdigest()
+
+    index = UploadIndex(index_file)
+    index.add(sha256, str(path))
+    with open(index_file, "a") as f:
+        f.write('{"hash": "cut')  # a crash mid-write
+
+    index = UploadIndex(index_file)
+    assert index.find(sha256, str(tmp_path)) == str(path)
+    other = tmp_path / "b.png"
+    other.write_bytes(b"b")
+    index.add("b", str(other))
+
+    index = UploadIndex(index_file)
+    assert index.find("b", str(tmp_path)) == str(other)
+    assert index.find(sha256, str(tmp_path / "user")) is None
+    os.remove(path)
+    assert index.find(sha256, str(tmp_path)) is None
@@ -0,0 +1,134 @@
+import os
+
+import aiohttp
+
+import folder_paths
+from app import fs_watcher
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+
+
+def next_counter(output, prefix):
+    return folder_paths.get_save_image_path(prefix, str(output))[2]
+
+
+def test_save_counters_continue_after_existing_files(comfy_dirs):
+    output = comfy_dirs["output"]
+    touch(output / "ComfyUI_00003_.png")
+    touch(output / "my_img_00007_.png")
+    touch(output / "sub" / "ComfyUI_00010_.png")
+
+    assert next_counter(output, "ComfyUI") == 4
+    # handed out counters count as used until the file shows up
+    assert next_counter(output, "ComfyUI") == 5
+    assert next_counter(output, "my_img") == 8
+    assert next_counter(output, "sub/ComfyUI") == 11
+    assert next_counter(output, "new") == 1
+
+    # saved behind the index's back
+    touch(output / "ComfyUI_00006_.png")
+    assert next_counter(output, "ComfyUI") == 7
+
+
+class FakeWatcher:
+    def __init__(self):
+        self.callbacks = {}
+
+    def is_watching(self, path, callback):
+        return callback in self.callbacks.get(path, ())
+
+    def watch(self, path, callback):
+        self.callbacks.setdefault(path, []).append(callback)
+        return True
+
+    def emit(self, kind, path):
+        for callback in self.callbacks.get(os.path.dirname(path), []):
+            callback(kind, path, False)
+
+
+def count_listings(monkeypatch):
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    return listed
+
+
+def test_save_counters_list_the_folder_once(comfy_dirs, monkeypatch):
+    output = comfy_dirs["output"]
+    touch(output / "ComfyUI_00001_.png")
+    listed = count_listings(monkeypatch)
+    # without --watch-model-folders the watcher isn't used
+    monkeypatch.setattr(fs_watcher, "get_watcher", lambda: FakeWatcher())
+
+    for counter in range(2, 6):
+        assert next_counter(output, "ComfyUI") == counter
+        touch(output / f"ComfyUI_{counter:05}_.png")
+    assert len(listed) == 1
+
+    # a prefix without files lists the folder again once it changed
+    assert next_counter(output, "other") == 1
+    assert len(listed) == 2
+    touch(output / "other_00004_.png")
+    assert next_counter(output, "other") == 5
+    assert len(listed) == 3
+    assert next_counter(output, "other") == 6
+    assert len(listed) == 3
+
+
+def test_save_counters_use_the_watcher(comfy_dirs, monkeypatch):
+    output = comfy_dirs["output"]
+    watcher = FakeWatcher()
+    monkeypatch.setattr(folder_paths, "filename_watcher", watcher)
+    touch(output / "ComfyUI_00001_.png")
+    listed = count_listings(monkeypatch)
+
+    assert next_counter(output, "ComfyUI") == 2
+    assert next_counter(output, "other") == 1
+    touch(output / "other_00008_.png")
+    watcher.emit("created", str(output / "other_00008_.png"))
+    assert next_counter(output, "other") == 9
+    assert len(listed) == 1
+
+    watcher.emit("overflow", str(output / "unknown"))
+    touch(output / "ComfyUI_00010_.webp")
+    assert next_counter(output, "ComfyUI") == 11
+    assert len(listed) == 2
+
+
+def post_image(client, data, filename="a.png", **fields):
+    form = aiohttp.FormData()
+    for name, value in fields.items():
+        form.add_field(name, value)
+    form.add_field("image", data, filename=filename, content_type="image/png")
+    return client.post("/upload/image", data=form)
+
+
+def test_uploads_with_the_same_name_are_numbered(with_server, comfy_dirs):
+    input_dir = comfy_dirs["input"]
+    touch(input_dir / "b (5).png")
+
+    async def test(server, client):
+        names = []
+        for data in (b"1", b"2", b"3"):
+            response = await post_image(client, data)
+            names.append((await response.json())["name"])
+        assert names == ["a.png", "a (1).png", "a (2).png"]
+        assert (input_dir / "a (1).png").read_bytes() == b"2"
+
+        touch(input_dir / "b.png")
+        response = await post_image(client, b"b", filename="b.png")
+        assert (await response.json())["name"] == "b (6).png"
+
+        response = await post_image(client, b"new", overwrite="true")
+        assert (await response.json())["name"] == "a.png"
+        assert (input_dir / "a.png").read_bytes() == b"new"
+
+    with_server(test)
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import os
+from io import BytesIO
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+from app.upload_stream import UPLOAD_CHUNK_SIZE, read_body
+
+
+def image_form(data, filename="a.png", **fields):
+    form = aiohttp.FormData()
+    for name, value in fields.items():
+        form.add_field(name, value)
+    form.add_field("image", data, filename=filename, content_type="image/png")
+    return form
+
+
+def temp_files(directory):
+    return [name for name in os.listdir(directory) if name.startswith(".upload-")]
+
+
+async def run_io(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def test_upload_is_streamed_to_its_folder(with_server, comfy_dirs):
+    data = os.urandom(3 * UPLOAD_CHUNK_SIZE + 10)
+
+    async def test(server, client):
+        response = await client.post(
+            "/upload/image", data=image_form(data, subfolder="sub")
+        )
+        assert await response.json() == {
+            "name": "a.png",
+            "subfolder": "sub",
+            "type": "input",
+        }
+        assert (comfy_dirs["input"] / "sub" / "a.png").read_bytes() == data
+        assert temp_files(comfy_dirs["input"] / "sub") == []
+
+        response = await client.post(
+            "/upload/image", data=image_form(b"x", type="temp")
+        )
+        assert (await response.json())["type"] == "temp"
+        assert (comfy_dirs["temp"] / "a.png").read_bytes() == b"x"
+
+        # outside the input folder
+        response = await client.post(
+            "/upload/image", data=image_form(b"x", subfolder="../output")
+        )
+        assert response.status == 400
+        assert not (comfy_dirs["output"] / "a.png").exists()
+
+        response = await client.post("/upload/image", data={"type": "input"})
+        assert response.status == 400
+
+    with_server(test)
+
+
+def png(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_mask_upload(with_server, comfy_dirs):
+    Image.new("RGB", (4, 3), (10, 20, 30)).save(comfy_dirs["output"] / "a.png")
+    mask = Image.new("RGBA", (4, 3), (0, 0, 0, 0))
+    mask.putpixel((1, 2), (0, 0, 0, 200))
+
+    def mask_form(mask, filename="a.png"):
+        original = {"filename": filename, "type": "output", "subfolder": ""}
+        return image_form(
+            png(mask), filename="mask.png", original_ref=json.dumps(original)
+        )
+
+    async def test(server, client):
+        response = await client.post("/upload/mask", data=mask_form(mask))
+        assert await response.json() == {
+            "name": "mask.png",
+            "subfolder": "",
+            "type": "input",
+        }
+        with Image.open(comfy_dirs["input"] / "mask.png") as img:
+            pixels = np.asarray(img)
+        assert np.all(pixels[:, :, :3] == (10, 20, 30))
+        assert pixels[2, 1, 3] == 200 and pixels[:, :, 3].sum() == 200
+
+        response = await client.post(
+            "/upload/mask", data=mask_form(Image.new("RGBA", (3, 4)))
+        )
+        assert response.status == 400
+        assert "do not match" in await response.text()
+
+        response = await client.post(
+            "/upload/mask", data=mask_form(mask, filename="missing.png")
+        )
+        assert response.status == 404
+
+        # nothing was saved for the failed ones
+        assert sorted(os.listdir(comfy_dirs["input"])) == ["mask.png"]
+
+    with_server(test)
+
+
+def test_userdata_body_is_streamed_to_the_user_folder(with_server, comfy_dirs):
+    data = os.urandom(2 * UPLOAD_CHUNK_SIZE)
+
+    async def test(server, client):
+        response = await client.post("/userdata/a.bin", data=data)
+        assert response.status == 200
+        response = await client.get("/userdata/a.bin")
+        assert await response.read() == data
+        assert temp_files(comfy_dirs["user"] / "default") == []
+
+    with_server(test)
+
+
+def test_oversized_body_is_rejected_and_removed(tmp_path):
+    async def upload(request):
+        upload = await read_body(request, "a.bin", str(tmp_path), run_io, 1000)
+        await run_io(upload.commit, str(tmp_path / "a.bin"))
+        return web.Response()
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/", upload)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post("/", data=b"x" * 999)
+            assert response.status == 200
+            response = await client.post("/", data=b"x" * UPLOAD_CHUNK_SIZE * 2)
+            assert response.status == 413
+
+    asyncio.run(main())
+    assert temp_files(tmp_path) == []
+    assert (tmp_path / "a.bin").read_bytes() == b"x" * 999
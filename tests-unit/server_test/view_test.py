@@ -0,0 +1,82 @@
+import os
+
+from app.file_lookup import StatFileResponse, check_file_response_hook
+
+
+def write_clip(comfy_dirs, data):
+    path = comfy_dirs["output"] / "clip.mp4"
+    path.write_bytes(data)
+    return path
+
+
+def test_view_answers_conditional_and_range_requests(with_server, comfy_dirs):
+    data = os.urandom(100_000)
+    write_clip(comfy_dirs, data)
+
+    async def test(server, client):
+        response = await client.get("/view?filename=clip.mp4")
+        assert response.status == 200
+        assert await response.read() == data
+        etag = response.headers["ETag"]
+
+        response = await client.get(
+            "/view?filename=clip.mp4", headers={"If-None-Match": etag}
+        )
+        assert response.status == 304
+
+        response = await client.get(
+            "/view?filename=clip.mp4", headers={"Range": "bytes=1000-1999"}
+        )
+        assert response.status == 206
+        assert response.headers["Content-Range"] == f"bytes 1000-1999/{len(data)}"
+        assert await response.read() == data[1000:2000]
+
+        response = await client.get(
+            "/view?filename=clip.mp4",
+            headers={"Range": "bytes=-10", "If-Range": etag},
+        )
+        assert response.status == 206
+        assert await response.read() == data[-10:]
+
+        response = await client.get("/view?filename=missing.mp4")
+        assert response.status == 404
+
+    with_server(test)
+
+
+def test_conditional_request_sees_a_file_changed_within_the_stat_ttl(
+    with_server, comfy_dirs
+):
+    path = write_clip(comfy_dirs, b"old contents")
+
+    async def test(server, client):
+        response = await client.get("/view?filename=clip.mp4")
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+
+        # rewritten behind the server's back, its stat is still cached
+        path.write_bytes(b"new contents!")
+        os.utime(path, (0, os.stat(path).st_mtime + 10))
+
+        response = await client.get(
+            "/view?filename=clip.mp4", headers={"If-None-Match": etag}
+        )
+        assert response.status == 200
+        assert await response.read() == b"new contents!"
+
+        response = await client.get(
+            "/view?filename=clip.mp4", headers={"If-Modified-Since": last_modified}
+        )
+        assert response.status == 200
+
+    with_server(test)
+
+
+def test_stat_file_response_hook_is_used(tmp_path):
+    # aiohttp's FileResponse internals are private, fail here when they change
+    assert check_file_response_hook()
+    path = tmp_path / "a.txt"
+    path.write_text("a")
+    st = os.stat(path)
+    response = StatFileResponse(str(path), st)
+    assert response._get_file_path_stat_encoding("gzip")[1] is st
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import struct
+
+from app.websocket_broadcast import Broadcaster
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        self.sent.append(bytes(data))
+
+    async def close(self, code=None, message=None):
+        pass
+
+
+def test_coalesced_messages_keep_the_latest_in_event_order():
+    async def main():
+        broadcaster = Broadcaster(8)
+        ws = RecordingSocket()
+        broadcaster.add("a", ws)
+        broadcaster.push(False, "status 1", None, ("status", None))
+        broadcaster.push(False, "executing", None)
+        broadcaster.push(False, "status 2", None, ("status", None))
+        await asyncio.sleep(0)
+        assert ws.sent == ["executing", "status 2"]
+        assert broadcaster.clients["a"].coalesced == 1
+
+    asyncio.run(main())
+
+
+def test_slow_client_is_disconnected_when_its_queue_is_full():
+    async def main():
+        broadcaster = Broadcaster(2)
+        broadcaster.add("a", RecordingSocket())
+        for i in range(3):
+            broadcaster.push(False, f"message {i}", "a")
+        client = broadcaster.clients["a"]
+        assert client.closing
+        assert len(client) == 0
+
+    asyncio.run(main())
+
+
+class DroppedSocket(RecordingSocket):
+    async def send_str(self, data):
+        self.sent.append(data)
+        raise ConnectionResetError("Cannot write to closing transport")
+
+
+def test_dropped_client_is_not_sent_to_again(caplog):
+    async def main():
+        broadcaster = Broadcaster(8)
+        dropped = DroppedSocket()
+        other = RecordingSocket()
+        broadcaster.add("dropped", dropped)
+        broadcaster.add("other", other)
+        for i in range(5):
+            broadcaster.push(False, f"message {i}")
+            await asyncio.sleep(0)
+        broadcaster.push(False, "late")
+        await asyncio.sleep(0)
+        assert dropped.sent == ["message 0"]
+        assert len(other.sent) == 6
+        assert broadcaster.clients["dropped"].closing
+
+    with caplog.at_level(logging.DEBUG):
+        asyncio.run(main())
+    assert len([r for r in caplog.records if "send error" in r.message]) == 1
+
+
+def test_status_with_sid_survives_a_broadcast_status(with_server):
+    async def test(server, client):
+        push = server.broadcaster.push
+
+        def push_then_broadcast(binary, data, sid=None, key=None):
+            push(binary, data, sid, key)
+            if sid is not None and '"sid"' in data:
+                # a queue change, sent before the writer got to the initial status
+                status = {"status": server.get_queue_info()}
+                message = json.dumps({"type": "status", "data": status})
+                push(False, message, None, server.coalesce_key("status", status))
+
+        server.broadcaster.push = push_then_broadcast
+        ws = await client.ws_connect("/ws?clientId=abc")
+        first = await ws.receive_json(timeout=5)
+        second = await ws.receive_json(timeout=5)
+        await ws.close()
+
+        assert first["data"]["sid"] == "abc"
+        assert second["type"] == "status"
+        assert "sid" not in second["data"]
+
+    with_server(test)
+
+
+def test_targeted_and_broadcast_progress_do_not_replace_each_other(with_server):
+    async def test(server, client):
+        ws = await client.ws_connect("/ws?clientId=abc")
+        await ws.receive_json(timeout=5)
+
+        # queued in the same tick so the writer sees them together
+        for prompt_id, sid in (
+            ("p1", "abc"),
+            ("p2", "abc"),
+            ("p1", "abc"),
+            (None, None),
+        ):
+            await server.send_json(
+                "progress", {"value": 1, "max": 2, "prompt_id": prompt_id}, sid
+            )
+        received = [await ws.receive_json(timeout=5) for _ in range(3)]
+        await ws.close()
+
+        assert [m["data"]["prompt_id"] for m in received] == ["p2", "p1", None]
+
+    with_server(test)
+
+
+def test_image_frames_are_sent_as_built_and_in_order(with_server):
+    async def test(server, client):
+        import server as server_module
+        from PIL import Image
+
+        from app.image_encoding import encode_image_frame
+
+        publish = asyncio.create_task(server.publish_loop())
+        pushed = []
+        push = server.broadcaster.push
+
+        def record_push(binary, data, sid=None, key=None):
+            pushed.append(data)
+            push(binary, data, sid, key)
+
+        server.broadcaster.push = record_push
+        ws = await client.ws_connect("/ws?clientId=abc")
+        await ws.receive_json(timeout=5)
+
+        event = server_module.BinaryEventTypes.PREVIEW_IMAGE
+        frame = encode_image_frame("WEBP", Image.new("RGB", (8, 8)), event)
+
+        def node():
+            # what a node does on the executor thread
+            server.send_sync("executing", {"node": "1", "prompt_id": "p"}, "abc")
+            server.send_frame_sync(event, frame, "abc")
+
+        await asyncio.get_running_loop().run_in_executor(None, node)
+        assert (await ws.receive_json(timeout=5))["type"] == "executing"
+        message = await ws.receive_bytes(timeout=5)
+        await ws.close()
+        publish.cancel()
+
+        assert pushed[-1] is frame
+        assert message[:8] == struct.pack(">II", event, 3)
+        assert message[8:12] == b"RIFF"
+
+    with_server(test)
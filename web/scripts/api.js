@@ -96,7 +96,7 @@ class ComfyApi extends EventTarget {
 					switch (eventType) {
 					case 1:
 						const view2 = new DataView(event.data);
-						const imageType = view2.getUint32(0)
+						const imageType = view2.getUint32(4)
 						let imageMime
 						switch (imageType) {
 							case 1:
@@ -105,6 +105,9 @@ class ComfyApi extends EventTarget {
 								break;
 							case 2:
 								imageMime = "image/png"
+								break;
+							case 3:
+								imageMime = "image/webp"
 						}
 						const imageBlob = new Blob([buffer.slice(4)], { type: imageMime });
 						this.dispatchEvent(new CustomEvent("b_preview", { detail: imageBlob }));